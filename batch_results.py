@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Reading the results of finished Mailchimp batch operations.
+
+A finished batch links to a gzipped tar archive (response_body_url) with
+JSON files that each hold a list of per-operation responses. The archive
+is streamed and parsed one file at a time, so large batches are never
+loaded into memory as a whole.
+"""
+import csv
+import json
+import os
+import tarfile
+import threading
+
+
+def iter_operation_results(url, timeout=60.0):
+    """Stream a batch result archive and yield the per-operation results one by one"""
+    import requests
+
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        with tarfile.open(fileobj=response.raw, mode='r|gz') as archive:
+            for entry in archive:
+                if not entry.isfile() or not entry.name.endswith('.json'):
+                    continue
+                for result in json.load(archive.extractfile(entry)):
+                    yield result
+
+
+def parse_operation_id(operation_id):
+    """Split an operation id like 'create_batch:name@example.com' into kind and email address"""
+    kind, _, email_address = (operation_id or "").partition(':')
+    return kind, email_address
+
+
+class ErrorReport:
+    """Report of failed operations, written as CSV or JSONL (by file extension) while batches finish"""
+    columns = ['batch_id', 'operation', 'email_address', 'status_code', 'title', 'detail', 'errors']
+
+    def __init__(self, path):
+        self.path = path
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def add_batch(self, batch_id, results):
+        """Append the failed operations of one batch, returns (succeeded, failed) counts.
+
+        The rows are written once all results were read, so reading the
+        results of a batch again after an error does not report them twice.
+        """
+        succeeded = 0
+        rows = []
+        for result in results:
+            if result.get('status_code', 200) < 400:
+                succeeded += 1
+                continue
+            rows.append(self.row(batch_id, result))
+        self.write(rows)
+        return succeeded, len(rows)
+
+    def add_unreadable(self, batch_id, failed, error):
+        """Report a finished batch whose results could not be read, with the number of operations that failed"""
+        self.write([{
+            'batch_id': batch_id,
+            'operation': 'results',
+            'email_address': '',
+            'status_code': None,
+            'title': 'Unreadable results',
+            'detail': f"{failed} operations failed, their results could not be read: {error}",
+            'errors': [],
+        }], failed)
+
+    def write(self, rows, failed=None):
+        """Append rows to the report and count them (or failed) as failed operations"""
+        with self.lock:
+            if rows:
+                is_new = not os.path.exists(self.path)
+                with open(self.path, 'a', newline='', encoding='utf-8') as report:
+                    if self.path.endswith('.jsonl'):
+                        for row in rows:
+                            report.write(json.dumps(row) + "\n")
+                    else:
+                        writer = csv.DictWriter(report, fieldnames=self.columns)
+                        if is_new:
+                            writer.writeheader()
+                        for row in rows:
+                            writer.writerow(dict(row, errors=json.dumps(row['errors'])))
+            self.failed += len(rows) if failed is None else failed
+
+    def row(self, batch_id, result):
+        kind, email_address = parse_operation_id(result.get('operation_id'))
+        try:
+            details = json.loads(result.get('response') or "{}")
+        except ValueError:
+            details = {'detail': result.get('response')}
+        return {
+            'batch_id': batch_id,
+            'operation': kind,
+            'email_address': email_address,
+            'status_code': result.get('status_code'),
+            'title': details.get('title', ''),
+            'detail': details.get('detail', ''),
+            'errors': details.get('errors', []),
+        }
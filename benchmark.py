@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput benchmark of the updater against the local Mailchimp
+stand-in (fake_mailchimp.py), so it never touches a live audience.
+
+For every size, an Excel file with that many contacts is generated (half
+of them already in the list, some with invalid addresses), and the full
+pipeline runs on it: read, clean, prefetch or look up, build, submit and
+poll. Each size runs in its own process so peak memory is measured per
+run. Reports rows per second, API calls, peak memory and wall time per
+stage.
+
+    python benchmark.py                      # 1k, 10k and 100k rows
+    python benchmark.py --sizes 1000 5000 --latency 0.05 --throttle-rate 0.01
+    python benchmark.py --no-prefetch --json results.json
+    python benchmark.py --index-memory 1000000   # bytes per prefetched member
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# The benchmark must never reach the real API, whatever is in .env
+os.environ.update({
+    'MAILCHIMP_LIST_ID': 'benchmark',
+    'CONFIG_CACHE_PATH': '',
+    'CATEGORY_TYPE_STUDENT': 'type-student',
+    'CATEGORY_TYPE_EMPLOYEE': 'type-employee',
+    'CATEGORY_KIND_OF_EMAIL_WEEKLY': 'weekly',
+    'CATEGORY_TAAL_NEDERLANDS': 'taal-nl',
+    'CATEGORY_TAAL_ENGLISH': 'taal-en',
+})
+
+BENCHMARK_LIST = 'benchmark'
+
+
+def contact(number):
+    return {
+        'voornaam': f"Voornaam{number}",
+        'voorvoegsels': "van" if number % 7 == 0 else None,
+        'naam': f"Achternaam{number}",
+        'e-mailadres': f"student{number}@example.org" if number % 100 else f"invalid{number}",
+    }
+
+
+def generate_file(path, rows):
+    """Write an Excel file with generated contacts"""
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    columns = ['Voornaam', 'Voorvoegsels', 'Naam', 'E-mailadres']
+    sheet.append(columns)
+    for number in range(rows):
+        sheet.append([contact(number)[column.lower()] for column in columns])
+    workbook.save(path)
+
+
+def existing_members(rows, contact_type='Student'):
+    """Members already in the list: every second contact, a quarter of them with outdated data"""
+    for number in range(0, rows, 2):
+        data = contact(number)
+        if not number % 100:
+            continue
+        yield {
+            'email_address': data['e-mailadres'],
+            'merge_fields': {
+                'FNAME': data['voornaam'],
+                'LNAME': data['naam'],
+                'TYPE': contact_type if number % 8 else 'Employee',
+            },
+            'interests': {
+                'type-student': bool(number % 8),
+                'type-employee': not number % 8,
+                'taal-nl': True,
+                'taal-en': False,
+            },
+        }
+
+
+def run_single(args):
+    """Benchmark one file size in this process, returns the results"""
+    import resource
+    import mailchimp_engine
+    from fake_mailchimp import FakeMailChimp
+
+    mailchimp_engine.config_prefetch = not args.no_prefetch
+    fake = FakeMailChimp(latency=args.latency, throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                         batch_rate=args.batch_rate, seed=1)
+    fake.add_members(BENCHMARK_LIST, existing_members(args.single))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f"contacts_{args.single}.xlsx")
+        generate_file(path, args.single)
+
+        engine = mailchimp_engine.UpdateEngine(
+            contact_type='Student',
+            debug_mode=False,
+            update=True,
+            workers=args.workers,
+            list_id=BENCHMARK_LIST,
+            mailchimp=fake,
+            log=lambda message: None,
+        )
+        start = time.perf_counter()
+        summary = engine.run(path)
+        report = engine.new_error_report()
+        report.path = os.path.join(directory, os.path.basename(report.path))
+        engine.poll_batches(report, interval=0.05)
+        wall = time.perf_counter() - start
+    fake.close()
+
+    return {
+        'rows': args.single,
+        'wall_time': round(wall, 3),
+        'rows_per_second': round(args.single / wall, 1),
+        'peak_memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'created': summary['created'],
+        'updated': summary['updated'],
+        'unchanged': summary['unchanged'],
+        'skipped': summary['skipped'],
+        'failed_operations': report.failed,
+        'stage_times': {stage: round(seconds, 3) for stage, seconds in engine.stage_times.items()},
+        'api': fake.summary(),
+    }
+
+
+def measure_index(rows):
+    """Memory per prefetched member, in a dict of API members and in a MemberIndex"""
+    import tracemalloc
+    from hashlib import md5
+    from member_index import MemberIndex
+
+    def members():
+        for member in existing_members(rows):
+            md5hash = md5(member['email_address'].lower().encode('utf-8')).hexdigest()
+            yield md5hash, dict(member, status='subscribed')
+
+    results = {}
+    for name, index in (('dict', {}), ('MemberIndex', MemberIndex(['type-student', 'type-employee', 'weekly', 'taal-nl', 'taal-en']))):
+        tracemalloc.start()
+        start = time.perf_counter()
+        for md5hash, member in members():
+            index[md5hash] = member
+        count = len(index)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {
+            'members': count,
+            'bytes_per_member': round(current / count, 1),
+            'peak_bytes_per_member': round(peak / count, 1),
+            'build_seconds': round(time.perf_counter() - start, 3),
+        }
+        del index
+    return results
+
+
+def print_table(results):
+    stages = []
+    for result in results:
+        stages += [stage for stage in result['stage_times'] if stage not in stages]
+    header = ['rows', 'wall s', 'rows/s', 'calls', '429s', 'peak MB'] + [f"{stage} s" for stage in stages]
+    print("  ".join(f"{column:>10}" for column in header))
+    for result in results:
+        values = [
+            result['rows'], result['wall_time'], result['rows_per_second'], result['api']['total_calls'],
+            result['api']['throttled'], result['peak_memory_mb'],
+        ] + [result['stage_times'].get(stage, 0.0) for stage in stages]
+        print("  ".join(f"{value:>10}" for value in values))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the updater against a local Mailchimp stand-in.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="rows per generated file")
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--no-prefetch', action='store_true', help="look up every contact instead of prefetching the list")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated seconds per API request")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="share of requests answered with HTTP 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with HTTP 500")
+    parser.add_argument('--batch-rate', type=float, default=50000.0, help="batch operations Mailchimp processes per second")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--index-memory', type=int, metavar='ROWS', help="only measure the memory per prefetched member")
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.index_memory:
+        results = measure_index(args.index_memory)
+        for name, values in results.items():
+            print(f"{name:>12}: {values['members']} members, {values['bytes_per_member']} bytes per member "
+                  f"({values['peak_bytes_per_member']} peak), built in {values['build_seconds']}s")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    if args.single:
+        print(json.dumps(run_single(args)))
+        return 0
+
+    results = []
+    passthrough = strip_sizes(argv if argv is not None else sys.argv[1:])
+    for size in args.sizes:
+        print(f"Benchmarking {size} rows...", file=sys.stderr, flush=True)
+        with tempfile.TemporaryDirectory() as directory:
+            # Checkpoints and reports stay out of the working directory, so no run resumes another
+            env = dict(os.environ, CONFIG_CHECKPOINT_DIR=os.path.join(directory, "checkpoints"), CONFIG_REPORT_DIR=directory)
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--single', str(size)] + passthrough,
+                check=True, capture_output=True, text=True, env=env,
+            ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+def strip_sizes(arguments):
+    """Drop --sizes and --json from the arguments passed on to a single run"""
+    stripped = []
+    skipping = False
+    for argument in arguments:
+        if argument in ('--sizes', '--json'):
+            skipping = True
+            continue
+        if skipping and not argument.startswith('--'):
+            continue
+        skipping = False
+        stripped.append(argument)
+    return stripped
+
+
+if __name__ == "__main__":
+    sys.exit(main())
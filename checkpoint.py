@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint journal of a run, so an interrupted run can be resumed.
+
+The journal is a JSON lines file named after a hash of the import file
+and the run settings. It records every chunk of rows that was looked up
+and turned into operations, the members a sync removes, the batches that
+Mailchimp accepted and the outcome of the batches that finished. A restarted run with the same file
+and settings restores that work instead of repeating it, and never
+resubmits an accepted batch. The journal is removed once all batches of
+the run have finished, or when they are left to Mailchimp without polling.
+"""
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+
+def checkpoint_key(path, settings):
+    """Hash of the content of the import file and the settings that determine the operations"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+
+class Checkpoint:
+    def __init__(self, directory, key):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"run_{key}.jsonl")
+        self.lock = threading.Lock()
+        self.state = self.load()
+
+    def load(self):
+        """Read the journal of an earlier run with the same key, if there is one"""
+        state = {'chunks': {}, 'built': False, 'sync': None, 'batches': {}, 'outcomes': {}}
+        if not os.path.exists(self.path):
+            return state
+        with open(self.path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # last line cut off by a crash
+                if entry['type'] == 'chunk':
+                    state['chunks'][entry['number']] = entry
+                elif entry['type'] == 'built':
+                    state['built'] = True
+                elif entry['type'] == 'sync':
+                    state['sync'] = entry
+                elif entry['type'] == 'batch':
+                    state['batches'][(entry['kind'], entry['index'])] = entry
+                elif entry['type'] == 'outcome':
+                    state['outcomes'][entry['id']] = entry
+        return state
+
+    @property
+    def resumed(self):
+        return bool(self.state['chunks'] or self.state['batches'])
+
+    def record(self, entry):
+        """Append an entry and make sure it is on disk before the run continues"""
+        line = json.dumps(dict(entry, at=datetime.now().isoformat(timespec='seconds'))) + "\n"
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as journal:
+                journal.write(line)
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def remove(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Mailchimp API, for benchmarks and load tests that
+must not touch a live audience.
+
+FakeMailChimp has the same interface as the mailchimp3 client for the
+calls the updater makes, and can be passed to UpdateEngine(mailchimp=...).
+It keeps the lists in memory and simulates latency, throttling (HTTP 429,
+also when more than max_connections requests run at once) and server
+errors. Batch operations are applied at batch_rate operations per second,
+and their result archives are served over HTTP on localhost, like the
+response_body_url of the real API. The same server answers the REST
+calls of the asyncio engine at api_url(), see
+AsyncUpdateEngine(base_url=...).
+"""
+import io
+import json
+import random
+import tarfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from mailchimp3.mailchimpclient import MailChimpError
+
+
+def subscriber_hash(email_address):
+    return md5(email_address.lower().encode('utf-8')).hexdigest()
+
+
+def timestamp(moment=None):
+    return (moment or datetime.now(timezone.utc)).isoformat(timespec='seconds')
+
+
+def api_error(status, title, detail=""):
+    return MailChimpError({'status': status, 'title': title, 'detail': detail})
+
+
+class FakeResponse:
+    """The parts of a requests response that the updater reads"""
+    def __init__(self, result, status_code=200):
+        self.result = result
+        self.status_code = status_code
+
+    def json(self):
+        return self.result
+
+
+class FakeMailChimp:
+    # Request settings of a mailchimp3 client, see mailchimp_engine.post_json()
+    base_url = "https://fake.api.mailchimp.com/3.0/"
+    auth = None
+    timeout = None
+    request_headers = {}
+    request_hooks = {}
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, error_rate=0.0, max_connections=10,
+                 batch_rate=5000.0, seed=None, error_page=False):
+        self.latency = latency # seconds per request
+        self.throttle_rate = throttle_rate # share of requests answered with 429
+        self.error_rate = error_rate # share of requests answered with 500
+        self.max_connections = max_connections
+        self.batch_rate = batch_rate # batch operations processed per second
+        self.error_page = error_page # answer 429 and 500 over HTTP with an HTML page, like a proxy in front of the API
+        self.random = random.Random(seed)
+
+        self.members = {} # list id -> subscriber hash -> member
+        self.segments = {} # list id -> segment id -> static segment (or tag) with the hashes of its members
+        self.batches = {} # batch id -> batch
+        self.calls = Counter() # endpoint -> number of requests
+        self.throttled = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self.active = 0
+        self.server = None
+
+        self.lists = FakeLists(self)
+        self.batch_operations = FakeBatchOperations(self)
+
+    def add_members(self, list_id, members):
+        """Put members into a list directly, without counting API calls"""
+        audience = self.members.setdefault(list_id, {})
+        for member in members:
+            member = dict(member)
+            member.setdefault('status', 'subscribed')
+            member.setdefault('merge_fields', {})
+            member.setdefault('interests', {})
+            member.setdefault('last_changed', timestamp())
+            audience[subscriber_hash(member['email_address'])] = member
+
+    def request(self, endpoint, body=None):
+        """Account for one API request and simulate its latency and failures"""
+        with self.lock:
+            self.calls[endpoint] += 1
+            if body is not None:
+                self.bytes_received += len(json.dumps(body))
+            self.active += 1
+            too_many = self.active > self.max_connections
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if too_many or self.random.random() < self.throttle_rate:
+                with self.lock:
+                    self.throttled += 1
+                raise api_error(429, "Too Many Requests", "You have exceeded the limit of 10 simultaneous connections.")
+            if self.random.random() < self.error_rate:
+                with self.lock:
+                    self.errors += 1
+                raise api_error(500, "Internal Server Error")
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _make_request(self, method, url, data=None, **kwargs):
+        """Streamed requests that bypass the mailchimp3 entities, i.e. the batch submissions"""
+        if method != 'POST' or not url.endswith('/batches'):
+            raise api_error(404, "Resource Not Found", url)
+        return FakeResponse(self.batch_operations.create(json.loads(b"".join(data))))
+
+    def add_segment(self, list_id, name, members=()):
+        """Create a static segment (a tag) directly, returns it"""
+        segments = self.segments.setdefault(list_id, {})
+        segment = {'id': 1000 + sum(len(values) for values in self.segments.values()), 'name': name,
+                   'members': set(subscriber_hash(email_address) for email_address in members)}
+        segments[segment['id']] = segment
+        return segment
+
+    def tag_member(self, list_id, md5hash, names):
+        """Add a member to the tags with these names, creating missing tags like Mailchimp does"""
+        for name in names:
+            segment = next((segment for segment in self.segments.get(list_id, {}).values() if segment['name'] == name), None)
+            if segment is None:
+                segment = self.add_segment(list_id, name)
+            segment['members'].add(md5hash)
+
+    def summary(self):
+        return {
+            'calls': dict(self.calls),
+            'total_calls': sum(self.calls.values()),
+            'throttled': self.throttled,
+            'errors': self.errors,
+            'bytes_received': self.bytes_received,
+        }
+
+    def archive_url(self, batch_id):
+        """Serve the result archives on localhost"""
+        return f"{self.serve()}{batch_id}.tar.gz"
+
+    def api_url(self):
+        """Serve the REST API on localhost, returns its base URL"""
+        return f"{self.serve()}3.0/"
+
+    def serve(self):
+        """Start the HTTP server on first use, returns its root URL"""
+        with self.lock:
+            if self.server is None:
+                fake = self
+
+                class Handler(BaseHTTPRequestHandler):
+                    def do_GET(self):
+                        if self.path.startswith('/3.0/'):
+                            self.answer()
+                            return
+                        batch = fake.batches.get(self.path.strip('/').split('.')[0])
+                        if batch is None or batch.get('archive') is None:
+                            self.send_error(404)
+                            return
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'application/x-gzip')
+                        self.send_header('Content-Length', str(len(batch['archive'])))
+                        self.end_headers()
+                        self.wfile.write(batch['archive'])
+
+                    def do_POST(self):
+                        self.answer()
+
+                    def answer(self):
+                        url = urlsplit(self.path)
+                        length = int(self.headers.get('Content-Length') or 0)
+                        data = json.loads(self.rfile.read(length)) if length else None
+                        status, result = fake.rest(self.command, url.path[len('/3.0/'):], dict(parse_qsl(url.query)), data)
+                        if status in (429, 500) and fake.error_page:
+                            content, content_type = b"<html><body>Service unavailable</body></html>", 'text/html'
+                        else:
+                            content, content_type = json.dumps(result).encode('utf-8'), 'application/json'
+                        self.send_response(status)
+                        self.send_header('Content-Type', content_type)
+                        self.send_header('Content-Length', str(len(content)))
+                        self.end_headers()
+                        self.wfile.write(content)
+
+                    def log_message(self, format, *args):
+                        pass
+
+                self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+                thread = threading.Thread(target=self.server.serve_forever)
+                thread.daemon = True
+                thread.start()
+        return f"http://127.0.0.1:{self.server.server_port}/"
+
+    def rest(self, method, path, params, data):
+        """Answer a REST call with the entities of the fake, returns (status code, response)"""
+        parts = path.strip('/').split('/')
+        for name in ('count', 'offset'):
+            if name in params:
+                params[name] = int(params[name])
+        try:
+            if method == 'POST' and parts == ['batches']:
+                return 200, self.batch_operations.create(data)
+            if method == 'GET' and len(parts) == 2 and parts[0] == 'batches':
+                return 200, self.batch_operations.get(parts[1])
+            if len(parts) < 2 or parts[0] != 'lists':
+                raise api_error(404, "Resource Not Found", path)
+            list_id, resource = parts[1], parts[2:]
+            if method == 'POST' and not resource:
+                return 200, self.lists.update_members(list_id, data)
+            if method == 'GET' and resource == ['members']:
+                return 200, self.lists.members.all(list_id, **params)
+            if method == 'GET' and len(resource) == 2 and resource[0] == 'members':
+                return 200, self.lists.members.get(list_id, resource[1])
+            if resource == ['segments']:
+                if method == 'POST':
+                    return 200, self.lists.segments.create(list_id, data)
+                return 200, self.lists.segments.all(list_id, **params)
+            if method == 'POST' and len(resource) == 2 and resource[0] == 'segments':
+                return 200, self.lists.segments.update_members(list_id, resource[1], data)
+            if method == 'GET' and len(resource) == 3 and resource[0] == 'segments' and resource[2] == 'members':
+                return 200, self.lists.segments.members.all(list_id, resource[1], **params)
+            raise api_error(404, "Resource Not Found", path)
+        except MailChimpError as e:
+            return e.args[0]['status'], e.args[0]
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def apply_operation(self, operation):
+        """Apply one batch operation to the lists, returns (status code, response)"""
+        parts = operation['path'].strip('/').split('/')
+        list_id = parts[1]
+        audience = self.members.setdefault(list_id, {})
+        body = json.loads(operation.get('body') or "{}")
+
+        if operation['method'] == 'POST' and len(parts) == 3:
+            md5hash = subscriber_hash(body['email_address'])
+            if md5hash in audience:
+                return 400, {'title': 'Member Exists', 'detail': f"{body['email_address']} is already a list member."}
+            audience[md5hash] = {
+                'email_address': body['email_address'],
+                'status': body.get('status', 'subscribed'),
+                'merge_fields': dict(body.get('merge_fields', {})),
+                'interests': dict(body.get('interests', {})),
+                'last_changed': timestamp(),
+            }
+            self.tag_member(list_id, md5hash, body.get('tags', []))
+            return 200, audience[md5hash]
+
+        if operation['method'] == 'PATCH' and len(parts) == 4:
+            member = audience.get(parts[3])
+            if member is None:
+                return 404, {'title': 'Resource Not Found', 'detail': "The requested resource could not be found."}
+            member['merge_fields'].update(body.get('merge_fields', {}))
+            member['interests'].update(body.get('interests', {}))
+            if 'status' in body:
+                member['status'] = body['status']
+            member['last_changed'] = timestamp()
+            return 200, member
+
+        if operation['method'] == 'DELETE' and len(parts) == 4:
+            # Archives the member, like the real API
+            member = audience.get(parts[3])
+            if member is None or member['status'] == 'archived':
+                return 404, {'title': 'Resource Not Found', 'detail': "The requested resource could not be found."}
+            member['status'] = 'archived'
+            member['last_changed'] = timestamp()
+            return 204, None
+
+        return 400, {'title': 'Invalid Resource', 'detail': f"{operation['method']} {operation['path']} is not supported by the fake."}
+
+
+class FakeLists:
+    def __init__(self, fake):
+        self.fake = fake
+        self.members = FakeListMembers(fake)
+        self.segments = FakeListSegments(fake)
+
+    def update_members(self, list_id, data):
+        """Batch subscribe: upsert up to 500 members and return the results at once"""
+        if len(data['members']) > 500:
+            raise ValueError('You may only batch sub/unsub 500 members at a time')
+        self.fake.request('lists.update_members', data)
+        response = {'new_members': [], 'updated_members': [], 'errors': []}
+        with self.fake.lock:
+            audience = self.fake.members.setdefault(list_id, {})
+            for body in data['members']:
+                md5hash = subscriber_hash(body['email_address'])
+                member = audience.get(md5hash)
+                if member is None:
+                    member = audience[md5hash] = {
+                        'email_address': body['email_address'],
+                        'status': body.get('status') or body.get('status_if_new', 'subscribed'),
+                        'merge_fields': {},
+                        'interests': {},
+                    }
+                    response['new_members'].append(member)
+                elif not data.get('update_existing'):
+                    response['errors'].append({'email_address': body['email_address'], 'error': f"{body['email_address']} is already a list member",
+                                               'error_code': 'ERROR_CONTACT_EXISTS'})
+                    continue
+                else:
+                    if 'status' in body:
+                        member['status'] = body['status']
+                    response['updated_members'].append(member)
+                member['merge_fields'].update(body.get('merge_fields', {}))
+                member['interests'].update(body.get('interests', {}))
+                member['last_changed'] = timestamp()
+        response['new_members'] = [dict(member) for member in response['new_members']]
+        response['updated_members'] = [dict(member) for member in response['updated_members']]
+        response.update(total_created=len(response['new_members']), total_updated=len(response['updated_members']),
+                        error_count=len(response['errors']))
+        return response
+
+
+class FakeListMembers:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def get(self, list_id, subscriber_hash, **queryparams):
+        self.fake.request('lists.members.get')
+        member = self.fake.members.get(list_id, {}).get(subscriber_hash)
+        if member is None:
+            raise api_error(404, "Resource Not Found", "The requested resource could not be found.")
+        return dict(member)
+
+    def all(self, list_id, get_all=False, count=10, offset=0, since_last_changed=None, status=None, **queryparams):
+        """Archived members are only listed when they are asked for, like with the real API"""
+        self.fake.request('lists.members.all')
+        members = [member for member in self.fake.members.get(list_id, {}).values()
+                   if (member['status'] == status if status else member['status'] != 'archived')]
+        if since_last_changed:
+            members = [member for member in members if member['last_changed'] > since_last_changed]
+        page = members if get_all else members[offset:offset + min(count, 1000)]
+        return {'members': [dict(member) for member in page], 'total_items': len(members)}
+
+
+class FakeListSegments:
+    def __init__(self, fake):
+        self.fake = fake
+        self.members = FakeSegmentMembers(fake)
+
+    def all(self, list_id, get_all=False, count=10, offset=0, **queryparams):
+        self.fake.request('lists.segments.all')
+        segments = [{'id': segment['id'], 'name': segment['name'], 'member_count': len(segment['members'])}
+                    for segment in self.fake.segments.get(list_id, {}).values()]
+        page = segments if get_all else segments[offset:offset + min(count, 1000)]
+        return {'segments': page, 'total_items': len(segments)}
+
+    def create(self, list_id, data):
+        self.fake.request('lists.segments.create', data)
+        with self.fake.lock:
+            segment = self.fake.add_segment(list_id, data['name'], data.get('static_segment', []))
+        return {'id': segment['id'], 'name': segment['name'], 'member_count': len(segment['members'])}
+
+    def update_members(self, list_id, segment_id, data):
+        """Add and remove up to 500 members each, only members of the list can be added"""
+        if len(data.get('members_to_add', [])) > 500 or len(data.get('members_to_remove', [])) > 500:
+            raise api_error(400, "Invalid Resource", "You may only add or remove 500 members at a time")
+        self.fake.request('lists.segments.update_members', data)
+        segment = self.fake.segments.get(list_id, {}).get(int(segment_id))
+        if segment is None:
+            raise api_error(404, "Resource Not Found", "The requested resource could not be found.")
+        response = {'members_added': [], 'members_removed': [], 'errors': []}
+        missing = []
+        with self.fake.lock:
+            audience = self.fake.members.get(list_id, {})
+            for email_address in data.get('members_to_add', []):
+                md5hash = subscriber_hash(email_address)
+                if md5hash not in audience:
+                    missing.append(email_address)
+                    continue
+                segment['members'].add(md5hash)
+                response['members_added'].append(dict(audience[md5hash]))
+            for email_address in data.get('members_to_remove', []):
+                md5hash = subscriber_hash(email_address)
+                if md5hash in segment['members']:
+                    segment['members'].discard(md5hash)
+                    response['members_removed'].append(dict(audience[md5hash]))
+        if missing:
+            response['errors'].append({'email_addresses': missing, 'error': "Email addresses are not subscribed to the list"})
+        response.update(total_added=len(response['members_added']), total_removed=len(response['members_removed']),
+                        error_count=len(missing))
+        return response
+
+
+class FakeSegmentMembers:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def all(self, list_id, segment_id, get_all=False, count=10, offset=0, **queryparams):
+        self.fake.request('lists.segments.members.all')
+        segment = self.fake.segments.get(list_id, {}).get(int(segment_id))
+        if segment is None:
+            raise api_error(404, "Resource Not Found", "The requested resource could not be found.")
+        audience = self.fake.members.get(list_id, {})
+        members = [audience[md5hash] for md5hash in sorted(segment['members']) if md5hash in audience]
+        page = members if get_all else members[offset:offset + min(count, 1000)]
+        return {'members': [dict(member) for member in page], 'total_items': len(members)}
+
+
+class FakeBatchOperations:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def create(self, data):
+        self.fake.request('batch_operations.create', data)
+        with self.fake.lock:
+            batch_id = f"fake{len(self.fake.batches) + 1:06d}"
+            self.fake.batches[batch_id] = {
+                'id': batch_id,
+                'operations': data['operations'],
+                'submitted': time.monotonic(),
+                'archive': None,
+                'errored': 0,
+            }
+        return self.status(batch_id)
+
+    def get(self, batch_id, **queryparams):
+        self.fake.request('batch_operations.get')
+        if batch_id not in self.fake.batches:
+            raise api_error(404, "Resource Not Found", "The requested resource could not be found.")
+        return self.status(batch_id)
+
+    def status(self, batch_id):
+        batch = self.fake.batches[batch_id]
+        total = len(batch['operations'])
+        elapsed = time.monotonic() - batch['submitted']
+        finished = min(total, int(elapsed * self.fake.batch_rate))
+
+        with self.fake.lock:
+            if finished == total and batch['archive'] is None:
+                self.finish(batch)
+        done = batch['archive'] is not None
+        return {
+            'id': batch_id,
+            'status': 'finished' if done else 'started',
+            'total_operations': total,
+            'finished_operations': total if done else finished,
+            'errored_operations': batch['errored'] if done else 0,
+            'submitted_at': timestamp(),
+            'response_body_url': self.fake.archive_url(batch_id) if done else "",
+        }
+
+    def finish(self, batch):
+        """Apply the operations of a batch and build its result archive (called with the lock held)"""
+        results = []
+        for operation in batch['operations']:
+            status_code, response = self.fake.apply_operation(operation)
+            if status_code >= 400:
+                batch['errored'] += 1
+            results.append({
+                'status_code': status_code,
+                'operation_id': operation.get('operation_id'),
+                'response': json.dumps(response),
+            })
+
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for number, start in enumerate(range(0, len(results), 1000)):
+                content = json.dumps(results[start:start + 1000]).encode('utf-8')
+                entry = tarfile.TarInfo(f"{batch['id']}/{number}.json")
+                entry.size = len(content)
+                tar.addfile(entry, io.BytesIO(content))
+        batch['archive'] = archive.getvalue()
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+Queue of import files that are processed at the same time, e.g. the
+exports of several faculties with a mix of Student and Employee files.
+
+Every file is read, cleaned and deduplicated in a process pool, so the
+files are parsed in parallel instead of one after the other. Once all
+files are ready, an email address that is in several files is kept in one
+of them, and the API stages (lookup, submit and poll) of every file run
+in a thread with an engine of its own. All jobs take their requests' slots from the
+scheduler of the process (Mailchimp's connection limit applies to the
+whole account) and share one backoff, the metrics, and the member index
+of every list, which is fetched once instead of once per file.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from mailchimp_engine import (
+    Backoff, RunCancelled, UpdateEngine, config_dedup, config_processes, config_workers, create_engine, get_scheduler,
+    normalise_contacts, plan_dedup, print_log, read_contacts,
+)
+from metrics import Metrics
+
+
+def prepare_file(path, dedup):
+    """Read, clean and deduplicate an import file (runs in a worker process).
+
+    Returns (rows, (drop, names), chunks) with chunks as (chunk, cleaned)
+    pairs. Only the index of a raw chunk is sent back, the engine needs
+    nothing else of it.
+    """
+    chunks = [(chunk.iloc[:, :0], normalise_contacts(chunk)) for chunk in read_contacts(path)]
+    plan = plan_dedup(path, dedup, cleaned=[cleaned for chunk, cleaned in chunks])
+    return sum(len(chunk) for chunk, cleaned in chunks), plan, chunks
+
+
+def dedup_files(files, policy):
+    """Keep every email address in one file only, by extending the (drop, names) plans of the files.
+
+    files are (name, (drop, names), chunks) tuples in queue order, with the
+    plan and chunks of prepare_file. The policy decides like in plan_dedup,
+    with the queue order as the order of the rows. Returns the number of
+    rows left out because their address is in another file.
+    """
+    if policy == 'off':
+        return 0
+    first = {} # subscriber hash -> (file number, index, roepnaam, achternaam) of its first row
+    groups = {} # subscriber hash -> all rows, only for addresses in several files
+    for number, (name, (drop, names), chunks) in enumerate(files):
+        for chunk, (contacts, warnings, errors) in chunks:
+            for index, md5hash, roepnaam, achternaam in zip(contacts.index, contacts['hash'], contacts['roepnaam'], contacts['achternaam']):
+                if index in drop:
+                    continue # a duplicate within its own file
+                row = (number, index) + names.get(index, (roepnaam, achternaam))
+                if md5hash in first:
+                    groups.setdefault(md5hash, [first[md5hash]]).append(row)
+                else:
+                    first[md5hash] = row
+
+    dropped = 0
+    for rows in groups.values():
+        kept = rows[-1] if policy == 'last' else rows[0]
+        for row in rows:
+            if row is not kept:
+                files[row[0]][1][0][row[1]] = f"{kept[1]} of {files[kept[0]][0]}"
+                dropped += 1
+        if policy == 'non-empty':
+            roepnaam = next((row[2] for row in rows if row[2]), "")
+            achternaam = next((row[3] for row in rows if row[3]), "")
+            if (roepnaam, achternaam) != (kept[2], kept[3]):
+                files[kept[0]][1][1][kept[1]] = (roepnaam, achternaam)
+    return dropped
+
+
+def parse_job(argument, contact_type):
+    """Split a command-line job like 'faculty.xlsx=Employee' into (path, contact type)"""
+    path, separator, job_type = argument.rpartition('=')
+    if separator and job_type in ('Student', 'Employee'):
+        return path, job_type
+    return argument, contact_type
+
+
+class SharedMembers:
+    """Member index per list, fetched by the first job that needs it and reused by the others"""
+    def __init__(self):
+        self.indexes = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, engine):
+        with self.lock:
+            lock = self.locks.setdefault(engine.listid, threading.Lock())
+        with lock:
+            if engine.listid not in self.indexes:
+                index = engine.load_member_index()
+                len(index) # a MemberIndex sorts itself on first use, before other threads read it
+                self.indexes[engine.listid] = index
+            else:
+                engine.log_message(f"Using the list members fetched by another job ({len(self.indexes[engine.listid])} members)")
+            return self.indexes[engine.listid]
+
+
+class Job:
+    """One import file of a JobQueue"""
+    def __init__(self, path, contact_type):
+        self.path = path
+        self.contact_type = contact_type
+        self.name = os.path.basename(path)
+        self.status = 'queued' # queued, reading, running, submitted, finished, done, cancelled or failed
+        self.engine = None
+        self.rows = 0
+        self.summary = None
+        self.error = None
+        self.progress = (0, 0, "")
+
+    @property
+    def batch_ids(self):
+        return [batch['id'] for batch in self.engine.batches] if self.engine else []
+
+    def status_text(self):
+        """One line with the state of the job, for the log and the job list"""
+        text = f"{self.name} ({self.contact_type}): {self.status}"
+        if self.summary:
+            text += f" - {self.summary['created']} new, {self.summary['updated']} updates, {self.summary['unchanged']} unchanged"
+        if self.batch_ids:
+            text += f" - batches {', '.join(self.batch_ids)}"
+        if self.error:
+            text += f" - {self.error}"
+        return text
+
+
+class JobQueue:
+    """Processes several import files at once, with the same interface as UpdateEngine.
+
+    jobs are (path, contact type) pairs. on_update(job) is called from
+    worker threads whenever the status of a job changes.
+    """
+    def __init__(self, jobs, mode=None, targets=None, workers=config_workers, processes=config_processes,
+                 dedup=config_dedup, log=print_log, progress=None, on_update=None, scheduler=None, **kwargs):
+        self.log_message = log
+        self.progress = progress or (lambda value, maximum, text: None)
+        self.on_update = on_update or (lambda job: None)
+        self.processes = processes or os.cpu_count() or 1
+        self.dedup_policy = dedup
+        self.jobs = [Job(path, contact_type) for path, contact_type in jobs]
+        self.listid = ",".join(sorted(set(target['list_id'] for target in targets))) if targets else None
+        self.import_file_path = ", ".join(job.path for job in self.jobs)
+        self.aantal_ingeschrevenen = 0
+        self.prepare_time = 0.0
+        self.progress_lock = threading.Lock()
+
+        self.metrics = Metrics()
+        self.scheduler = scheduler or get_scheduler(workers)
+        backoff = Backoff()
+        members = SharedMembers()
+        for number, job in enumerate(self.jobs, 1):
+            job.engine = create_engine(
+                mode,
+                targets=targets,
+                contact_type=job.contact_type,
+                workers=workers,
+                dedup=dedup,
+                scheduler=self.scheduler,
+                log=lambda message, number=number: log(f"[job {number}] {message}"),
+                progress=lambda value, maximum, text, job=job: self.job_progress(job, value, maximum, text),
+                **kwargs,
+            )
+            job.engine.share(backoff, self.metrics, members)
+            if self.listid is None:
+                self.listid = job.engine.listid
+
+    @property
+    def batches(self):
+        return [batch for job in self.jobs for batch in job.engine.batches]
+
+    @property
+    def stage_times(self):
+        # The jobs run side by side, so the slowest job decides the wall time of a stage
+        stage_times = {'prepare': self.prepare_time}
+        for job in self.jobs:
+            for stage, seconds in job.engine.stage_times.items():
+                stage_times[stage] = max(stage_times.get(stage, 0.0), seconds)
+        return stage_times
+
+    def update(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        self.log_message(f"Job {job.status_text()}")
+        self.on_update(job)
+
+    def job_progress(self, job, value, maximum, text):
+        """Report the combined progress of all jobs"""
+        with self.progress_lock:
+            job.progress = (value, maximum, text)
+            value = sum(other.progress[0] for other in self.jobs)
+            maximum = sum(other.progress[1] for other in self.jobs)
+        self.progress(value, maximum, f"[{job.name}] {text}")
+        self.on_update(job)
+
+    def run(self, import_file_path=None, aantal=None):
+        """Prepare the files in a process pool, then run the jobs of all files at once, returns the summary"""
+        self.log_message(f"Processing {len(self.jobs)} files with {min(self.processes, len(self.jobs))} processes: "
+                         f"{', '.join(job.name for job in self.jobs)}")
+        start = time.perf_counter()
+        # Spawned rather than forked, the GUI and the engines have threads running
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(self.processes, len(self.jobs)), mp_context=context) as processes:
+            prepared = [processes.submit(prepare_file, job.path, self.dedup_policy) for job in self.jobs]
+            for job in self.jobs:
+                self.update(job, 'reading')
+            files = [self.read_job(job, future) for job, future in zip(self.jobs, prepared)]
+        self.prepare_time = time.perf_counter() - start
+
+        # All jobs update the same lists, so an address that is in several files is sent once
+        ready = [(job, file) for job, file in zip(self.jobs, files) if file is not None]
+        dropped = dedup_files([(job.name,) + file for job, file in ready], self.dedup_policy)
+        if dropped:
+            self.log_message(f"Found {dropped} rows with an email address that is in another file, keeping one row per "
+                             f"email address ({self.dedup_policy} wins)")
+
+        # A sync compares the list with the contacts of all files, not only those of its own file
+        hashes = None
+        if len(ready) == len(self.jobs):
+            hashes = set(md5hash for job, (dedup, chunks) in ready for chunk, cleaned in chunks for md5hash in cleaned[0]['hash'])
+        planned = set()
+        for job, file in ready:
+            job.engine.share_sync(hashes, planned)
+
+        with ThreadPoolExecutor(max_workers=max(len(ready), 1)) as threads:
+            futures = [threads.submit(self.run_job, job, dedup, chunks) for job, (dedup, chunks) in ready]
+        # Wait for all jobs, so the batches of the others are kept when one fails
+        for future in futures:
+            future.result()
+        return self.summary()
+
+    def read_job(self, job, prepared):
+        """Wait for the file of a job, returns its (dedup, chunks) or None when it could not be read"""
+        try:
+            job.rows, dedup, chunks = prepared.result()
+        except Exception as e:
+            self.update(job, 'failed', str(e))
+            return None
+        self.aantal_ingeschrevenen += job.rows
+        return dedup, chunks
+
+    def run_job(self, job, dedup, chunks):
+        try:
+            job.engine.check_cancelled()
+            job.engine.prepare(dedup, chunks)
+            self.update(job, 'running')
+            job.summary = job.engine.run(job.path, job.rows)
+        except RunCancelled:
+            self.update(job, 'cancelled')
+            return
+        except Exception as e:
+            self.update(job, 'failed', str(e))
+            return
+        if job.engine.batches and not job.summary['dry_run']:
+            self.update(job, 'submitted')
+        else:
+            self.update(job, 'done')
+
+    def summary(self):
+        """Totals of all jobs plus the summary of each job"""
+        summaries = []
+        for job in self.jobs:
+            summary = dict(job.summary or {}, file=job.path, contact_type=job.contact_type)
+            summary.update(status=job.status, error=job.error, batch_ids=job.batch_ids)
+            summaries.append(summary)
+        summary = {
+            'files': [job.path for job in self.jobs],
+            'rows': self.aantal_ingeschrevenen,
+            'jobs': summaries,
+            'batches': self.batches,
+            'stage_times': {stage: round(seconds, 3) for stage, seconds in self.stage_times.items()},
+            'dry_run': any(job_summary.get('dry_run') for job_summary in summaries),
+            'failed': sum(1 for job in self.jobs if job.status in ('failed', 'cancelled')),
+            'api': self.metrics.snapshot(),
+        }
+        for count in ('created', 'updated', 'unchanged', 'removed', 'skipped', 'duplicates', 'warnings'):
+            summary[count] = sum(job_summary.get(count, 0) for job_summary in summaries)
+        return summary
+
+    metrics_report = UpdateEngine.metrics_report
+    export_metrics = UpdateEngine.export_metrics
+
+    def new_error_report(self):
+        return self.jobs[0].engine.new_error_report()
+
+    def poll_batches(self, report, batches=None, interval=None):
+        """Poll the batches of all jobs in parallel, into one error report"""
+        jobs = [job for job in self.jobs if job.status == 'submitted']
+        if not jobs:
+            return
+
+        def poll(job):
+            job_batches = None if batches is None else [batch for batch in batches if batch in job.engine.batches]
+            job.engine.poll_batches(report, job_batches, interval)
+            if all('failed' in batch for batch in job.engine.batches):
+                self.update(job, 'finished')
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = [pool.submit(poll, job) for job in jobs]
+        for future in futures:
+            future.result()
+
+    def release_checkpoint(self):
+        # A job that failed keeps its journal, to be resumed
+        for job in self.jobs:
+            if job.status == 'submitted':
+                job.engine.release_checkpoint()
+
+    def check_batches(self):
+        """Status of the batches of all jobs, with the totals per job file under 'jobs'"""
+        if not self.batches:
+            return None, []
+        totals = {'batches': 0, 'total': 0, 'finished': 0, 'errored': 0, 'pending': 0, 'statuses': {}, 'jobs': {}}
+        checks = []
+        for job in self.jobs:
+            job_totals, job_checks = job.engine.check_batches()
+            if not job_totals:
+                continue
+            totals['jobs'][job.path] = job_totals
+            checks += job_checks
+            for count in ('batches', 'total', 'finished', 'errored', 'pending'):
+                totals[count] += job_totals[count]
+            for status, number in job_totals['statuses'].items():
+                totals['statuses'][status] = totals['statuses'].get(status, 0) + number
+        return totals, checks
+
+    def cancel(self):
+        for job in self.jobs:
+            job.engine.cancel()
+
+    def close(self):
+        for job in self.jobs:
+            job.engine.close()
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio variant of the processing engine.
+
+AsyncUpdateEngine keeps the processing flow of UpdateEngine (reading,
+cleaning, debug/dry-run mode, the category mapping and batch building)
+but talks to the Mailchimp REST API directly with aiohttp instead of
+through mailchimp3. Prefetch pages, member lookups, batch submissions and
+status polls run concurrently on one event loop, sharing a pooled
+keep-alive session and the slots of the API scheduler (scheduler.py), so
+one process can use all of Mailchimp's simultaneous connections without a
+thread per request.
+
+Select it with CONFIG_ENGINE=async, --engine async or in the GUI. It needs
+aiohttp (pip install aiohttp).
+"""
+import asyncio
+import json
+import random
+import time
+import threading
+from concurrent.futures import CancelledError
+from hashlib import md5
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+import mailchimp_engine
+from mailchimp_engine import (
+    RunCancelled, UpdateEngine, config_paginate, config_poll_max_interval, config_retries, config_timeout,
+    error_status, member_fields, segment_chunks, segment_request, subscribe_limit, subscribe_members,
+)
+from payloads import JsonStream, dumps
+from scheduler import BULK, INTERACTIVE, WRITE
+
+
+class AsyncUpdateEngine(UpdateEngine):
+    def __init__(self, *args, api_key=None, base_url=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.api_key = api_key or mailchimp_engine.api_key
+        self.api_url = base_url # another address of the API, such as FakeMailChimp.api_url()
+        self.loop = None
+        self.session = None
+
+    @property
+    def base_url(self):
+        if self.api_url:
+            return self.api_url
+        # The data center is the part of the API key after the dash, e.g. us6
+        return f"https://{self.api_key.split('-')[-1]}.api.mailchimp.com/3.0/"
+
+    def start(self):
+        """Start the event loop thread and open the HTTP session on first use"""
+        if self.loop is not None:
+            return
+        if not AIOHTTP_AVAILABLE:
+            raise RuntimeError("The asyncio engine needs aiohttp: pip install aiohttp")
+        if not self.api_key:
+            raise ValueError("MAILCHIMP_API_KEY not set in .env file")
+
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.daemon = True
+        thread.start()
+        asyncio.run_coroutine_threadsafe(self.open_session(), self.loop).result()
+
+    async def open_session(self):
+        self.session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth('mailchimp_update', self.api_key),
+            connector=aiohttp.TCPConnector(limit=self.workers, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=config_timeout),
+        )
+
+    def wait(self, coroutine):
+        """Run a coroutine on the engine's event loop and wait for its result"""
+        try:
+            self.start()
+            self.check_cancelled()
+        except BaseException:
+            coroutine.close() # it never runs
+            raise
+        try:
+            return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+        except (CancelledError, asyncio.CancelledError):
+            raise RunCancelled("Processing cancelled")
+
+    def cancel(self):
+        """Cancel the run, including the requests that are in flight"""
+        super().cancel()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.cancel_tasks)
+
+    def cancel_tasks(self):
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+
+    def close(self):
+        """Close the HTTP session and stop the event loop"""
+        if self.loop is None:
+            return
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop = None
+        self.session = None
+
+    async def request(self, method, path, endpoint, body=None, priority=BULK, **kwargs):
+        """One API request in a slot of the scheduler, retried like call_api and recorded in the metrics.
+
+        body is serialized to JSON, a JsonStream while it is sent.
+        """
+        from mailchimp3.mailchimpclient import MailChimpError
+
+        sent = 0
+        if isinstance(body, JsonStream):
+            sent = len(body)
+            kwargs['headers'] = {'Content-Type': 'application/json', 'Content-Length': str(sent)}
+        elif body is not None:
+            kwargs['data'] = dumps(body)
+            kwargs['headers'] = {'Content-Type': 'application/json'}
+            sent = len(kwargs['data'])
+        for attempt in range(config_retries + 1):
+            if isinstance(body, JsonStream):
+                kwargs['data'] = body.pieces() # a generator is used up by an attempt
+            if self.backoff.delay > 0:
+                await asyncio.sleep(self.backoff.delay)
+            await self.scheduler.acquire_async(priority)
+            slot_status = 0 # a network error or cancelled until the API answers
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, self.base_url + path, **kwargs) as response:
+                    status = response.status
+                    body = await response.read()
+                elapsed = time.perf_counter() - start
+                try:
+                    result = json.loads(body) if body else None # no body with 204
+                except ValueError:
+                    # Not JSON, e.g. the HTML error page of a proxy with a 502 or a 429
+                    if status < 400:
+                        raise aiohttp.ClientPayloadError(f"Invalid JSON in the response of {endpoint}")
+                    result = {'detail': body[:200].decode('utf-8', 'replace')}
+                slot_status = status if status >= 400 else None
+                if status < 400:
+                    self.metrics.observe(endpoint, elapsed, None, sent, retry=attempt > 0)
+                    self.backoff.succeeded()
+                    return result
+                error = MailChimpError(dict(result or {}, status=status))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                elapsed = time.perf_counter() - start
+            finally:
+                self.scheduler.release(endpoint, time.perf_counter() - start, slot_status)
+
+            status = error_status(error)
+            self.metrics.observe(endpoint, elapsed, status or 0, sent, retry=attempt > 0)
+            if status is not None and status != 429 and status < 500:
+                self.backoff.succeeded() # the API answered, so it is not throttling us
+                raise error # Client errors such as 404 will not go away by retrying
+            if status == 429:
+                self.backoff.throttled()
+            if attempt == config_retries:
+                raise error
+            await asyncio.sleep(random.uniform(0, min(30.0, 0.5 * 2 ** attempt)))
+
+    def prefetch_members(self, since_last_changed=None, index=None, status=None):
+        """Fetch the first page, then all other pages of the list concurrently"""
+        if index is None:
+            index = self.new_member_index()
+        return self.wait(self.prefetch_members_async(since_last_changed, index, status))
+
+    async def prefetch_members_async(self, since_last_changed, index, status=None):
+        path = f"lists/{self.listid}/members"
+        params = {'fields': ",".join("members." + field for field in member_fields.split(",")) + ",total_items"}
+        if since_last_changed:
+            params['since_last_changed'] = since_last_changed
+        if status:
+            params['status'] = status
+        fetched = [0]
+
+        def add_page(page):
+            for member in page.get('members', []):
+                index[md5(member['email_address'].lower().encode('utf-8')).hexdigest()] = member
+            fetched[0] += len(page.get('members', []))
+            self.progress(fetched[0], total, f"Fetching list members {fetched[0]}/{total}")
+
+        self.log_message(f"Fetching current list members ({config_paginate} per request, concurrently)...")
+        first = await self.request('GET', path, 'lists.members.all', params=dict(params, count=config_paginate, offset=0))
+        total = first.get('total_items', 0)
+        add_page(first)
+
+        async def fetch(offset):
+            add_page(await self.request('GET', path, 'lists.members.all', params=dict(params, count=config_paginate, offset=offset)))
+
+        await asyncio.gather(*(fetch(offset) for offset in range(config_paginate, total, config_paginate)))
+        requests_made = max(1, -(-total // config_paginate))
+        self.log_message(f"Fetched {len(index)} list members in {requests_made} requests")
+        return index
+
+    def lookup_members(self, hashes):
+        """Look up members concurrently, keeping the input order"""
+        return self.wait(self.lookup_members_async(hashes))
+
+    async def lookup_members_async(self, hashes):
+        aantal = len(hashes)
+        done = [0]
+
+        async def lookup(md5hash):
+            try:
+                hit = await self.request('GET', f"lists/{self.listid}/members/{md5hash}", 'lists.members.get', params={'fields': member_fields})
+            except Exception as e:
+                if error_status(e) != 404:
+                    raise
+                hit = None
+            done[0] += 1
+            self.progress(done[0], aantal, f"Looking up members {done[0]}/{aantal} - Time remaining: {self.eta_text()}")
+            return hit
+
+        self.log_message(f"Looking up {aantal} contacts with up to {self.workers} concurrent requests...")
+        hits = await asyncio.gather(*(lookup(md5hash) for md5hash in hashes))
+        index = {md5hash: hit for md5hash, hit in zip(hashes, hits) if hit is not None}
+        self.log_message(f"Found {len(index)} of {aantal} contacts in the list")
+        return index
+
+    def submit_batches(self, kind, operations):
+        """Submit all chunks concurrently and remember every batch id"""
+        self.wait(self.submit_batches_async(kind, operations))
+
+    async def submit_batches_async(self, kind, operations):
+        chunks = self.pending_chunks(kind, operations)
+        handles = await asyncio.gather(
+            *(self.request('POST', "batches", 'batches.create', body=JsonStream("operations", chunk), priority=WRITE) for index, chunk in chunks),
+            return_exceptions=True,
+        )
+        errors = []
+        for (index, chunk), handle in zip(chunks, handles):
+            if isinstance(handle, BaseException):
+                # Keep the ids of the chunks that were accepted before reporting the failure
+                errors.append(handle)
+                continue
+            self.batch_submitted(kind, index, chunk, handle)
+        if errors:
+            raise errors[0]
+
+    def subscribe_batches(self, kind, operations):
+        """Send all batch subscribe requests concurrently and keep their results"""
+        self.wait(self.subscribe_batches_async(kind, operations))
+
+    async def subscribe_batches_async(self, kind, operations):
+        chunks = self.pending_chunks(kind, operations, subscribe=True)
+        if not chunks:
+            return
+        self.log_message(f"Sending {sum(len(chunk) for index, chunk in chunks)} operations with batch subscribe ({subscribe_limit} members per request)...")
+        responses = await asyncio.gather(
+            *(self.request('POST', f"lists/{self.listid}", 'lists.batch_subscribe',
+                           body={"members": subscribe_members(chunk), "update_existing": True}, priority=WRITE)
+              for index, chunk in chunks),
+            return_exceptions=True,
+        )
+        errors = []
+        for (index, chunk), response in zip(chunks, responses):
+            if isinstance(response, BaseException):
+                # Keep the results of the requests that succeeded before reporting the failure
+                errors.append(response)
+                continue
+            self.batch_subscribed(kind, index, chunk, response)
+        if errors:
+            raise errors[0]
+
+    def static_segments(self):
+        return self.wait(self.static_segments_async())
+
+    async def static_segments_async(self):
+        path = f"lists/{self.listid}/segments"
+        params = {'type': 'static', 'fields': 'segments.id,segments.name,total_items', 'count': 1000}
+        segments = []
+        total = None
+        while total is None or len(segments) < total:
+            page = await self.request('GET', path, 'lists.segments.all', params=dict(params, offset=len(segments)))
+            total = page.get('total_items', 0)
+            if not page.get('segments'):
+                break
+            segments += page['segments']
+        return segments
+
+    def create_segment(self, name):
+        return self.wait(self.request('POST', f"lists/{self.listid}/segments", 'lists.segments.create',
+                                      body={'name': name, 'static_segment': []}, priority=WRITE))
+
+    def segment_members(self, segment_id):
+        """Fetch the first page, then all other pages of the segment concurrently"""
+        return self.wait(self.segment_members_async(segment_id))
+
+    async def segment_members_async(self, segment_id):
+        path = f"lists/{self.listid}/segments/{segment_id}/members"
+        params = {'fields': 'members.email_address,total_items', 'count': config_paginate}
+        hashes = set()
+
+        def add_page(page):
+            hashes.update(md5(member['email_address'].lower().encode('utf-8')).hexdigest() for member in page.get('members', []))
+
+        first = await self.request('GET', path, 'lists.segments.members.all', params=dict(params, offset=0))
+        add_page(first)
+
+        async def fetch(offset):
+            add_page(await self.request('GET', path, 'lists.segments.members.all', params=dict(params, offset=offset)))
+
+        await asyncio.gather(*(fetch(offset) for offset in range(config_paginate, first.get('total_items', 0), config_paginate)))
+        return hashes
+
+    def segment_batches(self, operations):
+        """Send all segment requests concurrently and keep their results"""
+        self.wait(self.segment_batches_async(operations))
+
+    async def segment_batches_async(self, operations):
+        chunks = [
+            (segment_id, index, chunk)
+            for segment_id, segment_requests in segment_chunks(operations).items()
+            for index, chunk in self.pending(f"segment-{segment_id}", 'segment', segment_requests)
+        ]
+        if not chunks:
+            return
+        self.log_message(f"Sending {sum(len(chunk) for segment_id, index, chunk in chunks)} segment changes in {len(chunks)} requests...")
+        responses = await asyncio.gather(
+            *(self.request('POST', f"lists/{self.listid}/segments/{segment_id}", 'lists.segments.update_members',
+                           body=segment_request(chunk), priority=WRITE) for segment_id, index, chunk in chunks),
+            return_exceptions=True,
+        )
+        errors = []
+        for (segment_id, index, chunk), response in zip(chunks, responses):
+            if isinstance(response, BaseException):
+                # Keep the results of the requests that succeeded before reporting the failure
+                errors.append(response)
+                continue
+            self.segment_updated(segment_id, index, chunk, response)
+        if errors:
+            raise errors[0]
+
+    def check_batches(self):
+        """Fetch the status of all batches concurrently"""
+        if not self.batches:
+            return None, []
+        return self.aggregate_checks(self.wait(self.check_batches_async()))
+
+    async def check_batches_async(self):
+        remote = [batch for batch in self.batches if 'check' not in batch]
+        return await asyncio.gather(*(self.request('GET', f"batches/{batch['id']}", 'batches.get', priority=INTERACTIVE) for batch in remote))
+
+    def _poll_batches(self, report, batches, delay):
+        self.wait(self.poll_batches_async(report, batches, delay))
+
+    async def poll_batches_async(self, report, batches, delay):
+        from batch_results import iter_operation_results
+
+        log = self.log_message
+        pending = list(batches)
+        attempts = {} # batch id -> failed attempts to read its results
+        loop = asyncio.get_running_loop()
+
+        async def poll(batch):
+            try:
+                check = await self.request('GET', f"batches/{batch['id']}", 'batches.get', priority=INTERACTIVE)
+            except Exception as e:
+                log(f"Error polling batch {batch['id']}: {str(e)}")
+                return batch
+            self.batch_checked(batch, check)
+            if check['status'] != 'finished':
+                return batch
+
+            if check.get('errored_operations', 0) and check.get('response_body_url'):
+                try:
+                    # The archive is streamed with requests in a worker thread
+                    succeeded, failed = await loop.run_in_executor(
+                        None, report.add_batch, batch['id'], self.collect_failed(iter_operation_results(check['response_body_url'])))
+                    log(f"Batch {batch['id']} ({batch['kind']}) finished: {succeeded} succeeded, {failed} failed")
+                    self.batch_finished(batch, check, failed)
+                except Exception as e:
+                    if self.results_failed(report, batch, check, e, attempts):
+                        return batch
+            else:
+                log(f"Batch {batch['id']} ({batch['kind']}) finished: all {check.get('total_operations', 0)} operations succeeded")
+                self.batch_finished(batch, check, 0)
+            return None
+
+        while pending and not self.cancelled.is_set():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, config_poll_max_interval)
+            pending = [batch for batch in await asyncio.gather(*(poll(batch) for batch in pending)) if batch is not None]
+            self.report_processing()
+
+        if report.failed:
+            log(f"All batches finished. {report.failed} failed operations written to {report.path}")
+        else:
+            log("All batches finished without errors")
@@ -0,0 +1,2200 @@
+# -*- coding: utf-8 -*-
+"""
+Processing engine of the Mailchimp list updater: reading and cleaning
+import files, looking up members, building and submitting batch
+operations and following them up.
+
+Can be used from the GUI (mailchimp_update.py), imported as a library, or
+run from the command line for scheduled runs:
+
+    python mailchimp_engine.py contacts.xlsx --type Student --dry-run
+
+Importing this module is cheap: pandas, mailchimp3 and requests are only
+loaded when they are needed.
+"""
+import argparse
+import codecs
+import csv
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from hashlib import md5
+
+from dotenv import load_dotenv
+
+from batch_results import ErrorReport, iter_operation_results
+from checkpoint import Checkpoint, checkpoint_key
+from member_cache import MemberCache
+from metrics import Metrics, Throughput, format_duration, profiled, write_report
+from payloads import JsonStream, PayloadTemplate, dumps, field
+from scheduler import BULK, INTERACTIVE, WRITE, ApiScheduler, Slot, pooled_client
+
+load_dotenv()
+api_key = os.environ.get("MAILCHIMP_API_KEY")
+
+# Load configuration from environment variables
+config_update = os.environ.get("CONFIG_UPDATE", "False").lower() == "true"
+config_paginate = int(os.environ.get("CONFIG_PAGINATE", "1000"))
+config_prefetch = os.environ.get("CONFIG_PREFETCH", "True").lower() == "true"
+config_workers = int(os.environ.get("CONFIG_WORKERS", "10")) # Mailchimp allows 10 simultaneous connections
+config_processes = int(os.environ.get("CONFIG_PROCESSES", "0")) # processes reading import files of a job queue, 0 for one per CPU
+config_retries = int(os.environ.get("CONFIG_RETRIES", "5"))
+config_timeout = float(os.environ.get("CONFIG_TIMEOUT", "20")) # seconds per API request
+config_engine = os.environ.get("CONFIG_ENGINE", "threaded").lower() # threaded or async
+config_skip_unchanged = os.environ.get("CONFIG_SKIP_UNCHANGED", "True").lower() == "true" # no PATCH for members that already match
+config_group_mode = os.environ.get("CONFIG_GROUP_MODE", "interests").lower() # interests, or segments for static segments and tags
+config_sync = os.environ.get("CONFIG_SYNC", "off").lower() # off, archive or unsubscribe the members of the contact type missing from the import
+config_sync_max_share = float(os.environ.get("CONFIG_SYNC_MAX_SHARE", "0.1")) # abort when the sync would remove more of the contact type
+config_dedup = os.environ.get("CONFIG_DEDUP", "first").lower() # first, last, non-empty or off, see plan_dedup()
+config_cache_path = os.environ.get("CONFIG_CACHE_PATH", "") # empty disables the member cache
+config_cache_webhooks = os.environ.get("CONFIG_CACHE_WEBHOOKS", "False").lower() == "true" # webhook_receiver.py keeps the cache current
+config_cache_max_age = float(os.environ.get("CONFIG_CACHE_MAX_AGE", "24")) # hours; with webhooks, fetch the changes when the last sync is older
+config_chunk_size = int(os.environ.get("CONFIG_CHUNK_SIZE", "5000")) # rows read from the import file at a time
+config_batch_size = int(os.environ.get("CONFIG_BATCH_SIZE", "5000")) # operations per batch
+config_batch_max_bytes = int(os.environ.get("CONFIG_BATCH_MAX_BYTES", "5000000")) # payload size per batch
+config_subscribe_max = int(os.environ.get("CONFIG_SUBSCRIBE_MAX", "5000")) # runs up to this many operations use batch subscribe, 0 disables it
+config_poll_interval = float(os.environ.get("CONFIG_POLL_INTERVAL", "5")) # seconds before the first status poll
+config_poll_max_interval = float(os.environ.get("CONFIG_POLL_MAX_INTERVAL", "300"))
+config_batch_rate = float(os.environ.get("CONFIG_BATCH_RATE", "50")) # operations per second Mailchimp is assumed to process until measured
+config_report_dir = os.environ.get("CONFIG_REPORT_DIR", ".") # where reports of failed operations are written
+config_report_format = os.environ.get("CONFIG_REPORT_FORMAT", "csv").lower() # csv or jsonl
+config_checkpoint_dir = os.environ.get("CONFIG_CHECKPOINT_DIR", "checkpoints") # empty disables resuming interrupted runs
+config_lists = os.environ.get("CONFIG_LISTS", "") # JSON file with several target lists, see load_targets()
+config_metrics_file = os.environ.get("CONFIG_METRICS_FILE", "") # run metrics as JSON, or Prometheus text for .prom
+debug_mode = os.environ.get("DEBUG_MODE", "False").lower() == "true"
+profile_mode = os.environ.get("PROFILE", "").lower() # cprofile or tracemalloc
+listid = os.environ.get("MAILCHIMP_LIST_ID")
+default_contact_type = os.environ.get("DEFAULT_CONTACT_TYPE", "Student")
+
+# Load category configuration from environment variables
+category = {
+    'Kind of email': {
+        'name': 'Kind of email',
+        'id': os.environ.get("CATEGORY_KIND_OF_EMAIL_ID"),
+        'Weekly': os.environ.get("CATEGORY_KIND_OF_EMAIL_WEEKLY"),
+        'instant': os.environ.get("CATEGORY_KIND_OF_EMAIL_INSTANT"),
+    },
+    'Type': {
+        'name': 'Type',
+        'id': os.environ.get("CATEGORY_TYPE_ID"),
+        'Student': os.environ.get("CATEGORY_TYPE_STUDENT"),
+        'Employee': os.environ.get("CATEGORY_TYPE_EMPLOYEE"),
+    }, 
+    'Taal': {
+        'name': 'Taal',
+        'id': os.environ.get("CATEGORY_TAAL_ID"),
+        'Nederlands': os.environ.get("CATEGORY_TAAL_NEDERLANDS"),
+        'English': os.environ.get("CATEGORY_TAAL_ENGLISH"),
+    },
+}
+
+# Static segments per group value, used instead of the interests with CONFIG_GROUP_MODE=segments.
+# A value is the name of a tag (tags are static segments) or the id of a static segment.
+segment = {
+    'Kind of email': {
+        'Weekly': os.environ.get("SEGMENT_KIND_OF_EMAIL_WEEKLY"),
+        'instant': os.environ.get("SEGMENT_KIND_OF_EMAIL_INSTANT"),
+    },
+    'Type': {
+        'Student': os.environ.get("SEGMENT_TYPE_STUDENT"),
+        'Employee': os.environ.get("SEGMENT_TYPE_EMPLOYEE"),
+    },
+    'Taal': {
+        'Nederlands': os.environ.get("SEGMENT_TAAL_NEDERLANDS"),
+        'English': os.environ.get("SEGMENT_TAAL_ENGLISH"),
+    },
+}
+
+# Member fields needed to decide between create and update
+member_fields = "email_address,status,merge_fields.FNAME,merge_fields.LNAME,merge_fields.TYPE,interests"
+
+# Created on first use by get_client() and get_scheduler()
+client = None
+client_lock = threading.Lock()
+api_scheduler = None
+scheduler_lock = threading.Lock()
+
+def get_scheduler(workers=None):
+    """Create the scheduler that all API requests of the process share on first use.
+    
+    workers sets its number of slots, also when it exists already. Only the
+    top level of a run (the command line, a JobQueue or MultiListEngine)
+    passes it, and hands the scheduler to its engines with scheduler=.
+    """
+    global api_scheduler
+    with scheduler_lock:
+        if api_scheduler is None:
+            api_scheduler = ApiScheduler(maximum=workers or config_workers)
+        elif workers and workers != api_scheduler.maximum:
+            api_scheduler.resize(workers)
+    return api_scheduler
+
+def get_client():
+    """Create the Mailchimp client on first use, sending its requests through the scheduler's pooled session"""
+    global client
+    with client_lock:
+        if client is None:
+            if not api_key:
+                raise ValueError("MAILCHIMP_API_KEY not set in .env file")
+            client = pooled_client(api_key, get_scheduler(), config_timeout)
+    return client
+
+def error_status(error):
+    """Return the HTTP status code of a failed API call, or None for network errors"""
+    from mailchimp3.mailchimpclient import MailChimpError
+    if isinstance(error, MailChimpError) and error.args and isinstance(error.args[0], dict):
+        details = error.args[0]
+        if details.get('status'):
+            return int(details['status'])
+        if details.get('response') is not None:
+            return details['response'].status_code
+    return None
+
+class Backoff:
+    """Delay shared by all workers, doubled on HTTP 429 and relaxed again on success"""
+    def __init__(self, initial=0.5, maximum=30.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0.0
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            time.sleep(delay)
+    
+    def throttled(self):
+        with self.lock:
+            self.delay = min(max(self.delay * 2, self.initial), self.maximum)
+    
+    def succeeded(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay > self.initial else 0.0
+
+def call_api(method, *args, backoff=None, retries=config_retries, metrics=None, endpoint=None, sent=0, scheduler=None,
+             priority=BULK, **kwargs):
+    """Call a mailchimp3 method, retrying throttled requests and server errors with jitter.
+    
+    Every attempt is recorded in metrics under endpoint, with sent as its body size.
+    A scheduler (see scheduler.py) gives every attempt a slot, by priority.
+    """
+    from mailchimp3.mailchimpclient import MailChimpError
+    import requests
+    
+    endpoint = endpoint or method.__qualname__
+    for attempt in range(retries + 1):
+        if backoff is not None:
+            backoff.wait()
+        with scheduler.slot(priority, endpoint) if scheduler is not None else nullcontext(Slot()) as slot:
+            start = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+                error = None
+            except (MailChimpError, requests.exceptions.RequestException) as e:
+                error = e
+                slot.status = error_status(e) or 0
+            elapsed = time.perf_counter() - start
+        if error is not None:
+            status = error_status(error)
+            if metrics is not None:
+                metrics.observe(endpoint, elapsed, status or 0, sent, retry=attempt > 0)
+            if status is not None and status != 429 and status < 500:
+                if backoff is not None:
+                    backoff.succeeded() # the API answered, so it is not throttling us
+                raise error # Client errors such as 404 will not go away by retrying
+            if status == 429 and backoff is not None:
+                backoff.throttled()
+            if attempt == retries:
+                raise error
+            time.sleep(random.uniform(0, min(30.0, 0.5 * 2 ** attempt)))
+        else:
+            if metrics is not None:
+                metrics.observe(endpoint, elapsed, None, sent, retry=attempt > 0)
+            if backoff is not None:
+                backoff.succeeded()
+            return result
+
+def post_json(client, path, body):
+    """POST a streamed JSON body (see payloads.JsonStream) with the credentials and settings of a mailchimp3 client"""
+    from mailchimp3.mailchimpclient import _raise_response_error
+    from urllib.parse import urljoin
+    
+    headers = dict(client.request_headers)
+    headers['Content-Type'] = 'application/json'
+    response = client._make_request(method='POST', url=urljoin(client.base_url, path), data=body, auth=client.auth,
+                                    timeout=client.timeout, hooks=client.request_hooks, headers=headers)
+    if response.status_code >= 400:
+        _raise_response_error(response)
+    return response.json()
+
+# Column aliases in increasing priority: when a file has several of them, the last one wins
+name_columns = {
+    'voorvoegsels': ['voorvoegsels', 'prefix', 'voorvoegsel'],
+    'roepnaam': ['roepnaam', 'first name', 'voorletters', 'voornaam'],
+    'achternaam': ['achternaam', 'last name', 'name', 'naam'],
+}
+
+# Email validation based on RFC 5322, but practical for real-world use
+email_pattern = re.compile(r'^[a-zA-Z0-9.!#$%&\'*+/=?^_`{|}~-]+@[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(?:\.[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*$')
+
+def resolve_columns(columns):
+    """Find the columns of a file to read names, prefixes and email addresses from"""
+    lowercase = {}
+    for column in columns:
+        lowercase[str(column).lower()] = column
+    
+    resolved = {}
+    for name, aliases in name_columns.items():
+        found = [lowercase[alias] for alias in aliases if alias in lowercase]
+        resolved[name] = found[-1] if found else None
+    resolved['email'] = next((column for name, column in lowercase.items() if 'email' in name.replace('-', '')), None)
+    return resolved
+
+def clean_column(data, column):
+    """Return a column as stripped strings, with empty and NaN-like values as empty strings"""
+    import pandas as pd
+    if column is None:
+        return pd.Series("", index=data.index, dtype=object)
+    values = data[column].fillna("").astype(str).str.strip()
+    return values.mask(values.str.lower().isin(['nan', 'none', 'null']), "")
+
+def normalise_contacts(data):
+    """Clean and validate all contacts of a file at once.
+    
+    Returns the valid contacts as a DataFrame with the columns roepnaam,
+    achternaam, email and hash (the subscriber hash), plus lists of
+    warnings and errors.
+    """
+    import pandas as pd
+    columns = resolve_columns(data.columns)
+    roepnaam = clean_column(data, columns['roepnaam'])
+    achternaam = clean_column(data, columns['achternaam'])
+    voorvoegsels = clean_column(data, columns['voorvoegsels'])
+    email = clean_column(data, columns['email'])
+    
+    warnings = ['Warning: First name missing for ' + address for address in email[roepnaam == ""]]
+    warnings += ['Warning: Last name missing for ' + address for address in email[achternaam == ""]]
+    
+    # Join prefixes (voorvoegsels) with the last name
+    has_prefix = voorvoegsels != ""
+    achternaam = achternaam.where(~has_prefix, voorvoegsels + " " + achternaam)
+    
+    valid = email.str.lower().str.match(email_pattern)
+    errors = [f"Error: Invalid email address (index = {index})" for index in data.index[~valid.to_numpy()]]
+    
+    contacts = pd.DataFrame({
+        'roepnaam': roepnaam[valid],
+        'achternaam': achternaam[valid],
+        'email': email[valid],
+    })
+    contacts['hash'] = [md5(address.encode('utf-8')).hexdigest() for address in contacts['email'].str.lower()]
+    return contacts, warnings, errors
+
+def is_csv(path):
+    return path.lower().endswith('.csv')
+
+def csv_encoding(path):
+    """UTF-8 (with or without BOM) when the whole file decodes as such, otherwise cp1252 (Excel's ANSI in Dutch locales)"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(path, 'rb') as f:
+        try:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                decoder.decode(block)
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return 'cp1252'
+    return 'utf-8-sig'
+
+def csv_delimiter(path, encoding='utf-8-sig'):
+    """Guess the delimiter of a CSV file from its header line (Excel writes ';' in Dutch locales)"""
+    with open(path, newline='', encoding=encoding) as f:
+        header = f.readline()
+    try:
+        return csv.Sniffer().sniff(header, delimiters=",;\t").delimiter
+    except csv.Error:
+        return ","
+
+def count_rows(path):
+    """Count the contacts in an import file without loading it"""
+    import pandas as pd
+    if is_csv(path):
+        lines = 0
+        last = b"\n"
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                lines += block.count(b"\n")
+                last = block[-1:]
+        if last != b"\n":
+            lines += 1 # no newline after the last row
+        return max(lines - 1, 0)
+    
+    if path.lower().endswith('.xls'):
+        # Old Excel files have no streaming reader
+        return len(pd.read_excel(path))
+    
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True)
+    try:
+        sheet = workbook.active
+        if sheet.max_row is None:
+            # No dimensions in the workbook metadata, count the rows instead
+            sheet.reset_dimensions()
+            return max(sum(1 for row in sheet.iter_rows(values_only=True)) - 1, 0)
+        return max(sheet.max_row - 1, 0)
+    finally:
+        workbook.close()
+
+def drop_empty_rows(chunk):
+    """Leave out rows without any value, such as formatted but empty rows at the end of a sheet"""
+    empty = chunk.isna() | chunk.astype(str).apply(lambda column: column.str.strip() == "")
+    return chunk[~empty.all(axis=1).to_numpy()]
+
+def read_contacts(path, chunk_size=config_chunk_size):
+    """Read an Excel or CSV file in chunks of rows, yielding DataFrames with only the columns we use"""
+    for chunk in read_chunks(path, chunk_size):
+        yield drop_empty_rows(chunk)
+
+def read_chunks(path, chunk_size):
+    """Chunks of rows of an import file as read, see read_contacts()"""
+    import pandas as pd
+    if is_csv(path):
+        encoding = csv_encoding(path)
+        delimiter = csv_delimiter(path, encoding)
+        header = pd.read_csv(path, sep=delimiter, nrows=0, encoding=encoding).columns
+        usecols = [column for column in resolve_columns(header).values() if column is not None]
+        yield from pd.read_csv(path, sep=delimiter, usecols=usecols, dtype=str, chunksize=chunk_size, encoding=encoding)
+        return
+    
+    if path.lower().endswith('.xls'):
+        data = pd.read_excel(path, dtype=str)
+        for start in range(0, len(data), chunk_size):
+            yield data.iloc[start:start + chunk_size]
+        return
+    
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(column) if column is not None else "" for column in header]
+        wanted = set(column for column in resolve_columns(header).values() if column is not None)
+        positions = [position for position, column in enumerate(header) if column in wanted]
+        columns = [header[position] for position in positions]
+        
+        start = 0
+        chunk = []
+        for row in rows:
+            chunk.append([row[position] if position < len(row) else None for position in positions])
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=columns, index=pd.RangeIndex(start, start + len(chunk)))
+                start += len(chunk)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns, index=pd.RangeIndex(start, start + len(chunk)))
+    finally:
+        workbook.close()
+
+def plan_dedup(path, policy, cleaned=None):
+    """Find rows with the same email address (subscriber hash) before any API call.
+    
+    Returns (drop, names): drop maps the index of every row that is left out
+    to the index of the row that is kept, names maps kept rows to the
+    (roepnaam, achternaam) they get. The policy decides which row is kept:
+    'first' or 'last' keeps that row as it is, 'non-empty' keeps the first
+    row and fills in missing names from the other rows. cleaned holds the
+    result of normalise_contacts for every chunk when the file was read already.
+    """
+    drop = {}
+    names = {}
+    if policy == 'off':
+        return drop, names
+    
+    first = {} # subscriber hash -> (index, roepnaam, achternaam) of its first row
+    groups = {} # subscriber hash -> all rows, only for duplicated addresses
+    if cleaned is None:
+        cleaned = (normalise_contacts(chunk) for chunk in read_contacts(path))
+    for contacts, warnings, errors in cleaned:
+        for row in zip(contacts.index, contacts['hash'], contacts['roepnaam'], contacts['achternaam']):
+            md5hash = row[1]
+            if md5hash in first:
+                groups.setdefault(md5hash, [first[md5hash]]).append((row[0], row[2], row[3]))
+            else:
+                first[md5hash] = (row[0], row[2], row[3])
+    
+    for rows in groups.values():
+        kept = rows[-1] if policy == 'last' else rows[0]
+        for row in rows:
+            if row is not kept:
+                drop[row[0]] = kept[0]
+        if policy == 'non-empty':
+            roepnaam = next((row[1] for row in rows if row[1]), "")
+            achternaam = next((row[2] for row in rows if row[2]), "")
+            if (roepnaam, achternaam) != (kept[1], kept[2]):
+                names[kept[0]] = (roepnaam, achternaam)
+    return drop, names
+
+def plan_batches(operations, max_operations=config_batch_size, max_bytes=config_batch_max_bytes):
+    """Split serialized batch operations into chunks limited by operation count and payload size"""
+    chunk = []
+    size = 0
+    for operation in operations:
+        operation_size = len(operation) + 1
+        if chunk and (len(chunk) >= max_operations or size + operation_size > max_bytes):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(operation)
+        size += operation_size
+    if chunk:
+        yield chunk
+
+def journal_operations(operations):
+    """Serialized operations as text, for the checkpoint"""
+    return [operation.decode('utf-8') for operation in operations]
+
+def restore_operations(entries):
+    """Serialized operations from the checkpoint, which holds them as objects when it is from an older version"""
+    return [entry.encode('utf-8') if isinstance(entry, str) else dumps(entry) for entry in entries]
+
+
+subscribe_limit = 500 # members per batch subscribe request, set by Mailchimp
+
+def subscribe_members(operations):
+    """Turn create and update operations into members for the batch subscribe endpoint.
+    
+    The status only applies to new members, so an upsert never resubscribes
+    an existing member.
+    """
+    members = []
+    for operation in operations:
+        member = json.loads(json.loads(operation)['body'])
+        member['status_if_new'] = member.pop('status', 'subscribed')
+        member.pop('tags', None) # set with segment requests once the member exists
+        members.append(member)
+    return members
+
+def subscribe_results(kind, response):
+    """Per-member errors of a batch subscribe response, in the shape of batch operation results"""
+    results = []
+    for error in response.get('errors') or []:
+        details = {'title': error.get('error_code', ''), 'detail': error.get('error', ''), 'errors': []}
+        if error.get('field'):
+            details['errors'].append({'field': error['field'], 'message': error.get('field_message', '')})
+        results.append({
+            'operation_id': f"{kind}_batch:{error.get('email_address', '')}",
+            'status_code': 400,
+            'response': json.dumps(details),
+        })
+    return results
+
+
+segment_limit = 500 # members to add and to remove per segment request, set by Mailchimp
+
+def segment_chunks(operations):
+    """Group segment changes by segment into requests of at most segment_limit members to add and to remove.
+    
+    Returns a dict of segment id -> [(index, changes)].
+    """
+    changes = {}
+    for operation in operations:
+        changes.setdefault(operation['segment'], ([], []))[operation['action'] == 'remove'].append(operation)
+    chunks = {}
+    for segment_id, (added, removed) in changes.items():
+        requests = -(-max(len(added), len(removed)) // segment_limit)
+        chunks[segment_id] = [
+            (index, added[index * segment_limit:(index + 1) * segment_limit] + removed[index * segment_limit:(index + 1) * segment_limit])
+            for index in range(requests)
+        ]
+    return chunks
+
+def segment_request(changes):
+    """Body of a segment request: the email addresses to add and to remove"""
+    return {
+        'members_to_add': [change['email_address'] for change in changes if change['action'] != 'remove'],
+        'members_to_remove': [change['email_address'] for change in changes if change['action'] == 'remove'],
+    }
+
+def segment_results(changes, response):
+    """Failed members of a segment request, in the shape of batch operation results"""
+    actions = {change['email_address'].lower(): change for change in changes}
+    results = []
+    for error in response.get('errors') or []:
+        for email_address in error.get('email_addresses') or []:
+            change = actions.get(email_address.lower(), {'action': 'add', 'name': ''})
+            action = 'remove' if change['action'] == 'remove' else 'add'
+            results.append({
+                'operation_id': f"segment_{action}:{email_address}",
+                'status_code': 400,
+                'response': json.dumps({'title': change['name'], 'detail': error.get('error', ''), 'errors': []}),
+            })
+    return results
+
+
+def member_changed(hit, merge_fields, interests):
+    """Whether sending merge_fields and interests would change an existing member"""
+    current_fields = hit.get('merge_fields') or {}
+    for name, value in merge_fields.items():
+        if (current_fields.get(name) or "") != (value or ""):
+            return True
+    
+    current_interests = hit.get('interests') or {}
+    for interest, value in interests.items():
+        if bool(current_interests.get(interest)) != value:
+            return True
+    return False
+
+# Members a sync archives or unsubscribes, by status
+sync_statuses = {
+    'archive': ('subscribed', 'unsubscribed', 'cleaned', 'pending'),
+    'unsubscribe': ('subscribed',),
+}
+
+def load_targets(path):
+    """Read the target lists of a multi-list run from a JSON file.
+    
+    The file holds a list of objects with a list_id and optionally a
+    contact_type, a category mapping and a segments mapping. Groups that
+    are left out fall back to the CATEGORY_* and SEGMENT_* environment
+    variables.
+    """
+    with open(path, encoding='utf-8') as f:
+        targets = json.load(f)
+    if not isinstance(targets, list) or not targets or not all(target.get('list_id') for target in targets):
+        raise ValueError(f"{path} must contain a list of targets, each with a list_id")
+    return targets
+
+def target_category(target):
+    """Category mapping of a target list, with the groups it does not set taken from the environment"""
+    mapping = target.get('category') or {}
+    return {group: dict(values, **mapping.get(group, {})) for group, values in category.items()}
+
+def target_segments(target):
+    """Segment mapping of a target list, with the groups it does not set taken from the environment"""
+    mapping = target.get('segments') or {}
+    return {group: dict(values, **mapping.get(group, {})) for group, values in segment.items()}
+
+def create_engine(mode=None, targets=None, **kwargs):
+    """Create the threaded engine or, with mode 'async', the asyncio engine.
+    
+    With several targets (see load_targets), returns a MultiListEngine
+    that updates all of them in one pass over the import file.
+    """
+    if targets:
+        return MultiListEngine(targets, mode, **kwargs)
+    if (mode or config_engine) == 'async':
+        from mailchimp_async import AsyncUpdateEngine
+        return AsyncUpdateEngine(**kwargs)
+    return UpdateEngine(**kwargs)
+
+def print_log(message):
+    """Default logger: timestamped lines on stderr, so stdout stays free for results"""
+    timestamp = datetime.now().strftime("%H:%M:%S")
+    print(f"[{timestamp}] {message}", file=sys.stderr, flush=True)
+
+class RunCancelled(Exception):
+    """Raised inside a run after UpdateEngine.cancel() was called"""
+
+class UpdateEngine:
+    """Updates one Mailchimp list from an import file.
+    
+    Messages go to the log callback, progress to progress(value, maximum, text).
+    Both may be called from worker threads.
+    """
+    def __init__(self, contact_type=default_contact_type, debug_mode=debug_mode, update=config_update,
+                 skip_unchanged=config_skip_unchanged, workers=config_workers, list_id=None, mailchimp=None,
+                 log=print_log, progress=None, resume=True, category=category, dedup=config_dedup,
+                 group_mode=config_group_mode, segments=segment, sync=config_sync, sync_max_share=config_sync_max_share,
+                 scheduler=None):
+        self.contact_type = contact_type
+        self.debug_mode = debug_mode
+        self.update = update
+        self.skip_unchanged = skip_unchanged
+        self.workers = workers
+        self.listid = list_id or listid
+        self.category = category
+        self.group_mode = group_mode # interests, or segments to set the groups with bulk segment requests
+        self.segments = segments
+        self.sync = sync # off, or archive or unsubscribe the members of the contact type that are not in the file
+        self.sync_max_share = sync_max_share
+        self.mailchimp = mailchimp # injected client, otherwise created by get_client()
+        self.log_message = log
+        self.progress = progress or (lambda value, maximum, text: None)
+        self.resume = resume # continue an interrupted run of the same file from its checkpoint
+        self.dedup_policy = dedup
+        self.dedup = None # (drop, names) from plan_dedup(), shared when several lists are updated
+        
+        # Data storage
+        self.import_file_path = ""
+        self.aantal_ingeschrevenen = 0 # number of rows in the import file
+        self.overgeslagen = 0 # number of invalid rows skipped
+        self.dubbelen = 0 # number of duplicate rows left out
+        self.fouten = [] # list of errors
+        self.update_batch = [] # updates to be made, serialized operations
+        self.create_batch = [] # new contacts to be created, serialized operations
+        self.segment_batch = [] # segment changes: segment id and name, action (add, remove, or new for new members) and email address
+        self.segment_groups = {} # (group, value) -> id, name and subscriber hashes of the members of its segment
+        self.remove_batch = [] # archive or unsubscribe operations of a sync, serialized
+        self.new_groups = [] # (group, value) pairs a new member is put in, see compile_payloads()
+        self.create_payload = None # PayloadTemplate of the create body
+        self.update_payloads = {} # Taal interest id (None for segments) -> (interests, PayloadTemplate of the update body)
+        self.seen_hashes = set() # subscriber hashes of the contacts in the file, for a sync
+        self.sync_members = 0 # members of the contact type a sync compared the file with
+        self.sync_report = None # path of the list of members a sync removes
+        self.member_index = {} # members already in the list, keyed by subscriber hash
+        self.batches = [] # submitted batch operations
+        self.nieuw_lid = 0
+        self.update_lid = 0
+        self.ongewijzigd = 0 # existing members that already match
+        self.stage_times = {} # wall time in seconds per processing stage
+        self.metrics = Metrics() # API requests, latency, throttling and bytes sent
+        self.throughput = Throughput(defaults={'submit': 5000.0, 'mailchimp': config_batch_rate})
+        self.processed = {} # batch id -> operations Mailchimp has finished
+        self.cancelled = threading.Event()
+        self.checkpoint = None # journal of the run, see checkpoint.py
+        self.shared_chunks = None # (SharedChunks, reader) when the import file is shared with other lists or was read already
+        self.backoff = Backoff() # shared by all requests, Mailchimp throttles the whole account
+        self.scheduler = scheduler or get_scheduler() # slots for the API requests in flight, shared by the whole process
+        self.shared_members = None # member indexes of a JobQueue, fetched once per list
+        self.cache_mark = None # stale reason of the member cache until the writes of this run are applied to it
+        self.failed_operations = set() # operation ids (lowercase) of failed operations, left out of the member cache
+        self.results_unknown = False # results of failed operations that could not be read
+    
+    def cancel(self):
+        """Stop the run at the next chunk, before anything is submitted (safe to call from any thread)"""
+        self.cancelled.set()
+    
+    def share(self, backoff, metrics, members):
+        """Use the backoff, metrics and member indexes of a JobQueue"""
+        self.backoff = backoff
+        self.metrics = metrics
+        self.shared_members = members
+    
+    def prepare(self, dedup, chunks):
+        """Use an import file that was read, cleaned and deduplicated already, as (chunk, cleaned) pairs"""
+        self.dedup = dedup
+        self.shared_chunks = (SharedChunks(None, 1, chunks), 0)
+    
+    def share_sync(self, hashes, planned):
+        """Sync with the subscriber hashes of all files of a JobQueue (None when not every file could be read).
+        
+        planned holds the (list id, contact type) pairs whose removals another
+        engine of the queue plans already; those are not planned twice.
+        """
+        if self.sync == 'off':
+            return
+        if hashes is None:
+            self.log_message(f"Sync skipped: not every file of the queue could be read, so nothing is {self.sync}d")
+            self.sync = 'off'
+            return
+        if (self.listid, self.contact_type) in planned:
+            self.log_message(f"The {self.contact_type}s missing from the files are {self.sync}d by another job")
+            self.sync = 'off'
+            return
+        planned.add((self.listid, self.contact_type))
+        self.seen_hashes.update(hashes)
+    
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise RunCancelled("Processing cancelled")
+    
+    @contextmanager
+    def timed(self, stage):
+        """Add the wall time of the enclosed block to a processing stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + time.perf_counter() - start
+    
+    @property
+    def client(self):
+        if self.mailchimp is None:
+            self.mailchimp = get_client()
+        return self.mailchimp
+    
+    def run(self, import_file_path, aantal=None):
+        """Process an import file and submit the batch operations, returns the summary"""
+        self.import_file_path = import_file_path
+        profile_path = os.path.join(config_report_dir, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+        with profiled(profile_mode, self.log_message, profile_path):
+            with self.timed('count'):
+                self.aantal_ingeschrevenen = aantal if aantal is not None else count_rows(import_file_path)
+            if config_checkpoint_dir and not self.debug_mode:
+                with self.timed('checkpoint'):
+                    self.open_checkpoint()
+            self.process_contacts()
+            with self.timed('submit'):
+                self.submit()
+        if self.checkpoint is not None and not self.batches:
+            self.checkpoint.remove() # nothing to follow up
+        return self.summary()
+    
+    def open_checkpoint(self):
+        """Open the journal of this file and these settings, and report work restored from it"""
+        settings = {
+            'list_id': self.listid,
+            'contact_type': self.contact_type,
+            'update': self.update,
+            'skip_unchanged': self.skip_unchanged,
+            'dedup': self.dedup_policy,
+            'chunk_size': config_chunk_size,
+            'batch_size': config_batch_size,
+            'batch_max_bytes': config_batch_max_bytes,
+            'subscribe_max': config_subscribe_max,
+            'category': self.category,
+            'group_mode': self.group_mode,
+            'segments': self.segments,
+            'sync': self.sync,
+        }
+        self.checkpoint = Checkpoint(config_checkpoint_dir, checkpoint_key(self.import_file_path, settings))
+        if not self.checkpoint.resumed:
+            return
+        if not self.resume:
+            self.log_message(f"Discarding checkpoint {self.checkpoint.path} of an interrupted run")
+            self.checkpoint.remove()
+            self.checkpoint.state = self.checkpoint.load()
+            return
+        state = self.checkpoint.state
+        self.log_message(f"Resuming interrupted run from {self.checkpoint.path}: "
+                         f"{len(state['chunks'])} chunks processed, {len(state['batches'])} batches submitted")
+    
+    def restore_chunks(self):
+        """Take over the operations and counts of the chunks in the checkpoint, returns the number of valid rows"""
+        restored = 0
+        sync = self.checkpoint.state['sync']
+        if sync is not None:
+            self.remove_batch = restore_operations(sync['remove'])
+            self.sync_members = sync['members']
+            self.sync_report = sync['report']
+        for number, chunk in sorted(self.checkpoint.state['chunks'].items()):
+            self.create_batch.extend(restore_operations(chunk['create']))
+            self.update_batch.extend(restore_operations(chunk['update']))
+            self.segment_batch.extend(chunk.get('segment', []))
+            self.seen_hashes.update(chunk.get('hashes', []))
+            self.nieuw_lid += chunk['created']
+            self.update_lid += chunk['updated']
+            self.ongewijzigd += chunk['unchanged']
+            self.overgeslagen += chunk['skipped']
+            self.dubbelen += chunk['duplicates']
+            self.fouten.extend(chunk['errors'])
+            restored += chunk['rows'] - chunk['skipped'] - chunk['duplicates']
+        return restored
+    
+    def chunk_marks(self):
+        return (len(self.create_batch), len(self.update_batch), len(self.segment_batch), self.nieuw_lid, self.update_lid,
+                self.ongewijzigd, self.overgeslagen, self.dubbelen, len(self.fouten))
+    
+    def save_chunk(self, number, rows, marks, hashes=()):
+        """Record the operations and counts a chunk added since marks were taken, and the hashes of its contacts for a sync"""
+        if self.checkpoint is None:
+            return
+        creates, updates, segment_changes, created, updated, unchanged, skipped, duplicates, errors = marks
+        self.checkpoint.record({
+            'type': 'chunk',
+            'number': number,
+            'rows': rows,
+            'hashes': list(hashes),
+            'create': journal_operations(self.create_batch[creates:]),
+            'update': journal_operations(self.update_batch[updates:]),
+            'segment': self.segment_batch[segment_changes:],
+            'created': self.nieuw_lid - created,
+            'updated': self.update_lid - updated,
+            'unchanged': self.ongewijzigd - unchanged,
+            'skipped': self.overgeslagen - skipped,
+            'duplicates': self.dubbelen - duplicates,
+            'errors': self.fouten[errors:],
+        })
+    
+    def process_contacts(self):
+        """Read the import file and build the create and update operations"""
+        aantal = self.aantal_ingeschrevenen
+        mode_text = "DEBUG MODE" if self.debug_mode else "PRODUCTION MODE"
+        self.log_message(f"🚀 Starting to process {aantal} contacts as {self.contact_type}s - {mode_text}")
+        
+        if self.debug_mode:
+            self.log_message("🐛 DEBUG: API writes are DISABLED - only read operations will be performed")
+            self.log_message(f"🐛 DEBUG: Configuration - Update: {self.update}, List ID: {self.listid}")
+            self.log_message(f"🐛 DEBUG: Categories loaded: {len(self.category)} categories available")
+            if self.sync != 'off':
+                self.log_message(f"🐛 DEBUG: Sync would {self.sync} the {self.contact_type}s that are not in the file")
+            if self.group_mode == 'segments':
+                self.log_message("🐛 DEBUG: Groups are set with segment requests instead of interests")
+        
+        # Reset progress
+        self.progress(0, aantal, "Starting...")
+        
+        cnt = 0
+        self.update_lid = 0
+        self.nieuw_lid = 0
+        self.ongewijzigd = 0
+        built = False
+        if self.checkpoint is not None and self.checkpoint.resumed:
+            # Rows processed before the interruption are not looked up again
+            cnt = self.restore_chunks()
+            built = self.checkpoint.state['built']
+            self.progress(cnt + self.overgeslagen + self.dubbelen, aantal, f"Restored {cnt}/{aantal} contacts from the checkpoint")
+        
+        # Find duplicate rows before anything is looked up
+        if not built and self.dedup is None:
+            with self.timed('dedup'):
+                self.dedup = plan_dedup(self.import_file_path, self.dedup_policy)
+            if self.dedup[0]:
+                self.log_message(f"Found {len(self.dedup[0])} duplicate rows, keeping one row per email address ({self.dedup_policy} wins)")
+        
+        # Find out which contacts are already in the list; a sync compares the file with all of them
+        if built or not (config_cache_path or config_prefetch or self.sync != 'off'):
+            # Look up the contacts of each chunk while reading the file
+            self.member_index = None
+        else:
+            with self.timed('prefetch'):
+                if self.shared_members is not None:
+                    # Fetched once for all jobs that update this list
+                    self.member_index = self.shared_members.get(self)
+                else:
+                    self.member_index = self.load_member_index()
+        
+        # The segment changes are the difference between the current and the wanted segment members
+        if self.group_mode == 'segments' and not built:
+            with self.timed('segments'):
+                self.segment_groups = self.load_segments()
+        self.compile_payloads()
+        
+        loop_start = time.perf_counter()
+        contacts = () if built else self.iter_contacts(self.member_index)
+        
+        for contact, hit in contacts:
+            cnt += 1
+            roepnaam = contact.roepnaam
+            achternaam = contact.achternaam
+            email_address = contact.email
+            md5hash = contact.hash
+            
+            # Update progress
+            self.progress(cnt + self.overgeslagen + self.dubbelen, aantal, f"Processing {cnt}/{aantal} - {roepnaam} {achternaam}")
+            
+            # Log current contact
+            if self.debug_mode:
+                self.log_message(f"🐛 DEBUG: Processing contact {cnt}/{aantal}: {roepnaam} {achternaam} ({email_address})")
+
+            # Process contact with Mailchimp
+            if self.debug_mode:
+                self.log_message(f"🐛 DEBUG: Email: {email_address}, MD5 hash: {md5hash}")
+            
+            nieuwe = False
+            
+            if self.debug_mode:
+                self.log_message(f"🐛 DEBUG: Checking if member exists in Mailchimp...")
+            
+            # check if member exists in Mailchimp
+            if hit is not None:
+                if self.debug_mode:
+                    self.log_message(f"🐛 DEBUG: Found existing member - Status: {hit.get('status', 'unknown')}, Name: {hit.get('merge_fields', {}).get('FNAME', '')  } {hit.get('merge_fields', {}).get('LNAME', '')}")
+            else:
+                nieuwe = True
+                if self.debug_mode:
+                    self.log_message(f"🐛 DEBUG: Member not found in list (will be created)")
+            
+            if nieuwe:  # New member
+
+                if self.group_mode == 'segments':
+                    # The create body has the tags of these segments
+                    self.change_segments(email_address, md5hash, self.new_groups, new=True)
+                
+                # fill in the member data for insertion
+                body = self.create_payload.render(email_address=email_address, FNAME=roepnaam, LNAME=achternaam)
+                
+                if self.debug_mode:
+                    self.log_message(f"🐛 DEBUG: Would CREATE new member with data: {body}")
+                    self.log_message(f"🐛 DEBUG: Operation would be POST to /lists/{self.listid}/members/")
+                else:
+                    self.log_message(f"CREATE: {roepnaam} {achternaam} ({email_address})")
+
+                operation_item = {
+                    "method": "POST",
+                    "path": "/lists/" + self.listid + "/members/",
+                    "operation_id": "create_batch:" + email_address,
+                    "body": body
+                }
+                
+                # Serialized once, for the batch sizes and the request body
+                self.create_batch.append(dumps(operation_item))
+                self.nieuw_lid += 1
+                
+            else:  # Existing member
+
+                if not self.update:
+                    if self.debug_mode:
+                        self.log_message(f"🐛 DEBUG: Skipping update for existing member (updates disabled)")
+                    continue
+                
+                if self.debug_mode:
+                    self.log_message(f"🐛 DEBUG: Updating existing member...")
+                
+                # Save names from Excel file
+                original_fname = hit['merge_fields'].get('FNAME', '')
+                original_lname = hit['merge_fields'].get('LNAME', '')
+                
+                # Check if there is a first or last name in the response from Mailchimp
+                # If so, keep the name from Mailchimp
+                if original_lname is not None: 
+                    achternaam = original_lname
+                if original_fname is not None:
+                    roepnaam = original_fname
+                
+                if original_fname != hit['merge_fields'].get('FNAME', '') and original_lname != hit['merge_fields'].get('LNAME', ''):
+                    self.log_message(f"UPDATE: New name for {original_fname} {original_lname}: {roepnaam} {achternaam}")
+                else:
+                    self.log_message(f"UPDATE: Rejected input from Excel: {roepnaam} {achternaam} -> Keeping {original_fname} {original_lname} from Mailchimp")
+                    
+                    
+                if self.group_mode == 'segments':
+                    # Keep the language of the member, and move it to the segment of its type
+                    english = self.segment_groups.get(('Taal', 'English'))
+                    taal = "English" if english is not None and md5hash in english['members'] else "Nederlands"
+                    if self.debug_mode:
+                        self.log_message(f"🐛 DEBUG: Language preference: {taal} (segment)")
+                    self.change_segments(email_address, md5hash, [('Type', self.contact_type), ('Taal', taal)])
+                    taalset = None
+                else:
+                    engels = self.category['Taal']['English']
+                    nederlands = self.category['Taal']['Nederlands']
+                    if isinstance(hit['interests'][engels], bool):
+                        if not hit['interests'][engels]:
+                            taalset = nederlands
+                        else:
+                            taalset = engels
+                    
+                    if self.debug_mode:
+                        current_lang = "English" if taalset == engels else "Nederlands"
+                        self.log_message(f"🐛 DEBUG: Language preference: {current_lang} (ID: {taalset})")
+                    
+                interests, payload = self.update_payloads[taalset]
+                
+                # Only send updates that change something
+                merge_fields = {'FNAME': roepnaam, 'LNAME': achternaam, 'TYPE': self.contact_type}
+                if self.skip_unchanged and not member_changed(hit, merge_fields, interests):
+                    if self.debug_mode:
+                        self.log_message(f"🐛 DEBUG: Skipping update, member is unchanged")
+                    self.ongewijzigd += 1
+                    continue
+                
+                body = payload.render(email_address=email_address, FNAME=roepnaam, LNAME=achternaam)
+                if self.debug_mode:
+                    self.log_message(f"🐛 DEBUG: Would UPDATE existing member with data: {body}")
+                    self.log_message(f"🐛 DEBUG: Operation would be PATCH to /lists/{self.listid}/members/{md5hash}")
+                
+                operation_item = {
+                    "method": "PATCH",
+                    "path": "/lists/" + self.listid + "/members/" + md5hash,
+                    "operation_id": "update_batch:" + email_address,
+                    "body": body
+                }
+                
+                self.update_batch.append(dumps(operation_item))
+                self.update_lid += 1
+            
+            # Update status
+            done = cnt + self.overgeslagen + self.dubbelen
+            self.track_rows(done, aantal)
+            self.progress(done, aantal,
+                f"Processed {cnt}/{aantal} - {self.nieuw_lid} new, {self.update_lid} updates - {self.rate_text('rows')} - Time remaining: {self.eta_text()}"
+            )
+        
+        # Time spent building operations is what the loop took besides reading, cleaning and lookups
+        loop_time = time.perf_counter() - loop_start
+        self.stage_times['build'] = loop_time - sum(self.stage_times.get(stage, 0.0) for stage in ('read', 'clean', 'lookup'))
+        if self.sync != 'off' and not built:
+            with self.timed('sync'):
+                self.plan_removals()
+        if self.checkpoint is not None and not built:
+            self.checkpoint.record({'type': 'built'})
+        self.track_rows(aantal, aantal)
+        
+        if self.ongewijzigd:
+            self.log_message(f"Skipped {self.ongewijzigd} existing members that are unchanged")
+        for name, counts in self.segment_counts().items():
+            self.log_message(f"Segment {name}: {counts['added']} members to add, {counts['removed']} to remove")
+        
+        # Show errors if any
+        if self.fouten:
+            self.log_message("\n--- Errors and Warnings ---")
+            for fout in self.fouten:
+                self.log_message(fout)
+    
+    def compile_payloads(self):
+        """Compile the create and update bodies of the run from the category configuration and the contact type"""
+        merge_fields = {'FNAME': field('FNAME'), 'LNAME': field('LNAME'), 'TYPE': self.contact_type}
+        create = {'email_address': field('email_address'), 'status': 'subscribed', 'merge_fields': merge_fields}
+        update = {'email_address': field('email_address'), 'merge_fields': merge_fields}
+        self.new_groups = [('Type', self.contact_type), ('Kind of email', 'Weekly'), ('Taal', 'Nederlands')]
+        if self.group_mode == 'segments':
+            # Tags can be given when the member is created
+            create['tags'] = [self.segment_groups[value]['name'] for value in self.new_groups if value in self.segment_groups]
+            self.update_payloads = {None: ({}, PayloadTemplate(update))}
+        else:
+            create['interests'] = {self.category[group][value]: True for group, value in self.new_groups}
+            # The update keeps the language of the member
+            self.update_payloads = {}
+            for taal in ('Nederlands', 'English'):
+                taalset = self.category['Taal'][taal]
+                interests = {self.category['Type'][self.contact_type]: True, taalset: True}
+                self.update_payloads[taalset] = (interests, PayloadTemplate(dict(update, interests=interests)))
+        self.create_payload = PayloadTemplate(create)
+    
+    def submit(self):
+        """Submit the batch operations, or only summarise them in debug mode"""
+        self.check_cancelled()
+        if self.debug_mode:
+            # In debug mode, don't actually execute API writes
+            self.log_message("🐛 DEBUG: ========== BATCH OPERATIONS SUMMARY ==========")
+            if self.nieuw_lid > 0:
+                self.log_message(f"🐛 DEBUG: Would create {self.nieuw_lid} new members")
+                self.log_message(f"🐛 DEBUG: Create batch contains {len(self.create_batch)} operations")
+            if self.update_lid > 0:
+                self.log_message(f"🐛 DEBUG: Would update {self.update_lid} existing members")
+                self.log_message(f"🐛 DEBUG: Update batch contains {len(self.update_batch)} operations")
+            if self.use_batch_subscribe():
+                self.log_message(f"🐛 DEBUG: Operations would be sent with batch subscribe (POST /lists/{self.listid})")
+            if self.segment_batch:
+                requests = sum(len(chunks) for chunks in segment_chunks(self.segment_operations()).values())
+                self.log_message(f"🐛 DEBUG: Would send {len(self.segment_operations())} segment changes in {requests} requests")
+            if self.sync != 'off':
+                self.log_message(f"🐛 DEBUG: Would {self.sync} {len(self.remove_batch)} of {self.sync_members} {self.contact_type}s (listed in {self.sync_report})")
+                self.check_removals()
+            self.log_message("🐛 DEBUG: NO API WRITES PERFORMED (Debug mode enabled)")
+            self.log_message("🐛 DEBUG: ===============================================")
+        else:
+            # Nothing is written when the sync would remove too many members
+            self.check_removals()
+            self.mark_member_cache()
+            
+            # Normal operation - small runs are upserted right away, large runs go through /batches
+            submit = self.subscribe_batches if self.use_batch_subscribe() else self.submit_batches
+            if self.nieuw_lid > 0:
+                self.log_message(f"Creating batch operations for {self.nieuw_lid} new members...")
+                submit('create', self.create_batch)
+            
+            if self.update_lid > 0:
+                self.log_message(f"Creating batch operations for {self.update_lid} member updates...")
+                submit('update', self.update_batch)
+            
+            # After the creates, segments only take members that are in the list
+            if self.segment_operations():
+                self.segment_batches(self.segment_operations())
+            
+            if self.remove_batch:
+                self.log_message(f"Creating batch operations to {self.sync} {len(self.remove_batch)} members that are not in the file...")
+                self.submit_batches(self.sync, self.remove_batch)
+        
+        completion_message = "\nProcessing completed!"
+        if self.debug_mode:
+            completion_message += " (DEBUG MODE - No changes made to Mailchimp)"
+        elif self.use_batch_subscribe():
+            completion_message += "\nMailchimp processed all operations (batch subscribe)."
+        else:
+            completion_message += "\nLarge batches may take some time to process on Mailchimp's end."
+        self.log_message(completion_message)
+    
+    def close(self):
+        """Release resources held by the engine; the threaded engine has none"""
+    
+    def use_batch_subscribe(self):
+        """Whether the run is small enough for the batch subscribe endpoint, which returns its results at once"""
+        return 0 < len(self.create_batch) + len(self.update_batch) <= config_subscribe_max
+    
+    def plan_removals(self):
+        """Queue archive or unsubscribe operations for the members of the contact type that are not in the file,
+        and list them in a report"""
+        statuses = sync_statuses[self.sync]
+        self.remove_batch = []
+        if self.group_mode == 'segments':
+            group = self.segment_groups.get(('Type', self.contact_type))
+            if group is None:
+                raise ValueError(f"A sync needs the segment of {self.contact_type}s (SEGMENT_TYPE_{self.contact_type.upper()})")
+            members = [md5hash for md5hash in group['members']
+                       if md5hash in self.member_index and self.member_index.get(md5hash)['status'] in statuses]
+            stale = [md5hash for md5hash in members if md5hash not in self.seen_hashes]
+        else:
+            interest = self.category['Type'][self.contact_type]
+            if not interest:
+                raise ValueError(f"A sync needs the interest of {self.contact_type}s (CATEGORY_TYPE_{self.contact_type.upper()})")
+            members = self.member_index.select(interest, statuses)
+            stale = self.member_index.select(interest, statuses, exclude=self.seen_hashes)
+        self.sync_members = len(members)
+        
+        # Named after the list and contact type too, the jobs of a queue plan their removals at the same time
+        report_name = f"sync_{self.sync}_{self.listid}_{self.contact_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        report_path = os.path.join(config_report_dir, report_name)
+        with open(report_path, 'w', newline='', encoding='utf-8') as report:
+            writer = csv.writer(report)
+            writer.writerow(['action', 'email_address', 'FNAME', 'LNAME', 'status'])
+            for md5hash in stale:
+                member = self.member_index.get(md5hash)
+                writer.writerow([self.sync, member['email_address'], member['merge_fields'].get('FNAME', ''),
+                                 member['merge_fields'].get('LNAME', ''), member['status']])
+                if self.sync == 'archive':
+                    operation_item = {
+                        "method": "DELETE",
+                        "path": "/lists/" + self.listid + "/members/" + md5hash,
+                        "operation_id": "archive_batch:" + member['email_address'],
+                    }
+                else:
+                    operation_item = {
+                        "method": "PATCH",
+                        "path": "/lists/" + self.listid + "/members/" + md5hash,
+                        "operation_id": "unsubscribe_batch:" + member['email_address'],
+                        "body": json.dumps({'status': 'unsubscribed'}),
+                    }
+                self.remove_batch.append(dumps(operation_item))
+        self.sync_report = report_path
+        self.log_message(f"Sync: {len(stale)} of {len(members)} {self.contact_type}s are not in the file and will be "
+                         f"{self.sync}d, listed in {report_path}")
+        if self.checkpoint is not None:
+            self.checkpoint.record({'type': 'sync', 'remove': journal_operations(self.remove_batch), 'members': len(members), 'report': report_path})
+    
+    def check_removals(self):
+        """Stop the run when the sync would remove a larger share of the contact type than allowed"""
+        if self.sync == 'off' or not self.remove_batch:
+            return
+        share = len(self.remove_batch) / max(self.sync_members, 1)
+        if share <= self.sync_max_share:
+            return
+        message = (f"The sync would {self.sync} {len(self.remove_batch)} of {self.sync_members} {self.contact_type}s ({share:.0%}), "
+                   f"more than CONFIG_SYNC_MAX_SHARE ({self.sync_max_share:.0%})")
+        if self.debug_mode:
+            self.log_message(f"🐛 DEBUG: {message} - a real run would stop here")
+            return
+        raise ValueError(f"{message}. Nothing was submitted; check the file and {self.sync_report}")
+    
+    def segment_operations(self):
+        """Segment changes to send; members created through /batches get their tags in the create operation"""
+        if self.use_batch_subscribe():
+            return self.segment_batch
+        return [change for change in self.segment_batch if change['action'] != 'new']
+    
+    def segment_counts(self):
+        """Members to add to and to remove from each segment"""
+        counts = {}
+        for change in self.segment_batch:
+            segment_counts = counts.setdefault(change['name'], {'added': 0, 'removed': 0})
+            segment_counts['removed' if change['action'] == 'remove' else 'added'] += 1
+        return counts
+    
+    def change_segments(self, email_address, md5hash, values, new=False):
+        """Queue the changes that put a contact in the segments of values, (group, value) pairs, and take it out
+        of the segments of the other types. Returns the names of the segments of values."""
+        names = []
+        wanted_ids = set()
+        for group, value in values:
+            wanted = self.segment_groups.get((group, value))
+            if wanted is None:
+                continue # no segment configured for this value
+            names.append(wanted['name'])
+            wanted_ids.add(wanted['id'])
+            if new or md5hash not in wanted['members']:
+                self.segment_batch.append({'segment': wanted['id'], 'name': wanted['name'], 'action': 'new' if new else 'add',
+                                           'email_address': email_address})
+        if not new:
+            # A contact has one type, like the TYPE merge field
+            for (group, value), current in self.segment_groups.items():
+                if group == 'Type' and current['id'] not in wanted_ids and md5hash in current['members']:
+                    self.segment_batch.append({'segment': current['id'], 'name': current['name'], 'action': 'remove',
+                                               'email_address': email_address})
+        return names
+    
+    def track_rows(self, done, aantal):
+        """Measure the row rate and expect the operations of the whole file from those built so far"""
+        self.throughput.update('rows', done, aantal)
+        if not self.debug_mode:
+            operations = len(self.create_batch) + len(self.update_batch)
+            expected = operations if done >= aantal else operations * aantal / max(done, 1)
+            self.throughput.expect('submit', expected)
+            # Batch subscribe requests have finished when they return
+            self.throughput.expect('mailchimp', expected if expected > config_subscribe_max else 0)
+    
+    def rate_text(self, stage, unit='rows'):
+        rate = self.throughput.rate(stage)
+        return f"{rate:.0f} {unit}/s" if rate else f"? {unit}/s"
+    
+    def eta_text(self):
+        """Estimated time until Mailchimp has processed everything"""
+        return format_duration(self.throughput.eta())
+    
+    def batch_checked(self, batch, check):
+        self.processed[batch['id']] = check.get('finished_operations', 0)
+    
+    def report_processing(self):
+        """Measure how fast Mailchimp processes the operations and report it as progress"""
+        total = sum(batch['operations'] for batch in self.batches)
+        done = sum(batch['operations'] if 'failed' in batch else self.processed.get(batch['id'], 0) for batch in self.batches)
+        self.throughput.update('mailchimp', done, total)
+        self.progress(done, total,
+            f"Mailchimp processed {done}/{total} operations - {self.rate_text('mailchimp', 'operations')} - Time remaining: {self.eta_text()}"
+        )
+    
+    def pending_chunks(self, kind, operations, subscribe=False):
+        """Split operations into batches (or batch subscribe requests), leaving out those accepted before an interruption"""
+        if subscribe:
+            chunks = [(index, operations[start:start + subscribe_limit])
+                      for index, start in enumerate(range(0, len(operations), subscribe_limit))]
+        else:
+            chunks = list(enumerate(plan_batches(operations)))
+        return self.pending(f"subscribe-{kind}" if subscribe else kind, kind, chunks)
+    
+    def pending(self, journal_kind, kind, chunks):
+        """Leave out the chunks the checkpoint records under journal_kind, restoring their batches"""
+        if self.checkpoint is None:
+            return chunks
+        
+        pending = []
+        for index, chunk in chunks:
+            entry = self.checkpoint.state['batches'].get((journal_kind, index))
+            if entry is None:
+                pending.append((index, chunk))
+                continue
+            batch = {'id': entry['id'], 'kind': kind, 'operations': entry['operations'], 'list_id': self.listid}
+            if 'check' in entry:
+                batch['check'] = entry['check']
+                batch['results'] = entry['results']
+                self.processed[batch['id']] = entry['operations']
+            outcome = self.checkpoint.state['outcomes'].get(entry['id'])
+            if outcome is not None:
+                batch['failed'] = outcome['failed']
+                self.results_unknown |= outcome['failed'] > 0 # reported before the interruption
+            self.batches.append(batch)
+            self.log_message(f"Batch operation ID ({kind}, {batch['operations']} operations): {batch['id']} (submitted before the interruption)")
+        return pending
+    
+    def batch_submitted(self, kind, index, chunk, handle):
+        """Remember an accepted batch, in the checkpoint too so it is never submitted twice"""
+        batch = {'id': handle['id'], 'kind': kind, 'operations': len(chunk), 'list_id': self.listid}
+        self.batches.append(batch)
+        if self.checkpoint is not None:
+            self.checkpoint.record({'type': 'batch', 'kind': kind, 'index': index, 'id': batch['id'], 'operations': len(chunk)})
+        self.log_message(f"Batch operation ID ({kind}, {batch['operations']} operations): {batch['id']}")
+        self.report_submitted()
+    
+    def inline_batch(self, batch_id, kind, journal_kind, index, chunk, results):
+        """Remember a request that returned its results at once as a finished batch, in the checkpoint too"""
+        check = {
+            'status': 'finished',
+            'total_operations': len(chunk),
+            'finished_operations': len(chunk),
+            'errored_operations': len(results),
+        }
+        batch = {'id': batch_id, 'kind': kind, 'operations': len(chunk), 'list_id': self.listid, 'check': check, 'results': results}
+        self.batches.append(batch)
+        self.processed[batch['id']] = len(chunk)
+        if self.checkpoint is not None:
+            self.checkpoint.record({'type': 'batch', 'kind': journal_kind, 'index': index, 'id': batch['id'],
+                                    'operations': len(chunk), 'check': check, 'results': results})
+    
+    def batch_subscribed(self, kind, index, chunk, response):
+        """Remember a batch subscribe request with its results, which are complete when it returns"""
+        results = subscribe_results(kind, response)
+        self.inline_batch(f"subscribe:{self.listid}:{kind}:{index}", kind, f"subscribe-{kind}", index, chunk, results)
+        self.log_message(f"Batch subscribe ({kind}, {len(chunk)} members): {response.get('total_created', 0)} created, "
+                         f"{response.get('total_updated', 0)} updated, {len(results)} failed")
+        self.report_submitted()
+    
+    def segment_updated(self, segment_id, index, chunk, response):
+        """Remember a segment request with its results, which are complete when it returns"""
+        results = segment_results(chunk, response)
+        self.inline_batch(f"segment:{self.listid}:{segment_id}:{index}", 'segment', f"segment-{segment_id}", index, chunk, results)
+        self.log_message(f"Segment {chunk[0]['name']} ({len(chunk)} changes): {response.get('total_added', 0)} added, "
+                         f"{response.get('total_removed', 0)} removed, {len(results)} failed")
+        self.report_submitted()
+    
+    def report_submitted(self):
+        """Measure the submit rate and report the operations submitted so far as progress"""
+        submitted = sum(batch['operations'] for batch in self.batches)
+        total = len(self.create_batch) + len(self.update_batch) + len(self.segment_operations()) + len(self.remove_batch)
+        self.throughput.update('submit', submitted, total)
+        self.progress(submitted, total,
+            f"Submitted {submitted}/{total} operations - {self.rate_text('submit', 'operations')} - Time remaining: {self.eta_text()}"
+        )
+    
+    def subscribe_finished(self, report, batch):
+        """Write the failed members of a batch subscribe request to the report"""
+        succeeded, failed = report.add_batch(batch['id'], self.collect_failed(batch.pop('results', [])))
+        self.log_message(f"Batch {batch['id']} ({batch['kind']}) finished: {batch['operations'] - failed} succeeded, {failed} failed")
+        self.batch_finished(batch, batch['check'], failed)
+    
+    def batch_finished(self, batch, check, failed):
+        """Remember that a batch finished and its failed operations were reported"""
+        batch['failed'] = failed
+        if self.checkpoint is not None:
+            self.checkpoint.record({'type': 'outcome', 'id': batch['id'], 'total': check.get('total_operations', 0), 'failed': failed})
+    
+    def summary(self):
+        """Counts and batch ids of the run, suitable for JSON output"""
+        return {
+            'file': self.import_file_path,
+            'list_id': self.listid,
+            'contact_type': self.contact_type,
+            'dry_run': self.debug_mode,
+            'rows': self.aantal_ingeschrevenen,
+            'skipped': self.overgeslagen,
+            'duplicates': self.dubbelen,
+            'created': self.nieuw_lid,
+            'updated': self.update_lid,
+            'unchanged': self.ongewijzigd,
+            'segments': self.segment_counts(),
+            'removed': len(self.remove_batch),
+            'sync_report': self.sync_report,
+            'warnings': sum(1 for fout in self.fouten if fout.startswith('Warning')),
+            'batches': self.batches,
+            'stage_times': {stage: round(seconds, 3) for stage, seconds in self.stage_times.items()},
+            'api': self.metrics.snapshot(),
+        }
+    
+    def metrics_report(self):
+        """Stage times and API metrics of the run so far"""
+        return {
+            'list_id': self.listid,
+            'file': self.import_file_path,
+            'rows': self.aantal_ingeschrevenen,
+            'stage_times': {stage: round(seconds, 3) for stage, seconds in self.stage_times.items()},
+            'api': self.metrics.snapshot(),
+            'scheduler': self.scheduler.stats(),
+        }
+    
+    def export_metrics(self, path=None):
+        """Write the metrics report to path or CONFIG_METRICS_FILE, returns the path written or None"""
+        path = path or config_metrics_file
+        if not path:
+            return None
+        write_report(self.metrics_report(), path)
+        return path
+    
+    def iter_contacts(self, member_index):
+        """Read, clean and look up the contacts chunk by chunk, yielding (contact, member) pairs.
+        
+        The member is None for contacts that are not in the list yet. Without
+        a member index, the contacts of each chunk are looked up one by one.
+        """
+        if self.shared_chunks is not None:
+            shared, reader = self.shared_chunks
+            chunks = shared.iterate(reader)
+        else:
+            chunks = ((chunk, None) for chunk in read_contacts(self.import_file_path))
+        done = self.checkpoint.state['chunks'] if self.checkpoint is not None else {}
+        number = -1
+        while True:
+            self.check_cancelled()
+            with self.timed('read'):
+                chunk, cleaned = next(chunks, (None, None))
+            if chunk is None:
+                break
+            number += 1
+            if number in done:
+                continue # restored from the checkpoint
+            
+            marks = self.chunk_marks()
+            if cleaned is None:
+                with self.timed('clean'):
+                    cleaned = normalise_contacts(chunk)
+            contacts, warnings, errors = cleaned
+            self.fouten.extend(warnings)
+            self.fouten.extend(errors)
+            self.overgeslagen += len(errors)
+            if self.debug_mode and errors:
+                self.log_message(f"🐛 DEBUG: Skipped {len(errors)} invalid contacts")
+            contacts = self.drop_duplicates(contacts)
+            hashes = contacts['hash'].tolist() if self.sync != 'off' else []
+            self.seen_hashes.update(hashes)
+            
+            if member_index is not None:
+                hits = member_index
+            else:
+                with self.timed('lookup'):
+                    hits = self.lookup_members(contacts['hash'].tolist())
+            for contact in contacts.itertuples(index=False, name='Contact'):
+                yield contact, hits.get(contact.hash)
+            # Only reached once every contact of the chunk has been processed
+            self.save_chunk(number, len(chunk), marks, hashes)
+    
+    def drop_duplicates(self, contacts):
+        """Leave out the duplicate rows of a chunk and apply the merged names of the rows that are kept"""
+        drop, names = self.dedup or ({}, {})
+        if not drop:
+            return contacts
+        duplicate = contacts.index.map(drop.__contains__).to_numpy(dtype=bool)
+        for index, email in zip(contacts.index[duplicate], contacts['email'][duplicate]):
+            self.fouten.append(f"Warning: Duplicate email address {email} (index = {index}), using index {drop[index]}")
+        self.dubbelen += int(duplicate.sum())
+        contacts = contacts[~duplicate]
+        
+        merged = [index for index in contacts.index if index in names]
+        if merged:
+            contacts = contacts.copy()
+            for index in merged:
+                contacts.loc[index, ['roepnaam', 'achternaam']] = names[index]
+        return contacts
+    
+    def load_member_index(self):
+        """Fetch the members of the list, through the member cache when it is enabled"""
+        if config_cache_path:
+            # Only fetch the members that changed since the previous run
+            return self.sync_member_cache()
+        # Fetch the current list membership once instead of one GET per contact
+        index = self.prefetch_members()
+        # Archived contacts are updated like a lookup finds them, a create of their address is rejected
+        return self.prefetch_members(index=index, status='archived')
+    
+    def new_member_index(self):
+        """Compact index for the members of the list, tracking the interests of the category mapping"""
+        from member_index import MemberIndex
+        return MemberIndex(
+            interest for group in self.category.values() for key, interest in group.items() if key not in ('name', 'id')
+        )
+    
+    def prefetch_members(self, since_last_changed=None, index=None, status=None):
+        """Page through the whole list once and index the members by subscriber hash.
+        
+        Archived members are left out by the API unless status is 'archived'.
+        """
+        fields = ",".join("members." + field for field in member_fields.split(",")) + ",total_items"
+        filters = {'since_last_changed': since_last_changed} if since_last_changed else {}
+        if status:
+            filters['status'] = status
+        if index is None:
+            index = self.new_member_index()
+        offset = 0
+        total = None
+        requests_made = 0
+        
+        self.log_message(f"Fetching current list members ({config_paginate} per request)...")
+        while total is None or offset < total:
+            page = call_api(self.client.lists.members.all, list_id=self.listid, count=config_paginate, offset=offset, fields=fields,
+                            metrics=self.metrics, scheduler=self.scheduler, endpoint='lists.members.all', **filters)
+            requests_made += 1
+            total = page.get('total_items', 0)
+            members = page.get('members', [])
+            if not members:
+                break
+            
+            for member in members:
+                md5hash = md5(member['email_address'].lower().encode('utf-8')).hexdigest()
+                index[md5hash] = member
+            offset += len(members)
+            
+            self.progress(offset, total, f"Fetching list members {offset}/{total}")
+        
+        self.log_message(f"Fetched {len(index)} list members in {requests_made} requests")
+        return index
+    
+    def sync_member_cache(self):
+        """Bring the local member cache up to date and return its members"""
+        cache = MemberCache(config_cache_path)
+        try:
+            # Take the timestamp before fetching, so changes made during the sync are fetched next time.
+            # since_last_changed has whole seconds, so go back one to also get changes in the same second
+            synced_at = (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat(timespec='seconds')
+            since = cache.last_sync(self.listid)
+            if since and config_cache_webhooks:
+                stale = cache.stale_reasons(self.listid)
+                age = datetime.now(timezone.utc) - datetime.fromisoformat(since)
+                if not stale and age < timedelta(hours=config_cache_max_age):
+                    # The webhook receiver has applied every change since the last sync
+                    index = cache.load(self.listid, self.new_member_index())
+                    self.log_message(f"Member cache is kept current by webhooks, not fetching changes ({len(index)} members)")
+                    return index
+                # Webhooks that failed or were not received, and changes they never report
+                self.log_message(f"Member cache may miss changes ({', '.join(stale) or 'last sync older than CONFIG_CACHE_MAX_AGE'})")
+            if since:
+                self.log_message(f"Member cache last synced at {since}, fetching changes only")
+            else:
+                self.log_message(f"Member cache {config_cache_path} is empty, fetching the whole list")
+            
+            # Store the changed members page by page, then load the list into a compact index
+            changed = cache.writer(self.listid)
+            self.prefetch_members(since_last_changed=since, index=changed)
+            # The filter leaves out archived members, also those archived by a sync of this updater. They are
+            # kept with their status: a sync leaves them alone, and they are updated instead of created
+            archived = cache.writer(self.listid)
+            self.prefetch_members(since_last_changed=since, index=archived, status='archived')
+            archived.flush()
+            changed.flush(synced_at=synced_at)
+            index = cache.load(self.listid, self.new_member_index())
+            self.log_message(f"Member cache holds {len(index)} members ({len(changed)} changed, {len(archived)} archived)")
+            return index
+        finally:
+            cache.close()
+    
+    def load_segments(self):
+        """Find (or create) the segments of the segment mapping and fetch their members, keyed by (group, value)"""
+        existing = self.static_segments()
+        by_name = {found['name']: found for found in existing}
+        by_id = {str(found['id']): found for found in existing}
+        members = {} # segment id -> subscriber hashes, for segments used by several values
+        groups = {}
+        for group, values in self.segments.items():
+            for value, setting in values.items():
+                if not setting:
+                    continue
+                found = by_id.get(str(setting)) or by_name.get(setting)
+                if found is None:
+                    if str(setting).isdigit():
+                        raise ValueError(f"Static segment {setting} of {group} {value} not found in list {self.listid}")
+                    if self.debug_mode:
+                        self.log_message(f"🐛 DEBUG: Would create tag {setting}")
+                        found = {'id': None, 'name': setting}
+                    else:
+                        found = self.create_segment(setting)
+                        self.log_message(f"Created tag {found['name']} (segment {found['id']})")
+                    by_name[setting] = found
+                    members[found['id']] = set() # new, so without members
+                if found['id'] not in members:
+                    members[found['id']] = self.segment_members(found['id'])
+                groups[(group, value)] = {'id': found['id'], 'name': found['name'], 'members': members[found['id']]}
+        self.log_message("Segments: " + (", ".join(f"{group['name']} ({len(group['members'])} members)" for group in groups.values()) or "none configured"))
+        return groups
+    
+    def static_segments(self):
+        """Static segments and tags of the list, with their id and name"""
+        response = call_api(self.client.lists.segments.all, list_id=self.listid, get_all=True, type='static', fields='segments.id,segments.name',
+                            backoff=self.backoff, metrics=self.metrics, scheduler=self.scheduler, endpoint='lists.segments.all')
+        return response.get('segments', [])
+    
+    def create_segment(self, name):
+        """Create an empty static segment, which is a tag, returns its id and name"""
+        return call_api(self.client.lists.segments.create, list_id=self.listid, data={'name': name, 'static_segment': []},
+                        backoff=self.backoff, metrics=self.metrics, scheduler=self.scheduler, priority=WRITE, endpoint='lists.segments.create')
+    
+    def segment_members(self, segment_id):
+        """Subscriber hashes of the members of a static segment"""
+        hashes = set()
+        offset = 0
+        total = None
+        while total is None or offset < total:
+            page = call_api(self.client.lists.segments.members.all, list_id=self.listid, segment_id=segment_id, count=config_paginate,
+                            offset=offset, fields='members.email_address,total_items', backoff=self.backoff,
+                            metrics=self.metrics, scheduler=self.scheduler, endpoint='lists.segments.members.all')
+            total = page.get('total_items', 0)
+            members = page.get('members', [])
+            if not members:
+                break
+            hashes.update(md5(member['email_address'].lower().encode('utf-8')).hexdigest() for member in members)
+            offset += len(members)
+            self.progress(offset, total, f"Fetching segment members {offset}/{total}")
+        return hashes
+    
+    def segment_batches(self, operations):
+        """Add and remove segment members in bulk, concurrently, and keep the results of every request"""
+        chunks = [
+            (segment_id, index, chunk)
+            for segment_id, segment_requests in segment_chunks(operations).items()
+            for index, chunk in self.pending(f"segment-{segment_id}", 'segment', segment_requests)
+        ]
+        if not chunks:
+            return
+        backoff = self.backoff
+        self.log_message(f"Sending {sum(len(chunk) for segment_id, index, chunk in chunks)} segment changes in {len(chunks)} requests...")
+        
+        def update(segment_id, chunk):
+            data = segment_request(chunk)
+            return call_api(self.client.lists.segments.update_members, list_id=self.listid, segment_id=segment_id, data=data, backoff=backoff,
+                            metrics=self.metrics, scheduler=self.scheduler, priority=WRITE,
+                            endpoint='lists.segments.update_members', sent=len(json.dumps(data)))
+        
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(chunks))) as pool:
+            futures = [pool.submit(update, segment_id, chunk) for segment_id, index, chunk in chunks]
+            for (segment_id, index, chunk), future in zip(chunks, futures):
+                try:
+                    response = future.result()
+                except Exception as e:
+                    # Keep the results of the requests that succeeded before reporting the failure
+                    errors.append(e)
+                    continue
+                self.segment_updated(segment_id, index, chunk, response)
+        
+        if errors:
+            raise errors[0]
+    
+    def lookup_members(self, hashes):
+        """Look up members one by one with a bounded pool of workers, keeping the input order"""
+        backoff = self.backoff
+        aantal = len(hashes)
+        done = [0]
+        lock = threading.Lock()
+        
+        def lookup(md5hash):
+            try:
+                hit = call_api(self.client.lists.members.get, list_id=self.listid, subscriber_hash=md5hash, fields=member_fields,
+                               backoff=backoff, metrics=self.metrics, scheduler=self.scheduler, endpoint='lists.members.get')
+            except Exception as e:
+                if error_status(e) != 404:
+                    raise
+                hit = None
+            with lock:
+                done[0] += 1
+                cnt = done[0]
+            self.progress(cnt, aantal, f"Looking up members {cnt}/{aantal} - Time remaining: {self.eta_text()}")
+            return hit
+        
+        self.log_message(f"Looking up {aantal} contacts with {self.workers} workers...")
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            hits = list(pool.map(lookup, hashes))
+        
+        index = {md5hash: hit for md5hash, hit in zip(hashes, hits) if hit is not None}
+        self.log_message(f"Found {len(index)} of {aantal} contacts in the list")
+        return index
+    
+    def subscribe_batches(self, kind, operations):
+        """Upsert operations with the batch subscribe endpoint, concurrently, and keep the results of every request"""
+        chunks = self.pending_chunks(kind, operations, subscribe=True)
+        if not chunks:
+            return
+        backoff = self.backoff
+        self.log_message(f"Sending {sum(len(chunk) for index, chunk in chunks)} operations with batch subscribe ({subscribe_limit} members per request)...")
+        
+        def subscribe(chunk):
+            data = {"members": subscribe_members(chunk), "update_existing": True}
+            return call_api(self.client.lists.update_members, list_id=self.listid, data=data, backoff=backoff,
+                            metrics=self.metrics, scheduler=self.scheduler, priority=WRITE,
+                            endpoint='lists.batch_subscribe', sent=len(json.dumps(data)))
+        
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(chunks))) as pool:
+            futures = [pool.submit(subscribe, chunk) for index, chunk in chunks]
+            for (index, chunk), future in zip(chunks, futures):
+                try:
+                    response = future.result()
+                except Exception as e:
+                    # Keep the results of the requests that succeeded before reporting the failure
+                    errors.append(e)
+                    continue
+                self.batch_subscribed(kind, index, chunk, response)
+        
+        if errors:
+            raise errors[0]
+    
+    def submit_batches(self, kind, operations):
+        """Submit operations in chunks, concurrently, and remember every batch id"""
+        chunks = self.pending_chunks(kind, operations)
+        if not chunks:
+            return
+        backoff = self.backoff
+        
+        def submit(chunk):
+            # Joined while it is sent, instead of as one string next to the operations
+            body = JsonStream("operations", chunk)
+            return call_api(post_json, self.client, "batches", body, backoff=backoff,
+                            metrics=self.metrics, scheduler=self.scheduler, priority=WRITE,
+                            endpoint='batches.create', sent=len(body))
+        
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(chunks))) as pool:
+            futures = [pool.submit(submit, chunk) for index, chunk in chunks]
+            for (index, chunk), future in zip(chunks, futures):
+                try:
+                    handle = future.result()
+                except Exception as e:
+                    # Keep the ids of the chunks that were accepted before reporting the failure
+                    errors.append(e)
+                    continue
+                self.batch_submitted(kind, index, chunk, handle)
+        
+        if errors:
+            raise errors[0]
+    
+    def new_error_report(self):
+        """Create the report that failed operations of this run are written to"""
+        report_name = f"failed_operations_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{config_report_format}"
+        return ErrorReport(os.path.join(config_report_dir, report_name))
+    
+    def poll_batches(self, report, batches=None, interval=None):
+        """Poll batch status with exponential backoff until all batches have finished, and report failed operations"""
+        if batches is None:
+            # Batches that finished before an interruption were reported then
+            batches = [batch for batch in self.batches if 'failed' not in batch]
+        with self.timed('poll'):
+            # Batch subscribe requests returned their results already
+            for batch in batches:
+                if 'check' in batch:
+                    self.subscribe_finished(report, batch)
+            batches = [batch for batch in batches if 'check' not in batch]
+            self._poll_batches(report, batches, interval or config_poll_interval)
+        if all('failed' in batch for batch in self.batches):
+            self.update_member_cache()
+            if self.checkpoint is not None:
+                self.checkpoint.remove() # the run is complete
+    
+    def release_checkpoint(self):
+        """Remove the journal when the batches are left to Mailchimp without polling them, so the next run of the
+        file submits its changes instead of restoring batches that were accepted already"""
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+    
+    def _poll_batches(self, report, batches, delay):
+        log = self.log_message
+        pending = list(batches)
+        attempts = {} # batch id -> failed attempts to read its results
+        
+        while pending and not self.cancelled.is_set():
+            time.sleep(delay)
+            delay = min(delay * 2, config_poll_max_interval)
+            
+            still_pending = []
+            for batch in pending:
+                try:
+                    check = call_api(self.client.batch_operations.get, batch_id=batch['id'], metrics=self.metrics, scheduler=self.scheduler,
+                                     priority=INTERACTIVE, endpoint='batches.get')
+                except Exception as e:
+                    log(f"Error polling batch {batch['id']}: {str(e)}")
+                    still_pending.append(batch)
+                    continue
+                
+                self.batch_checked(batch, check)
+                if check['status'] != 'finished':
+                    still_pending.append(batch)
+                    continue
+                
+                if check.get('errored_operations', 0) and check.get('response_body_url'):
+                    try:
+                        succeeded, failed = report.add_batch(batch['id'], self.collect_failed(iter_operation_results(check['response_body_url'])))
+                        log(f"Batch {batch['id']} ({batch['kind']}) finished: {succeeded} succeeded, {failed} failed")
+                        self.batch_finished(batch, check, failed)
+                    except Exception as e:
+                        if self.results_failed(report, batch, check, e, attempts):
+                            still_pending.append(batch)
+                else:
+                    log(f"Batch {batch['id']} ({batch['kind']}) finished: all {check.get('total_operations', 0)} operations succeeded")
+                    self.batch_finished(batch, check, 0)
+            pending = still_pending
+            self.report_processing()
+        
+        if report.failed:
+            log(f"All batches finished. {report.failed} failed operations written to {report.path}")
+        else:
+            log("All batches finished without errors")
+    
+    def results_failed(self, report, batch, check, error, attempts):
+        """Handle an error reading the results of a finished batch, returns True when they are read again at the next poll.
+        
+        After the last retry the batch is recorded as finished, with its failed
+        operations reported as unreadable results.
+        """
+        attempts[batch['id']] = attempts.get(batch['id'], 0) + 1
+        if attempts[batch['id']] <= config_retries:
+            self.log_message(f"Error reading results of batch {batch['id']}, retrying at the next poll: {str(error)}")
+            return True
+        failed = check.get('errored_operations', 0)
+        self.log_message(f"Batch {batch['id']} ({batch['kind']}) finished: {failed} failed, results unreadable: {str(error)}")
+        report.add_unreadable(batch['id'], failed, str(error))
+        self.results_unknown = True
+        self.batch_finished(batch, check, failed)
+        return False
+    
+    def collect_failed(self, results):
+        """Pass on operation results, remembering the ids of the failed operations"""
+        for result in results:
+            if result.get('status_code', 200) >= 400:
+                self.failed_operations.add((result.get('operation_id') or "").lower())
+            yield result
+    
+    def mark_member_cache(self):
+        """With webhooks, mark the member cache stale until the writes of this run are applied to it.
+        
+        When the run is interrupted or its results are not read, the mark
+        stays and the next run fetches the changes.
+        """
+        if not (config_cache_path and config_cache_webhooks) or not (self.create_batch or self.update_batch or self.remove_batch):
+            return
+        self.cache_mark = f"run {datetime.now(timezone.utc).isoformat(timespec='seconds')} {os.getpid()}:{id(self)}"
+        cache = MemberCache(config_cache_path)
+        try:
+            cache.mark_stale(self.listid, self.cache_mark)
+        finally:
+            cache.close()
+    
+    def member_changes(self):
+        """Cache changes (see MemberCache.apply) of the operations of this run that succeeded"""
+        for operation in map(json.loads, self.create_batch + self.update_batch + self.remove_batch):
+            if operation['operation_id'].lower() in self.failed_operations:
+                continue
+            md5hash = md5(operation['operation_id'].partition(':')[2].lower().encode('utf-8')).hexdigest()
+            if operation['method'] == 'DELETE':
+                yield (self.listid, md5hash, None)
+            else:
+                yield (self.listid, md5hash, json.loads(operation['body']))
+    
+    def update_member_cache(self):
+        """Apply the writes of the finished run to the member cache, so it does not depend on their webhooks"""
+        if self.cache_mark is None:
+            return
+        if self.results_unknown:
+            self.log_message("Not all results of the run could be read, the member cache fetches the changes at the next run")
+            return
+        cache = MemberCache(config_cache_path)
+        try:
+            cache.apply(self.member_changes())
+            cache.clear_stale(self.listid, self.cache_mark)
+        finally:
+            cache.close()
+        self.cache_mark = None
+        self.log_message(f"Applied the operations of this run to the member cache ({len(self.failed_operations)} failed left out)")
+    
+    def check_batches(self):
+        """Fetch the status of all batches, returns the aggregated totals and the per-batch responses"""
+        if not self.batches:
+            return None, []
+        
+        remote = [batch for batch in self.batches if 'check' not in batch]
+        if not remote:
+            return self.aggregate_checks([])
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(remote))) as pool:
+            checks = list(pool.map(
+                lambda batch: call_api(self.client.batch_operations.get, batch_id=batch['id'], metrics=self.metrics, scheduler=self.scheduler,
+                                       priority=INTERACTIVE, endpoint='batches.get'),
+                remote,
+            ))
+        return self.aggregate_checks(checks)
+
+    def aggregate_checks(self, checks):
+        """Add up the status responses of the /batches batches and the results of the batch subscribe requests"""
+        totals ={'batches': len(self.batches), 'total': 0, 'finished': 0, 'errored': 0, 'pending': 0, 'statuses': {}}
+        remote = iter(checks)
+        checks = [batch['check'] if 'check' in batch else next(remote) for batch in self.batches]
+        for batch, check in zip(self.batches, checks):
+            totals['total'] += check.get('total_operations', 0)
+            totals['finished'] += check.get('finished_operations', 0)
+            totals['errored'] += check.get('errored_operations', 0)
+            totals['statuses'][check['status']] = totals['statuses'].get(check['status'], 0) + 1
+            batch['status'] = check['status']
+        totals['pending'] = totals['total'] - totals['finished']
+        return totals, checks
+
+class SharedChunks:
+    """Reads and cleans an import file once for several engines that each go through all chunks.
+    
+    A chunk is kept until every reader has passed it, so memory stays
+    bounded by how far the fastest reader runs ahead of the slowest.
+    """
+    def __init__(self, path, readers, chunks=None):
+        # (chunk, cleaned) pairs; cleaned is None for chunks that still have to be cleaned
+        self.chunks = iter(chunks) if chunks is not None else ((chunk, None) for chunk in read_contacts(path))
+        self.positions = [0] * readers # next chunk per reader, None once a reader has stopped
+        self.cache = {}
+        self.read = 0
+        self.exhausted = False
+        self.lock = threading.Lock()
+    
+    def iterate(self, reader):
+        """Yield (chunk, (contacts, warnings, errors)) pairs for one reader"""
+        try:
+            while True:
+                with self.lock:
+                    number = self.positions[reader]
+                    if number == self.read and not self.exhausted:
+                        chunk, cleaned = next(self.chunks, (None, None))
+                        if chunk is None:
+                            self.exhausted = True
+                        else:
+                            self.cache[number] = (chunk, cleaned if cleaned is not None else normalise_contacts(chunk))
+                            self.read += 1
+                    if number >= self.read:
+                        return
+                    item = self.cache[number]
+                    self.positions[reader] = number + 1
+                    self.drop()
+                yield item
+        finally:
+            self.release(reader)
+    
+    def release(self, reader):
+        """Stop reading for one reader, so the chunks it did not need can be dropped"""
+        with self.lock:
+            self.positions[reader] = None
+            self.drop()
+    
+    def drop(self):
+        oldest = min((position for position in self.positions if position is not None), default=self.read)
+        for number in [number for number in self.cache if number < oldest]:
+            del self.cache[number]
+
+class MultiListEngine:
+    """Updates several lists from one import file, with the same interface as UpdateEngine.
+    
+    The file is read and cleaned once; lookups and batches run per list, in
+    parallel. The workers are divided over the lists, because Mailchimp's
+    connection limit applies to the whole account.
+    """
+    def __init__(self, targets, mode=None, contact_type=default_contact_type, workers=config_workers,
+                 list_id=None, log=print_log, progress=None, scheduler=None, **kwargs):
+        self.log_message = log
+        self.progress = progress or (lambda value, maximum, text: None)
+        self.import_file_path = ""
+        self.aantal_ingeschrevenen = 0
+        self.progress_values = {}
+        self.progress_lock = threading.Lock()
+        self.metrics = Metrics() # shared by all lists, like the connection limit
+        # All workers go to the shared scheduler, the lists only split the threads
+        self.scheduler = scheduler or get_scheduler(workers)
+        self.engines = [
+            create_engine(
+                mode,
+                contact_type=target.get('contact_type', contact_type),
+                workers=max(1, workers // len(targets)),
+                list_id=target['list_id'],
+                category=target_category(target),
+                segments=target_segments(target),
+                log=lambda message, list_id=target['list_id']: log(f"[{list_id}] {message}"),
+                progress=lambda value, maximum, text, list_id=target['list_id']: self.list_progress(list_id, value, maximum, text),
+                scheduler=self.scheduler,
+                **kwargs,
+            )
+            for target in targets
+        ]
+        self.listid = ",".join(target['list_id'] for target in targets)
+        self.prepared = None # (dedup, chunks) of an import file that was read already, see prepare()
+        for engine in self.engines:
+            engine.metrics = self.metrics
+    
+    @property
+    def batches(self):
+        return [batch for engine in self.engines for batch in engine.batches]
+    
+    @property
+    def stage_times(self):
+        stage_times = {}
+        for engine in self.engines:
+            for stage, seconds in engine.stage_times.items():
+                stage_times[stage] = max(stage_times.get(stage, 0.0), seconds)
+        return stage_times
+    
+    def list_progress(self, list_id, value, maximum, text):
+        """Report the combined progress of all lists"""
+        with self.progress_lock:
+            self.progress_values[list_id] = (value, maximum)
+            value = sum(values[0] for values in self.progress_values.values())
+            maximum = sum(values[1] for values in self.progress_values.values())
+        self.progress(value, maximum, f"[{list_id}] {text}")
+    
+    def run(self, import_file_path, aantal=None):
+        """Process the import file for every list in parallel, returns the combined summary"""
+        self.import_file_path = import_file_path
+        self.aantal_ingeschrevenen = aantal if aantal is not None else count_rows(import_file_path)
+        self.log_message(f"Updating {len(self.engines)} lists: {', '.join(engine.listid for engine in self.engines)}")
+        
+        # Duplicates are found once for all lists
+        first = self.engines[0]
+        dedup, chunks = self.prepared or (None, None)
+        if dedup is None:
+            with first.timed('dedup'):
+                dedup = plan_dedup(import_file_path, first.dedup_policy)
+        for engine in self.engines:
+            engine.dedup = dedup
+        if dedup[0]:
+            self.log_message(f"Found {len(dedup[0])} duplicate rows, keeping one row per email address ({first.dedup_policy} wins)")
+        
+        shared = SharedChunks(import_file_path, len(self.engines), chunks)
+        for reader, engine in enumerate(self.engines):
+            engine.shared_chunks = (shared, reader)
+        
+        def run(reader, engine):
+            try:
+                return engine.run(import_file_path, self.aantal_ingeschrevenen)
+            finally:
+                shared.release(reader)
+        
+        with ThreadPoolExecutor(max_workers=len(self.engines)) as pool:
+            futures = [pool.submit(run, reader, engine) for reader, engine in enumerate(self.engines)]
+        # Wait for all lists, so batches accepted for one list are kept when another fails
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise errors[0]
+        return self.summary()
+    
+    def summary(self):
+        """Totals of all lists plus the summary of each list"""
+        summaries = [engine.summary() for engine in self.engines]
+        summary = {
+            'file': self.import_file_path,
+            'rows': self.aantal_ingeschrevenen,
+            'lists': summaries,
+            'batches': self.batches,
+            'stage_times': {stage: round(seconds, 3) for stage, seconds in self.stage_times.items()},
+        }
+        for count in ('created', 'updated', 'unchanged', 'removed'):
+            summary[count] = sum(list_summary[count] for list_summary in summaries)
+        # Invalid rows and warnings come from the shared file, they are the same for every list
+        summary['skipped'] = summaries[0]['skipped']
+        summary['duplicates'] = summaries[0]['duplicates']
+        summary['warnings'] = summaries[0]['warnings']
+        summary['dry_run'] = self.engines[0].debug_mode
+        summary['api'] = self.metrics.snapshot()
+        return summary
+    
+    metrics_report = UpdateEngine.metrics_report
+    export_metrics = UpdateEngine.export_metrics
+    
+    def new_error_report(self):
+        return self.engines[0].new_error_report()
+    
+    def poll_batches(self, report, batches=None, interval=None):
+        """Poll the batches of all lists in parallel, into one error report"""
+        with ThreadPoolExecutor(max_workers=len(self.engines)) as pool:
+            futures = [
+                pool.submit(engine.poll_batches, report, None if batches is None else [batch for batch in batches if batch in engine.batches], interval)
+                for engine in self.engines
+            ]
+        for future in futures:
+            future.result()
+    
+    def release_checkpoint(self):
+        for engine in self.engines:
+            engine.release_checkpoint()
+    
+    def check_batches(self):
+        """Status of the batches of all lists, with the totals per list under 'lists'"""
+        if not self.batches:
+            return None, []
+        totals = {'batches': 0, 'total': 0, 'finished': 0, 'errored': 0, 'pending': 0, 'statuses': {}, 'lists': {}}
+        checks = []
+        for engine in self.engines:
+            list_totals, list_checks = engine.check_batches()
+            if not list_totals:
+                continue
+            totals['lists'][engine.listid] = list_totals
+            checks += list_checks
+            for count in ('batches', 'total', 'finished', 'errored', 'pending'):
+                totals[count] += list_totals[count]
+            for status, number in list_totals['statuses'].items():
+                totals['statuses'][status] = totals['statuses'].get(status, 0) + number
+        return totals, checks
+    
+    def cancel(self):
+        for engine in self.engines:
+            engine.cancel()
+    
+    def share(self, backoff, metrics, members):
+        self.metrics = metrics
+        for engine in self.engines:
+            engine.share(backoff, metrics, members)
+    
+    def share_sync(self, hashes, planned):
+        for engine in self.engines:
+            engine.share_sync(hashes, planned)
+    
+    def prepare(self, dedup, chunks):
+        self.prepared = (dedup, chunks)
+    
+    def close(self):
+        for engine in self.engines:
+            engine.close()
+
+def main(argv=None):
+    """Command-line entry point for unattended runs, prints a JSON summary on stdout"""
+    parser = argparse.ArgumentParser(description="Update a Mailchimp list from an Excel or CSV file.")
+    parser.add_argument('input', nargs='+',
+                        help="Excel (.xlsx, .xls) or CSV file with contacts; several files are processed at once, "
+                             "FILE=Employee sets the contact type of one file")
+    parser.add_argument('--type', dest='contact_type', choices=['Student', 'Employee'], default=default_contact_type,
+                        help="contact type of everyone in the file (default: %(default)s)")
+    parser.add_argument('--dry-run', action='store_true', default=debug_mode,
+                        help="read only, no API writes (debug mode)")
+    parser.add_argument('--update-policy', choices=['create-only', 'update', 'force'],
+                        default='update' if config_update else 'create-only',
+                        help="create-only: never update existing members, update: only update members that changed, "
+                             "force: update all existing members (default: %(default)s)")
+    parser.add_argument('--dedup', choices=['first', 'last', 'non-empty', 'off'], default=config_dedup,
+                        help="which row to keep when an email address occurs more than once (default: %(default)s)")
+    parser.add_argument('--group-mode', choices=['interests', 'segments'], default=config_group_mode,
+                        help="set the Type and Taal groups as interests of every member, or with bulk static segment "
+                             "(tag) requests (default: %(default)s)")
+    parser.add_argument('--sync', choices=['off', 'archive', 'unsubscribe'], default=config_sync,
+                        help="archive or unsubscribe the members of the contact type that are not in the file (default: %(default)s)")
+    parser.add_argument('--sync-max-share', type=float, default=config_sync_max_share,
+                        help="stop before writing anything when the sync would remove a larger share of the contact type "
+                             "(default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=config_workers,
+                        help="concurrent API requests (default: %(default)s)")
+    parser.add_argument('--processes', type=int, default=config_processes,
+                        help="processes reading the files when there are several (default: one per CPU)")
+    parser.add_argument('--list-id', default=listid, help="Mailchimp list (audience) id")
+    parser.add_argument('--lists', default=config_lists or None,
+                        help="JSON file with several target lists to update in one pass (overrides --list-id)")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default=config_engine,
+                        help="threaded (mailchimp3) or asyncio (aiohttp) API engine (default: %(default)s)")
+    parser.add_argument('--wait', action='store_true',
+                        help="poll the batches until they have finished and report failed operations")
+    parser.add_argument('--metrics', default=config_metrics_file or None,
+                        help="write stage times and API metrics to this file, as Prometheus text for .prom, otherwise JSON")
+    parser.add_argument('--restart', action='store_true',
+                        help="discard the checkpoint of an interrupted run of this file instead of resuming it")
+    parser.add_argument('--quiet', action='store_true', help="only print the JSON summary")
+    args = parser.parse_args(argv)
+    try:
+        targets = load_targets(args.lists) if args.lists else None
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    
+    last_progress = [0.0]
+    
+    def print_progress(value, maximum, text):
+        # Progress lines every 10 seconds, the GUI shows every update
+        now = time.monotonic()
+        if now - last_progress[0] >= 10:
+            last_progress[0] = now
+            print_log(text)
+    
+    from job_queue import JobQueue, parse_job
+    jobs = [parse_job(argument, args.contact_type) for argument in args.input]
+    settings = dict(
+        targets=targets,
+        debug_mode=args.dry_run,
+        update=args.update_policy != 'create-only',
+        skip_unchanged=args.update_policy != 'force',
+        dedup=args.dedup,
+        group_mode=args.group_mode,
+        sync=args.sync,
+        sync_max_share=args.sync_max_share,
+        workers=args.workers,
+        list_id=args.list_id,
+        scheduler=get_scheduler(args.workers),
+        log=(lambda message: None) if args.quiet else print_log,
+        progress=None if args.quiet else print_progress,
+        resume=not args.restart,
+    )
+    if len(jobs) > 1:
+        engine = JobQueue(jobs, args.engine, processes=args.processes, **settings)
+    else:
+        engine = create_engine(args.engine, contact_type=jobs[0][1], **settings)
+    
+    try:
+        summary = engine.run() if len(jobs) > 1 else engine.run(jobs[0][0])
+        # The results of batch subscribe requests are reported without waiting
+        if engine.batches and (args.wait or all('check' in batch for batch in engine.batches)):
+            report = engine.new_error_report()
+            engine.poll_batches(report)
+            summary['status'], checks = engine.check_batches()
+            summary['error_report'] = report.path if report.failed else None
+            summary['api'] = engine.metrics.snapshot()
+        else:
+            engine.release_checkpoint() # Mailchimp processes the accepted batches, their ids are in the summary
+        engine.export_metrics(args.metrics)
+    except Exception as e:
+        print_log(f"Error during processing: {str(e)}")
+        print(json.dumps({'error': str(e)}))
+        return 1
+    finally:
+        engine.close()
+    
+    print(json.dumps(summary))
+    # A job queue keeps the other files going when one fails, the exit code still tells
+    return 1 if summary.get('failed') else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,77 +8,47 @@ Updates mailchimp lists by checking status first.
 """
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-try:
-    from PIL import Image, ImageTk
-    PIL_AVAILABLE = True
-except ImportError:
-    PIL_AVAILABLE = False
 import threading
-from email.utils import parseaddr
-import json
-from hashlib import md5
-import pandas as pd
-from datetime import datetime
-from mailchimp3 import MailChimp
-from dotenv import load_dotenv
+import queue
 import os
+import sys
+from datetime import datetime
+from mailchimp_engine import (
+    RunCancelled, config_engine, config_lists, config_sync, count_rows, create_engine, debug_mode, default_contact_type, load_targets,
+)
+from job_queue import JobQueue
+from metrics import format_report
 
-load_dotenv()
-api_key = os.environ.get("MAILCHIMP_API_KEY")
-if not api_key:
-    raise ValueError("MAILCHIMP_API_KEY not set in .env file")
-
-# Load configuration from environment variables
-config_update = os.environ.get("CONFIG_UPDATE", "False").lower() == "true"
-config_paginate = int(os.environ.get("CONFIG_PAGINATE", "1000"))
-debug_mode = os.environ.get("DEBUG_MODE", "False").lower() == "true"
-listid = os.environ.get("MAILCHIMP_LIST_ID")
-default_contact_type = os.environ.get("DEFAULT_CONTACT_TYPE", "Student")
-
-# Load category configuration from environment variables
-category = {
-    'Kind of email': {
-        'name': 'Kind of email',
-        'id': os.environ.get("CATEGORY_KIND_OF_EMAIL_ID"),
-        'Weekly': os.environ.get("CATEGORY_KIND_OF_EMAIL_WEEKLY"),
-        'instant': os.environ.get("CATEGORY_KIND_OF_EMAIL_INSTANT"),
-    },
-    'Type': {
-        'name': 'Type',
-        'id': os.environ.get("CATEGORY_TYPE_ID"),
-        'Student': os.environ.get("CATEGORY_TYPE_STUDENT"),
-        'Employee': os.environ.get("CATEGORY_TYPE_EMPLOYEE"),
-    }, 
-    'Taal': {
-        'name': 'Taal',
-        'id': os.environ.get("CATEGORY_TAAL_ID"),
-        'Nederlands': os.environ.get("CATEGORY_TAAL_NEDERLANDS"),
-        'English': os.environ.get("CATEGORY_TAAL_ENGLISH"),
-    },
-}
-
-client = MailChimp(mc_api=api_key, timeout=20.0)
+# Status log settings
+log_max_lines = int(os.environ.get("LOG_MAX_LINES", "2000")) # lines kept in the status log window
+log_file = os.environ.get("LOG_FILE", "") # optional file that receives the full log
+log_fps = int(os.environ.get("LOG_FPS", "10")) # status log and progress refreshes per second
 
 class MailchimpUpdaterGUI:
     def __init__(self):
         self.root = tk.Tk()
         self.root.title("Mailchimp List Updater")
-        self.root.geometry("800x600")
+        self.root.geometry("800x730")
         self.root.resizable(True, True)
         
         # Data storage
-        self.ingeschrevenen = [] # list from Excel file
-        self.contact_list = [] # list of contacts to be processed
-        self.fouten = [] # list of errors
-        self.update_batch = [] # list of updates to be made
-        self.create_batch = [] # list of new contacts to be created
+        self.aantal_ingeschrevenen = 0 # number of rows in the Excel file
+        self.engine = None # engine of the last run, holds the batches and errors
         self.import_file_path = ""
+        self.jobs = [] # selected files: path, contact type, rows (None while counting) and their row in the file list
+        self.jobs_changed = False # a job of the running queue changed, drain_log refreshes the file list
         self.contact_type = default_contact_type
         self.processing = False
         self.debug_mode = debug_mode
         
+        # Log lines, the latest progress and widget updates from worker threads, handled by drain_log on the Tk thread
+        self.log_queue = queue.Queue()
+        self.latest_progress = None
+        self.ui_queue = queue.Queue()
+        
         # Create GUI elements
         self.create_widgets()
+        self.drain_log()
         
     def create_widgets(self):
         # Main frame
@@ -111,49 +81,77 @@ class MailchimpUpdaterGUI:
         self.file_label = ttk.Label(main_frame, text="No file selected", foreground="gray")
         self.file_label.grid(row=1, column=1, sticky=tk.W)
         
+        # Queue of selected files, each with the contact type chosen when it was added
+        jobs_frame = ttk.Frame(main_frame)
+        jobs_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(5, 0))
+        jobs_frame.columnconfigure(0, weight=1)
+        self.jobs_tree = ttk.Treeview(jobs_frame, columns=('type', 'rows', 'status'), height=4)
+        self.jobs_tree.heading('#0', text="File")
+        self.jobs_tree.heading('type', text="Contact Type")
+        self.jobs_tree.heading('rows', text="Rows")
+        self.jobs_tree.heading('status', text="Status / Batches")
+        self.jobs_tree.column('type', width=90, stretch=False)
+        self.jobs_tree.column('rows', width=70, stretch=False)
+        self.jobs_tree.grid(row=0, column=0, sticky=(tk.W, tk.E))
+        ttk.Button(jobs_frame, text="Clear Files", command=self.clear_files).grid(row=0, column=1, sticky=tk.N, padx=(10, 0))
+        
         # Contact type selection
-        ttk.Label(main_frame, text="Contact Type:", font=('Arial', 12, 'bold')).grid(row=2, column=0, columnspan=2, sticky=tk.W, pady=(20, 10))
+        ttk.Label(main_frame, text="Contact Type:", font=('Arial', 12, 'bold')).grid(row=3, column=0, columnspan=2, sticky=tk.W, pady=(20, 10))
         
         self.contact_type_var = tk.StringVar(value="Student")
-        ttk.Radiobutton(main_frame, text="Students", variable=self.contact_type_var, value="Student").grid(row=3, column=0, sticky=tk.W)
-        ttk.Radiobutton(main_frame, text="Employees", variable=self.contact_type_var, value="Employee").grid(row=3, column=1, sticky=tk.W)
+        ttk.Radiobutton(main_frame, text="Students", variable=self.contact_type_var, value="Student",
+                        command=self.on_contact_type).grid(row=4, column=0, sticky=tk.W)
+        ttk.Radiobutton(main_frame, text="Employees", variable=self.contact_type_var, value="Employee",
+                        command=self.on_contact_type).grid(row=4, column=1, sticky=tk.W)
         
         # Debug mode toggle
-        ttk.Label(main_frame, text="Options:", font=('Arial', 12, 'bold')).grid(row=4, column=0, columnspan=2, sticky=tk.W, pady=(20, 10))
+        ttk.Label(main_frame, text="Options:", font=('Arial', 12, 'bold')).grid(row=5, column=0, columnspan=2, sticky=tk.W, pady=(20, 10))
         
         self.debug_mode_var = tk.BooleanVar(value=self.debug_mode)
         self.debug_checkbox = ttk.Checkbutton(main_frame, text="Debug Mode (Read-only, no API writes)", 
                                             variable=self.debug_mode_var, command=self.on_debug_toggle)
-        self.debug_checkbox.grid(row=5, column=0, columnspan=2, sticky=tk.W)
+        self.debug_checkbox.grid(row=6, column=0, sticky=tk.W)
+        
+        self.async_engine_var = tk.BooleanVar(value=config_engine == 'async')
+        ttk.Checkbutton(main_frame, text="Asyncio engine (needs aiohttp)",
+                        variable=self.async_engine_var).grid(row=6, column=1, sticky=tk.W)
+        
+        # Sync mode: archive or unsubscribe the contacts of the type that are missing from the file
+        sync_frame = ttk.Frame(main_frame)
+        sync_frame.grid(row=7, column=0, columnspan=2, sticky=tk.W, pady=(5, 0))
+        ttk.Label(sync_frame, text="Members missing from the file:").grid(row=0, column=0, sticky=tk.W, padx=(0, 10))
+        self.sync_var = tk.StringVar(value=config_sync)
+        ttk.Combobox(sync_frame, textvariable=self.sync_var, values=['off', 'archive', 'unsubscribe'], state='readonly',
+                     width=12).grid(row=0, column=1, sticky=tk.W)
         
         # Contact count display
         self.count_label = ttk.Label(main_frame, text="", font=('Arial', 10))
-        self.count_label.grid(row=6, column=0, columnspan=2, sticky=tk.W, pady=(10, 0))
+        self.count_label.grid(row=8, column=0, columnspan=2, sticky=tk.W, pady=(10, 0))
         style = ttk.Style()
         style.configure("Green.TButton", foreground="white", background="#4CAF50")
 
         # Process button
         self.process_button = ttk.Button(main_frame, text="Start Processing", command=self.start_processing, state=tk.DISABLED, padding=(10,10), style="Green.TButton")
-        self.process_button.grid(row=7, column=0, columnspan=2, pady=(20, 10))
+        self.process_button.grid(row=9, column=0, columnspan=2, pady=(20, 10))
         
         # Progress section
-        ttk.Label(main_frame, text="Progress:", font=('Arial', 12, 'bold')).grid(row=8, column=0, columnspan=2, sticky=tk.W, pady=(20, 10))
+        ttk.Label(main_frame, text="Progress:", font=('Arial', 12, 'bold')).grid(row=10, column=0, columnspan=2, sticky=tk.W, pady=(20, 10))
         
         self.progress = ttk.Progressbar(main_frame, mode='determinate')
-        self.progress.grid(row=9, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(0, 5))
+        self.progress.grid(row=11, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(0, 5))
         
         self.progress_label = ttk.Label(main_frame, text="Ready to start")
-        self.progress_label.grid(row=10, column=0, columnspan=2, sticky=tk.W)
+        self.progress_label.grid(row=12, column=0, columnspan=2, sticky=tk.W)
         
         # Status and log section
-        ttk.Label(main_frame, text="Status Log:", font=('Arial', 12, 'bold')).grid(row=11, column=0, columnspan=2, sticky=tk.W, pady=(20, 10))
+        ttk.Label(main_frame, text="Status Log:", font=('Arial', 12, 'bold')).grid(row=13, column=0, columnspan=2, sticky=tk.W, pady=(20, 10))
         
         # Text widget with scrollbar for status log
         log_frame = ttk.Frame(main_frame)
-        log_frame.grid(row=12, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(0, 10))
+        log_frame.grid(row=14, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(0, 10))
         log_frame.columnconfigure(0, weight=1)
         log_frame.rowconfigure(0, weight=1)
-        main_frame.rowconfigure(12, weight=1)
+        main_frame.rowconfigure(14, weight=1)
         
         self.log_text = tk.Text(log_frame, height=15, width=80, wrap=tk.WORD)
         scrollbar = ttk.Scrollbar(log_frame, orient=tk.VERTICAL, command=self.log_text.yview)
@@ -164,16 +162,24 @@ class MailchimpUpdaterGUI:
         
         # Batch status section
         self.status_frame = ttk.Frame(main_frame)
-        self.status_frame.grid(row=13, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 0))
+        self.status_frame.grid(row=15, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 0))
         
         self.check_status_button = ttk.Button(self.status_frame, text="Check Batch Status", command=self.check_batch_status, state=tk.DISABLED)
         self.check_status_button.grid(row=0, column=0, padx=(0, 10))
         
+        self.cancel_button = ttk.Button(self.status_frame, text="Cancel", command=self.cancel_processing, state=tk.DISABLED)
+        self.cancel_button.grid(row=0, column=1, padx=(0, 10))
+        
         self.status_label = ttk.Label(self.status_frame, text="")
-        self.status_label.grid(row=0, column=1, sticky=tk.W)
+        self.status_label.grid(row=0, column=2, sticky=tk.W)
     
     def load_logo(self):
         """Load and display logo image if available"""
+        try:
+            from PIL import Image, ImageTk
+            PIL_AVAILABLE = True
+        except ImportError:
+            PIL_AVAILABLE = False
         try:
             if not PIL_AVAILABLE:
                 # Try to load with tkinter's built-in PhotoImage (supports GIF/PPM/PGM)
@@ -239,55 +245,205 @@ class MailchimpUpdaterGUI:
             self.process_button.config(text="Start Processing")
         
     def select_file(self):
-        file_path = filedialog.askopenfilename(
-            title="Select Excel File",
-            filetypes=[("Excel files", "*.xlsx *.xls"), ("All files", "*.*")]
+        """Add one or more files to the queue, with the selected contact type"""
+        file_paths = filedialog.askopenfilenames(
+            title="Select Excel Files",
+            filetypes=[("Excel files", "*.xlsx *.xls"), ("CSV files", "*.csv"), ("All files", "*.*")]
         )
+        if not file_paths or self.processing:
+            return
         
-        if file_path:
-            self.import_file_path = file_path
+        contact_type = self.contact_type_var.get()
+        for file_path in file_paths:
             filename = file_path.split('/')[-1].split('\\')[-1]  # Get just the filename
-            self.file_label.config(text=f"Selected: {filename}", foreground="black")
+            item = self.jobs_tree.insert('', tk.END, text=filename, values=(contact_type, "", "Counting..."))
+            self.jobs.append({'path': file_path, 'contact_type': contact_type, 'rows': None, 'item': item})
             
-            # Try to load the file and count contacts
-            try:
-                import pandas as pd
-                self.ingeschrevenen = pd.read_excel(file_path)
-                count = len(self.ingeschrevenen)
-                self.count_label.config(text=f"Found {count} contacts in the file")
-                self.process_button.config(state=tk.NORMAL)
-                self.log_message(f"Loaded Excel file: {filename}")
-                self.log_message(f"Found {count} contacts")
-            except Exception as e:
-                messagebox.showerror("Error", f"Error loading Excel file: {str(e)}")
-                self.log_message(f"Error loading file: {str(e)}")
+            # Count the contacts in the background, the file is only read while processing
+            thread = threading.Thread(target=self.count_contacts, args=(file_path, filename, item))
+            thread.daemon = True
+            thread.start()
+        
+        self.import_file_path = self.jobs[0]['path']
+        self.file_label.config(text=f"Selected: {len(self.jobs)} files" if len(self.jobs) > 1 else f"Selected: {self.jobs_tree.item(self.jobs[0]['item'], 'text')}",
+                               foreground="black")
+        self.aantal_ingeschrevenen = 0
+        self.process_button.config(state=tk.DISABLED)
+        self.count_label.config(text="Counting contacts...")
+    
+    def clear_files(self):
+        """Empty the queue of selected files"""
+        if self.processing:
+            return
+        self.jobs_tree.delete(*self.jobs_tree.get_children())
+        self.jobs = []
+        self.import_file_path = ""
+        self.aantal_ingeschrevenen = 0
+        self.file_label.config(text="No file selected", foreground="gray")
+        self.count_label.config(text="")
+        self.process_button.config(state=tk.DISABLED)
+    
+    def on_contact_type(self):
+        """Apply the contact type to the files selected in the list, or to the only file"""
+        items = self.jobs_tree.selection() or ([self.jobs[0]['item']] if len(self.jobs) == 1 else [])
+        for job in self.jobs:
+            if job['item'] in items:
+                job['contact_type'] = self.contact_type_var.get()
+                self.jobs_tree.set(job['item'], 'type', job['contact_type'])
+    
+    def count_contacts(self, file_path, filename, item):
+        """Count the contacts in the selected file (runs in separate thread)"""
+        try:
+            count = count_rows(file_path)
+        except Exception as e:
+            self.call_in_ui(self.on_file_error, item, e)
+            return
+        self.call_in_ui(self.on_file_counted, item, filename, count)
+    
+    def on_file_counted(self, item, filename, count):
+        job = next((job for job in self.jobs if job['item'] == item), None)
+        if job is None:
+            return # The files were cleared in the meantime
+        job['rows'] = count
+        self.jobs_tree.set(item, 'rows', count)
+        self.jobs_tree.set(item, 'status', "Ready")
+        self.log_message(f"Selected file: {filename}")
+        self.log_message(f"Found {count} contacts")
+        
+        if all(job['rows'] is not None for job in self.jobs):
+            self.aantal_ingeschrevenen = sum(job['rows'] for job in self.jobs)
+            if len(self.jobs) > 1:
+                self.count_label.config(text=f"Found {self.aantal_ingeschrevenen} contacts in {len(self.jobs)} files")
+            else:
+                self.count_label.config(text=f"Found {self.aantal_ingeschrevenen} contacts in the file")
+            self.process_button.config(state=tk.NORMAL)
+    
+    def on_file_error(self, item, e):
+        messagebox.showerror("Error", f"Error loading Excel file: {str(e)}")
+        self.log_message(f"Error loading file: {str(e)}")
+        self.jobs = [job for job in self.jobs if job['item'] != item]
+        self.jobs_tree.delete(item)
+        if self.jobs and all(job['rows'] is not None for job in self.jobs):
+            self.aantal_ingeschrevenen = sum(job['rows'] for job in self.jobs)
+            self.process_button.config(state=tk.NORMAL)
     
     def log_message(self, message):
-        """Add a message to the status log"""
-        from datetime import datetime
+        """Add a message to the status log (safe to call from any thread)"""
         timestamp = datetime.now().strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        self.log_queue.put(f"[{timestamp}] {message}\n")
+    
+    def call_in_ui(self, callback, *args):
+        """Have drain_log call a function on the Tk thread, Tk is not thread-safe (safe to call from any thread)"""
+        self.ui_queue.put((callback, args))
+    
+    def drain_log(self):
+        """Show queued log lines and the latest progress, a fixed number of times per second"""
+        lines = []
+        try:
+            while True:
+                lines.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        
+        if lines:
+            text = "".join(lines)
+            if log_file:
+                # Opened per write, so the file is closed however the window goes away
+                with open(log_file, 'a', encoding='utf-8') as f:
+                    f.write(text)
+            # Only the last lines fit in the window anyway
+            self.log_text.insert(tk.END, "".join(lines[-log_max_lines:]))
+            excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - log_max_lines
+            if excess > 0:
+                self.log_text.delete('1.0', f"{excess + 1}.0")
+            self.log_text.see(tk.END)
+        
+        progress, self.latest_progress = self.latest_progress, None
+        if progress is not None:
+            value, maximum, text = progress
+            self.progress['maximum'] = maximum
+            self.progress['value'] = value
+            self.progress_label.config(text=text)
+        
+        if self.jobs_changed:
+            self.jobs_changed = False
+            self.show_jobs()
+        
+        try:
+            while True:
+                callback, args = self.ui_queue.get_nowait()
+                try:
+                    callback(*args)
+                except Exception:
+                    # Reported like an error in a Tk callback, the log keeps draining
+                    self.root.report_callback_exception(*sys.exc_info())
+        except queue.Empty:
+            pass
+        
+        self.root.after(max(1, 1000 // log_fps), self.drain_log)
+    
+    def on_job_update(self, job):
+        """Remember that a job of the queue changed, drain_log shows it (called from worker threads)"""
+        self.jobs_changed = True
+    
+    def show_jobs(self):
+        """Show the status, progress and batch ids of every job of the running queue in the file list"""
+        if not isinstance(self.engine, JobQueue):
+            return
+        for selected, job in zip(self.jobs, self.engine.jobs):
+            status = job.status
+            value, maximum, text = job.progress
+            if job.status == 'running' and maximum:
+                status += f" {100 * value // maximum}%"
+            if job.batch_ids:
+                status += f" - {', '.join(job.batch_ids)}"
+            if job.error:
+                status += f" - {job.error}"
+            self.jobs_tree.set(selected['item'], 'status', status)
     
     def start_processing(self):
         """Start the processing in a separate thread to avoid blocking the GUI"""
         if self.processing:
             return
             
-        if not self.import_file_path or len(self.ingeschrevenen) == 0:
+        if not self.jobs or any(job['rows'] is None for job in self.jobs) or self.aantal_ingeschrevenen == 0:
             messagebox.showerror("Error", "Please select a valid Excel file first")
             return
         
+        try:
+            targets = load_targets(config_lists) if config_lists else None
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Could not read the target lists: {str(e)}")
+            return
+        
         self.processing = True
         self.process_button.config(state=tk.DISABLED)
-        self.contact_type = self.contact_type_var.get()
+        self.cancel_button.config(state=tk.NORMAL)
+        self.contact_type = self.jobs[0]['contact_type']
         self.debug_mode = self.debug_mode_var.get()
-        
-        # Clear previous results
-        self.fouten = []
-        self.update_batch = []
-        self.create_batch = []
+        mode = 'async' if self.async_engine_var.get() else 'threaded'
+        if len(self.jobs) > 1:
+            # Several files are read in parallel and share the API limits
+            self.engine = JobQueue(
+                [(job['path'], job['contact_type']) for job in self.jobs],
+                mode,
+                targets=targets,
+                debug_mode=self.debug_mode,
+                sync=self.sync_var.get(),
+                log=self.log_message,
+                progress=self.on_progress,
+                on_update=self.on_job_update,
+            )
+        else:
+            self.engine = create_engine(
+                mode,
+                targets=targets,
+                contact_type=self.contact_type,
+                debug_mode=self.debug_mode,
+                sync=self.sync_var.get(),
+                log=self.log_message,
+                progress=self.on_progress,
+            )
         
         # Start processing in a separate thread
         thread = threading.Thread(target=self.process_contacts)
@@ -297,302 +453,88 @@ class MailchimpUpdaterGUI:
     def process_contacts(self):
         """Process contacts (runs in separate thread)"""
         try:
-            aantal = len(self.ingeschrevenen)
-            mode_text = "DEBUG MODE" if self.debug_mode else "PRODUCTION MODE"
-            self.log_message(f"🚀 Starting to process {aantal} contacts as {self.contact_type}s - {mode_text}")
-            
-            if self.debug_mode:
-                self.log_message("🐛 DEBUG: API writes are DISABLED - only read operations will be performed")
-                self.log_message(f"🐛 DEBUG: Configuration - Update: {config_update}, List ID: {listid}")
-                self.log_message(f"🐛 DEBUG: Categories loaded: {len(category)} categories available")
+            self.engine.run(self.import_file_path, self.aantal_ingeschrevenen)
             
-            # Reset progress
-            self.progress['maximum'] = aantal
-            self.progress['value'] = 0
+            if not self.debug_mode:
+                self.log_message("You can now check the batch status.")
             
-            cnt = 0
-            update_lid = 0
-            nieuw_lid = 0
-            starttijd = datetime.now()
-            
-            for index, contact in self.ingeschrevenen.iterrows(): # Iterate excel file
-                # Clean and format current contact
-                contact = self.cleancontact(contact, index)
-                if not contact:
-                    if self.debug_mode:
-                        self.log_message(f"🐛 DEBUG: Skipped invalid contact at index {index}")
-                    cnt += 1
-                    continue
-                
-                cnt += 1
-                
-                # Update progress
-                self.progress['value'] = cnt
-                progress_text = f"Processing {cnt}/{aantal} - {contact['roepnaam']} {contact['achternaam']}"
-                self.progress_label.config(text=progress_text)
-                
-                # Log current contact
-                if self.debug_mode:
-                    self.log_message(f"🐛 DEBUG: Processing contact {cnt}/{aantal}: {contact['roepnaam']} {contact['achternaam']} ({contact['e-mailadres']})")
-
-                # Process contact with Mailchimp
-                email_address = contact['e-mailadres']
-                md5hash = md5(email_address.lower().encode('utf-8')).hexdigest()
-                
-                if self.debug_mode:
-                    self.log_message(f"🐛 DEBUG: Email: {email_address}, MD5 hash: {md5hash}")
-                
-                hit = ""
-                nieuwe = False
-                
-                if self.debug_mode:
-                    self.log_message(f"🐛 DEBUG: Checking if member exists in Mailchimp...")
-                
-                # check if member exists in Mailchimp
-                try:
-                    hit = client.lists.members.get(list_id=listid, subscriber_hash=md5hash, fields="status,merge_fields.FNAME,merge_fields.LNAME,interests")
-                    if self.debug_mode:
-                        self.log_message(f"🐛 DEBUG: Found existing member - Status: {hit.get('status', 'unknown')}, Name: {hit.get('merge_fields', {}).get('FNAME', '')  } {hit.get('merge_fields', {}).get('LNAME', '')}")
-                except Exception as e:
-                    nieuwe = True
-                    if self.debug_mode:
-                        self.log_message(f"🐛 DEBUG: Member not found in list (will be created) - Error: {str(e)[:100]}")
-                
-                if nieuwe:  # New member
-
-                    # prepare member data for insertion
-                    memberdata = {
-                        'email_address': email_address,
-                        'status': 'subscribed',
-                        'merge_fields': {
-                            'FNAME': contact['roepnaam'],
-                            'LNAME': contact['achternaam'],
-                            'TYPE': self.contact_type,
-                        },
-                        'interests': {
-                            category['Type'][self.contact_type]: True,
-                            category['Kind of email']['Weekly']: True,
-                            category['Taal']['Nederlands']: True,
-                        },
-                    }
-                    
-                    if self.debug_mode:
-                        self.log_message(f"🐛 DEBUG: Would CREATE new member with data: {json.dumps(memberdata, indent=2)}")
-                        self.log_message(f"🐛 DEBUG: Operation would be POST to /lists/{listid}/members/")
-                    else:
-                        self.log_message(f"CREATE: {contact['roepnaam']} {contact['achternaam']} ({contact['e-mailadres']})")
-
-                    operation_item = {
-                        "method": "POST",
-                        "path": "/lists/" + listid + "/members/",
-                        "operation_id": "create_batch",
-                        "body": json.dumps(memberdata)
-                    }
-                    
-                    self.create_batch.append(operation_item)
-                    nieuw_lid += 1
-                    
-                else:  # Existing member
-
-                    if config_update == False:
-                        if self.debug_mode:
-                            self.log_message(f"🐛 DEBUG: Skipping update for existing member (CONFIG_UPDATE=False)")
-                        continue
-                    
-                    if self.debug_mode:
-                        self.log_message(f"🐛 DEBUG: Updating existing member...")
-                    
-                    # Save names from Excel file
-                    original_fname = hit['merge_fields'].get('FNAME', '')
-                    original_lname = hit['merge_fields'].get('LNAME', '')
-                    
-                    # Check if there is a first or last name in the response from Mailchimp
-                    # If so, keep the name from Mailchimp
-                    if original_lname is not None: 
-                        contact['achternaam'] = original_lname
-                    if original_fname is not None:
-                        contact['roepnaam'] = original_fname
-                    
-                    if original_fname != hit['merge_fields'].get('FNAME', '') and original_lname != hit['merge_fields'].get('LNAME', ''):
-                        self.log_message(f"UPDATE: New name for {original_fname} {original_lname}: {contact['roepnaam']} {contact['achternaam']}")
-                    else:
-                        self.log_message(f"UPDATE: Rejected input from Excel: {contact['roepnaam']} {contact['achternaam']} -> Keeping {original_fname} {original_lname} from Mailchimp")
-                        
-                        
-                    engels = category['Taal']['English']
-                    nederlands = category['Taal']['Nederlands']
-                    if isinstance(hit['interests'][engels], bool):
-                        if not hit['interests'][engels]:
-                            taalset = nederlands
-                        else:
-                            taalset = engels
-                    
-                    if self.debug_mode:
-                        current_lang = "English" if taalset == engels else "Nederlands"
-                        self.log_message(f"🐛 DEBUG: Language preference: {current_lang} (ID: {taalset})")
-                    
-                    memberdata = {
-                        'email_address': email_address,
-                        'merge_fields': {
-                            'FNAME': contact['roepnaam'],
-                            'LNAME': contact['achternaam'],
-                            'TYPE': self.contact_type,
-                        },
-                        'interests': {
-                            category['Type'][self.contact_type]: True,
-                            taalset: True,
-                        },
-                    }
-                    
-                    if self.debug_mode:
-                        self.log_message(f"🐛 DEBUG: Would UPDATE existing member with data: {json.dumps(memberdata, indent=2)}")
-                        self.log_message(f"🐛 DEBUG: Operation would be PATCH to /lists/{listid}/members/{md5hash}")
-                    
-                    operation_item = {
-                        "method": "PATCH",
-                        "path": "/lists/" + listid + "/members/" + md5hash,
-                        "operation_id": "update_batch",
-                        "body": json.dumps(memberdata)
-                    }
-                    
-                    self.update_batch.append(operation_item)
-                    update_lid += 1
-                
-                # Update status
-                self.root.after(0, lambda: self.progress_label.config(
-                    text=f"Processed {cnt}/{aantal} - {nieuw_lid} new, {update_lid} updates - Time remaining: {self.formatTimeDelta(starttijd, cnt/aantal)}"
-                ))
-            
-            # Show errors if any
-            if self.fouten:
-                self.log_message("\n--- Errors and Warnings ---")
-                for fout in self.fouten:
-                    self.log_message(fout)
-            
-            # Execute batch operations
-            self.create_id = None
-            self.update_id = None
-            
-            if self.debug_mode:
-                # In debug mode, don't actually execute API writes
-                self.log_message("🐛 DEBUG: ========== BATCH OPERATIONS SUMMARY ==========")
-                if nieuw_lid > 0:
-                    self.log_message(f"🐛 DEBUG: Would create {nieuw_lid} new members")
-                    self.log_message(f"🐛 DEBUG: Create batch contains {len(self.create_batch)} operations")
-                if update_lid > 0:
-                    self.log_message(f"🐛 DEBUG: Would update {update_lid} existing members")
-                    self.log_message(f"🐛 DEBUG: Update batch contains {len(self.update_batch)} operations")
-                self.log_message("🐛 DEBUG: NO API WRITES PERFORMED (Debug mode enabled)")
-                self.log_message("🐛 DEBUG: ===============================================")
+            # Enable status checking only if not in debug mode and there are actual batches
+            if not self.debug_mode and self.engine.batches:
+                self.call_in_ui(lambda: self.check_status_button.config(state=tk.NORMAL))
+                self.start_batch_poller()
             else:
-                # Normal operation - execute batch operations
-                if nieuw_lid > 0:
-                    self.log_message(f"Creating batch operation for {nieuw_lid} new members...")
-                    handle = client.batch_operations.create(data={"operations": self.create_batch})
-                    self.create_id = handle['id']
-                    self.log_message(f"Created batch operation ID: {self.create_id}")
-                
-                if update_lid > 0:
-                    self.log_message(f"Creating batch operation for {update_lid} member updates...")
-                    handle = client.batch_operations.create(data={"operations": self.update_batch})
-                    self.update_id = handle['id']
-                    self.log_message(f"Update batch operation ID: {self.update_id}")
+                self.finish_run(self.engine)
             
-            completion_message = "\nProcessing completed!"
-            if self.debug_mode:
-                completion_message += " (DEBUG MODE - No changes made to Mailchimp)"
+        except RunCancelled:
+            if self.engine.batches:
+                self.log_message(f"Processing cancelled after {len(self.engine.batches)} batches were submitted")
             else:
-                completion_message += " You can now check the batch status."
-                completion_message += "\nLarge batches may take some time to process on Mailchimp's end."
-            
-            self.log_message(completion_message)
-            
-            # Enable status checking only if not in debug mode and there are actual batches
-            if not self.debug_mode and (nieuw_lid > 0 or update_lid > 0):
-                self.root.after(0, lambda: self.check_status_button.config(state=tk.NORMAL))
-            
+                self.log_message("Processing cancelled, no batch operations were submitted")
+        
         except Exception as e:
             self.log_message(f"Error during processing: {str(e)}")
-            messagebox.showerror("Processing Error", f"An error occurred: {str(e)}")
+            self.call_in_ui(lambda message=str(e): messagebox.showerror("Processing Error", f"An error occurred: {message}"))
         
         finally:
             self.processing = False
-            self.root.after(0, lambda: self.process_button.config(state=tk.NORMAL))
+            self.call_in_ui(lambda: self.process_button.config(state=tk.NORMAL))
+            self.call_in_ui(lambda: self.cancel_button.config(state=tk.DISABLED))
     
-    def safe_str(self, value):
-        """Safely convert value to string, handling NaN values from pandas"""
-        if value is None:
-            return ""
-        str_val = str(value).strip()
-        if str_val.lower() in ['nan', 'none', 'null']:
-            return ""
-        return str_val
+    def cancel_processing(self):
+        """Ask the engine to stop the current run"""
+        if self.processing and self.engine is not None:
+            self.log_message("Cancelling...")
+            self.engine.cancel()
     
-    def cleancontact(self, contact, index):
-        """Clean and validate contact data"""
-        # Convert to lowercase for future-proofing and handle NaN values
-        contact = {k.lower(): self.safe_str(v) for k, v in contact.items()}
-        
-        # Handle aliases and English names
-        if 'prefix' in contact: contact['voorvoegsels'] = contact['prefix']
-        if 'first name' in contact: contact['roepnaam'] = contact['first name']
-        if 'last name' in contact: contact['achternaam'] = contact['last name']
-        if 'name' in contact: contact['achternaam'] = contact['name']
-        
-        if 'voorvoegsel' in contact: contact['voorvoegsels'] = contact['voorvoegsel']
-        if 'voornaam' in contact:
-            contact['roepnaam'] = contact['voornaam']
-        else:
-            if 'voorletters' in contact: contact['roepnaam'] = contact['voorletters']
-        if 'naam' in contact: contact['achternaam'] = contact['naam']
-        
-        # Find email field and clean it
-        email_value = next((v for k, v in contact.items() if 'email' in k.lower().replace('-', '')), None)
-        contact['e-mailadres'] = self.safe_str(email_value) if email_value else ""
-        
-        # Check for missing names (already cleaned by safe_str method)
-        if not contact.get('roepnaam'):
-            contact['roepnaam'] = ""
-            self.fouten.append('Warning: First name missing for ' + str(contact['e-mailadres']))
-            
-        if not contact.get('achternaam'):
-            contact['achternaam'] = ""
-            self.fouten.append('Warning: Last name missing for ' + str(contact['e-mailadres']))
-            
-        # Handle voorvoegsels (prefixes) - already cleaned by safe_str
-        if contact.get('voorvoegsels'):
-            contact['achternaam'] = contact['voorvoegsels'] + " " + contact['achternaam']
-        if not self.is_valid_email(str(contact['e-mailadres'])):
-            self.fouten.append("Error: Invalid email address (index = " + str(index) + ")")
-            return False
-        
-        return contact
+    def on_progress(self, value, maximum, text):
+        """Remember the engine progress, drain_log shows the latest one (called from worker threads)"""
+        self.latest_progress = (value, maximum, text)
     
-    def is_valid_email(self, email):
-        """Validate email address using robust regex pattern"""
-        import re
-        
-        if not email or not isinstance(email, str):
-            return False
+    def start_batch_poller(self):
+        """Watch the submitted batches in the background until they have all finished"""
+        engine = self.engine
+        report = engine.new_error_report()
         
-        email = email.strip().lower()
+        def poll():
+            engine.poll_batches(report)
+            self.call_in_ui(self.check_batch_status)
+            self.finish_run(engine)
         
-        # Comprehensive regex pattern for email validation
-        # Based on RFC 5322 specification but practical for real-world use
-        pattern = r'^[a-zA-Z0-9.!#$%&\'*+/=?^_`{|}~-]+@[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(?:\.[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*$'
-        
-        return re.match(pattern, email) is not None
+        thread = threading.Thread(target=poll)
+        thread.daemon = True
+        thread.start()
+    
+    def finish_run(self, engine):
+        """Export the run metrics and show them in the summary panel (called from worker threads)"""
+        try:
+            path = engine.export_metrics()
+            if path:
+                self.log_message(f"Metrics written to {path}")
+        except OSError as e:
+            self.log_message(f"Error writing metrics: {str(e)}")
+        report = engine.metrics_report()
+        self.call_in_ui(lambda: self.show_run_summary(engine.summary(), report))
     
-    def formatTimeDelta(self, starttijd, perc):
-        """Format time remaining estimate"""
-        if perc <= 0:
-            return "Calculating..."
-        time_passed = datetime.now() - starttijd
-        total_time = time_passed / perc
-        time_remaining = total_time - time_passed
-        hours, remainder = divmod(time_remaining.seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        return '{:02}:{:02}:{:02}'.format(int(hours), int(minutes), int(seconds))
+    def show_run_summary(self, summary, report):
+        """Show counts, stage times and API metrics of the finished run in a separate window"""
+        lines = [
+            f"Created: {summary['created']}, updated: {summary['updated']}, unchanged: {summary['unchanged']}, skipped: {summary['skipped']}, "
+            f"removed: {summary['removed']}",
+            f"Batches: {len(summary['batches'])}",
+        ] + format_report(report)
+        
+        panel = tk.Toplevel(self.root)
+        panel.title("Run Summary")
+        text = tk.Text(panel, height=len(lines) + 1, width=110, wrap=tk.NONE)
+        text.insert(tk.END, "\n".join(lines))
+        text.config(state=tk.DISABLED)
+        text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), padx=10, pady=10)
+        ttk.Button(panel, text="Close", command=panel.destroy).grid(row=1, column=0, pady=(0, 10))
+        panel.columnconfigure(0, weight=1)
+        panel.rowconfigure(0, weight=1)
+        
+        for line in format_report(report):
+            self.log_message(line)
     
     def check_batch_status(self):
         """Check the status of batch operations"""
@@ -602,22 +544,31 @@ class MailchimpUpdaterGUI:
             return
             
         try:
-            status_messages = []
+            totals, checks = self.engine.check_batches() if self.engine else (None, [])
+            if not totals:
+                self.status_label.config(text="No batch operations found")
+                return
             
-            if hasattr(self, 'create_id') and self.create_id:
-                create_check = client.batch_operations.get(batch_id=self.create_id)
-                status_messages.append(f"New members batch: {create_check['status']}")
-                self.log_message(f"New members batch status: {create_check['status']}")
+            for batch, check in zip(self.engine.batches, checks):
+                self.log_message(f"Batch {batch['id']} ({batch['kind']}): {check['status']} - {check.get('finished_operations', 0)}/{check.get('total_operations', 0)} finished, {check.get('errored_operations', 0)} errored")
             
-            if hasattr(self, 'update_id') and self.update_id:
-                update_check = client.batch_operations.get(batch_id=self.update_id)
-                status_messages.append(f"Updates batch: {update_check['status']}")
-                self.log_message(f"Updates batch status: {update_check['status']}")
+            # Separate counts per file when several files were processed
+            for path, job_totals in totals.get('jobs', {}).items():
+                job = next(job for job in self.engine.jobs if job.path == path)
+                self.log_message(f"Job {job.status_text()}: {job_totals['finished']} finished, {job_totals['errored']} errored, "
+                                 f"{job_totals['pending']} pending operations")
             
-            if status_messages:
-                self.status_label.config(text=" | ".join(status_messages))
-            else:
-                self.status_label.config(text="No batch operations found")
+            # Separate counts per list when several lists were updated
+            for list_id, list_totals in totals.get('lists', {}).items():
+                summary = next(summary for summary in self.engine.summary()['lists'] if summary['list_id'] == list_id)
+                self.log_message(f"List {list_id}: {summary['created']} created, {summary['updated']} updated, {summary['unchanged']} unchanged - "
+                                 f"{list_totals['batches']} batches ({', '.join(batch['id'] for batch in self.engine.batches if batch['list_id'] == list_id)}), "
+                                 f"{list_totals['finished']} finished, {list_totals['errored']} errored, {list_totals['pending']} pending operations")
+            
+            batch_text = ", ".join(f"{count} {status}" for status, count in totals['statuses'].items())
+            status_text = f"{totals['batches']} batches ({batch_text}) | {totals['finished']} finished, {totals['errored']} errored, {totals['pending']} pending operations"
+            self.status_label.config(text=status_text)
+            self.log_message(status_text)
                 
         except Exception as e:
             self.log_message(f"Error checking batch status: {str(e)}")
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of Mailchimp list members, so later runs only fetch the
+members that changed since the previous sync.
+
+Members are stored in SQLite, keyed by list id and subscriber hash (the
+MD5 of the lowercase email address). The webhook receiver
+(webhook_receiver.py) applies the changes Mailchimp reports to the same
+store with apply(). When changes may have been missed, the list is marked
+stale until the next sync.
+"""
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class MemberCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(members)")]
+            if columns and 'merge_fields' not in columns:
+                # Cache from an older version, start over with a full sync
+                self.conn.execute("DROP TABLE members")
+                self.conn.execute("DROP TABLE IF EXISTS sync")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS members ("
+                " list_id TEXT NOT NULL,"
+                " hash TEXT NOT NULL,"
+                " email_address TEXT,"
+                " status TEXT,"
+                " merge_fields TEXT,"
+                " interests TEXT,"
+                " PRIMARY KEY (list_id, hash))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sync ("
+                " list_id TEXT PRIMARY KEY,"
+                " last_sync TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS stale ("
+                " list_id TEXT NOT NULL,"
+                " reason TEXT NOT NULL,"
+                " marked_at TEXT NOT NULL,"
+                " PRIMARY KEY (list_id, reason))"
+            )
+
+    def last_sync(self, list_id):
+        """Return the timestamp of the last sync of a list, or None if it was never synced"""
+        with self.lock:
+            row = self.conn.execute("SELECT last_sync FROM sync WHERE list_id = ?", (list_id,)).fetchone()
+        return row[0] if row else None
+
+    def store(self, list_id, members, synced_at=None):
+        """Insert or replace members given as (subscriber hash, member) pairs.
+        
+        With synced_at, the stale marks from before that time are cleared too.
+        """
+        rows = (
+            (
+                list_id,
+                md5hash,
+                member.get('email_address'),
+                member.get('status'),
+                json.dumps(member.get('merge_fields', {})),
+                json.dumps(member.get('interests', {})),
+            )
+            for md5hash, member in members
+        )
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?)", rows)
+            if synced_at is not None:
+                self.conn.execute("INSERT OR REPLACE INTO sync VALUES (?, ?)", (list_id, synced_at))
+                self.conn.execute("DELETE FROM stale WHERE list_id = ? AND marked_at <= ?", (list_id, synced_at))
+
+    def load(self, list_id, index=None):
+        """Return all cached members of a list keyed by subscriber hash, in index (a dict by default)"""
+        if index is None:
+            index = {}
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT hash, email_address, status, merge_fields, interests FROM members WHERE list_id = ?",
+                (list_id,),
+            )
+            for row in rows:
+                index[row[0]] = self._member(row[1:])
+        return index
+
+    def apply(self, changes):
+        """Apply changes to cached members in one transaction.
+        
+        changes are (list_id, subscriber hash, values) tuples. values holds the
+        member fields to set, with merge_fields and interests merged into the
+        cached ones, and 'replaces' for the hash the member had before its
+        email address changed. None as values forgets the member.
+        """
+        select = "SELECT email_address, status, merge_fields, interests FROM members WHERE list_id = ? AND hash = ?"
+        with self.lock, self.conn:
+            for list_id, md5hash, values in changes:
+                previous = (values or {}).get('replaces') or md5hash
+                row = self.conn.execute(select, (list_id, previous)).fetchone()
+                if row is None and previous != md5hash:
+                    row = self.conn.execute(select, (list_id, md5hash)).fetchone()
+                self.conn.execute("DELETE FROM members WHERE list_id = ? AND hash = ?", (list_id, previous))
+                if values is None:
+                    continue
+                member = self._member(row or (None, None, None, None))
+                for key in ('email_address', 'status'):
+                    if values.get(key) is not None:
+                        member[key] = values[key]
+                member['merge_fields'].update(values.get('merge_fields') or {})
+                member['interests'].update(values.get('interests') or {})
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?)",
+                    (list_id, md5hash, member['email_address'], member['status'],
+                     json.dumps(member['merge_fields']), json.dumps(member['interests'])),
+                )
+
+    def mark_stale(self, list_id, reason):
+        """Remember that changes of a list may be missing from the cache, until the next sync or clear_stale"""
+        marked_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO stale VALUES (?, ?, ?)", (list_id, reason, marked_at))
+    
+    def clear_stale(self, list_id, reason):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM stale WHERE list_id = ? AND reason = ?", (list_id, reason))
+    
+    def stale_reasons(self, list_id):
+        """Return why changes of a list may be missing from the cache, empty when it is complete"""
+        with self.lock:
+            rows = self.conn.execute("SELECT reason FROM stale WHERE list_id = ? ORDER BY marked_at", (list_id,)).fetchall()
+        return [row[0] for row in rows]
+    
+    def writer(self, list_id, batch_size=1000):
+        """Return a CacheWriter that stores members of a list as they are fetched"""
+        return CacheWriter(self, list_id, batch_size)
+
+    def get(self, list_id, md5hash):
+        """Return a single cached member, or None if it is not in the cache"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT email_address, status, merge_fields, interests FROM members WHERE list_id = ? AND hash = ?",
+                (list_id, md5hash),
+            ).fetchone()
+        return self._member(row) if row else None
+
+    def clear(self, list_id):
+        """Forget all members and the sync timestamp of a list"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM members WHERE list_id = ?", (list_id,))
+            self.conn.execute("DELETE FROM sync WHERE list_id = ?", (list_id,))
+            self.conn.execute("DELETE FROM stale WHERE list_id = ?", (list_id,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @staticmethod
+    def _member(row):
+        """Rebuild a member in the shape returned by the Mailchimp API"""
+        email_address, status, merge_fields, interests = row
+        return {
+            'email_address': email_address,
+            'status': status,
+            'merge_fields': json.loads(merge_fields) if merge_fields else {},
+            'interests': json.loads(interests) if interests else {},
+        }
+
+
+class CacheWriter:
+    """Stores members assigned by subscriber hash in batches, so a sync never holds the whole list in memory"""
+    def __init__(self, cache, list_id, batch_size):
+        self.cache = cache
+        self.list_id = list_id
+        self.batch_size = batch_size
+        self.pending = []
+        self.count = 0
+
+    def __setitem__(self, md5hash, member):
+        self.pending.append((md5hash, member))
+        self.count += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def __len__(self):
+        return self.count
+
+    def flush(self, synced_at=None):
+        """Store the pending members, and the sync timestamp when it is given"""
+        self.cache.store(self.list_id, self.pending, synced_at=synced_at)
+        self.pending = []
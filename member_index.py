@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-compact index of the members of a list, for prefetching very large
+audiences.
+
+The API returns every member as nested dicts, which costs well over a
+kilobyte per member in Python. MemberIndex keeps only what the engine
+compares, in numpy arrays: the subscriber hash as 16 bytes (two 64-bit
+integers, sorted for binary search), the status as one byte, the interests
+of the category mapping as a 64-bit mask, and the email address, FNAME,
+LNAME and TYPE as one UTF-8 record in a shared buffer. That is about 40
+bytes per member plus the length of the address and the names, instead of
+close to a kilobyte.
+"""
+from array import array
+
+import numpy as np
+
+statuses = ['subscribed', 'unsubscribed', 'cleaned', 'pending', 'transactional', 'archived']
+name_fields = ('FNAME', 'LNAME', 'TYPE')
+all_statuses = object() # see MemberIndex.select()
+separator = '\x1f'
+
+
+class MemberIndex:
+    def __init__(self, interest_ids):
+        self.interest_ids = list(dict.fromkeys(interest for interest in interest_ids if interest))
+        if len(self.interest_ids) > 64:
+            raise ValueError("MemberIndex tracks at most 64 interests")
+        self.bits = [(interest, 1 << bit) for bit, interest in enumerate(self.interest_ids)]
+        self.statuses = list(statuses)
+        self.text = bytearray() # FNAME, LNAME and TYPE of every member, see __setitem__
+
+        # Sorted arrays, see merge()
+        self.high = np.empty(0, dtype=np.uint64)
+        self.low = np.empty(0, dtype=np.uint64)
+        self.status = np.empty(0, dtype=np.uint8)
+        self.interests = np.empty(0, dtype=np.uint64)
+        self.starts = np.empty(0, dtype=np.uint64)
+        self.lengths = np.empty(0, dtype=np.uint32)
+
+        # Members added since the last merge
+        self.new_keys = bytearray()
+        self.new_status = array('B')
+        self.new_interests = array('Q')
+        self.new_starts = array('Q')
+        self.new_lengths = array('I')
+
+    def __setitem__(self, md5hash, member):
+        """Add or replace a member given in the shape returned by the API"""
+        self.new_keys += bytes.fromhex(md5hash)
+
+        status = member.get('status') or ""
+        if status not in self.statuses:
+            self.statuses.append(status)
+        self.new_status.append(self.statuses.index(status))
+
+        interests = member.get('interests') or {}
+        mask = 0
+        for interest, bit in self.bits:
+            if interests.get(interest):
+                mask |= bit
+        self.new_interests.append(mask)
+
+        merge_fields = member.get('merge_fields') or {}
+        values = [member.get('email_address') or ""] + [merge_fields.get(field) or "" for field in name_fields]
+        record = separator.join(values).encode('utf-8')
+        self.new_starts.append(len(self.text))
+        self.new_lengths.append(len(record))
+        self.text += record
+
+    def merge(self):
+        """Sort the members added since the last merge into the arrays; a later member replaces an earlier one"""
+        keys = np.frombuffer(bytes(self.new_keys), dtype='>u8').reshape(-1, 2).astype(np.uint64)
+        high = np.concatenate([self.high, keys[:, 0]])
+        low = np.concatenate([self.low, keys[:, 1]])
+        status = np.concatenate([self.status, np.frombuffer(self.new_status, dtype=np.uint8)])
+        interests = np.concatenate([self.interests, np.frombuffer(self.new_interests, dtype=np.uint64)])
+        starts = np.concatenate([self.starts, np.frombuffer(self.new_starts, dtype=np.uint64)])
+        lengths = np.concatenate([self.lengths, np.frombuffer(self.new_lengths, dtype=np.uint32)])
+        self.new_keys = bytearray()
+        self.new_status = array('B')
+        self.new_interests = array('Q')
+        self.new_starts = array('Q')
+        self.new_lengths = array('I')
+
+        # Stable sort by hash, then keep the last entry of every run of equal hashes
+        order = np.lexsort((np.arange(len(high)), low, high))
+        high = high[order]
+        low = low[order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (high[1:] != high[:-1]) | (low[1:] != low[:-1])
+        order = order[last]
+        self.high = high[last]
+        self.low = low[last]
+        self.status = status[order]
+        self.interests = interests[order]
+        self.starts = starts[order]
+        self.lengths = lengths[order]
+
+    def position(self, md5hash):
+        if self.new_keys:
+            self.merge()
+        key = bytes.fromhex(md5hash)
+        high = int.from_bytes(key[:8], 'big')
+        low = int.from_bytes(key[8:], 'big')
+        position = int(np.searchsorted(self.high, np.uint64(high)))
+        while position < len(self.high) and self.high[position] == high:
+            if self.low[position] == low:
+                return position
+            position += 1
+        return None
+
+    def get(self, md5hash, default=None):
+        """Return the member in the shape returned by the API (for the fields the engine uses), or default"""
+        position = self.position(md5hash)
+        if position is None:
+            return default
+        mask = int(self.interests[position])
+        start = int(self.starts[position])
+        email_address, *names = self.text[start:start + int(self.lengths[position])].decode('utf-8').split(separator)
+        return {
+            'email_address': email_address,
+            'status': self.statuses[self.status[position]],
+            'merge_fields': dict(zip(name_fields, names)),
+            'interests': {interest: bool(mask & bit) for interest, bit in self.bits},
+        }
+    
+    def select(self, interest=None, statuses=all_statuses, exclude=()):
+        """Subscriber hashes of the members with the interest and one of the statuses, leaving out the hashes in exclude.
+        
+        The comparison with exclude runs on the sorted 16-byte keys, so it
+        stays fast for lists and import files with millions of entries.
+        """
+        if self.new_keys:
+            self.merge()
+        selected = np.ones(len(self.high), dtype=bool)
+        if interest is not None:
+            bit = dict(self.bits)[interest]
+            selected &= (self.interests & np.uint64(bit)) != 0
+        if statuses is not all_statuses:
+            selected &= np.isin(self.status, [self.statuses.index(status) for status in statuses if status in self.statuses])
+        keys = np.stack([self.high, self.low], axis=1).astype('>u8').view('S16').ravel()
+        if len(exclude):
+            excluded = np.frombuffer(b"".join(bytes.fromhex(md5hash) for md5hash in exclude), dtype='S16')
+            selected &= ~np.isin(keys, excluded)
+        positions = np.nonzero(selected)[0]
+        return [f"{high:016x}{low:016x}" for high, low in zip(self.high[positions].tolist(), self.low[positions].tolist())]
+
+    def __contains__(self, md5hash):
+        return self.position(md5hash) is not None
+
+    def __len__(self):
+        if self.new_keys:
+            self.merge()
+        return len(self.high)
+
+    def nbytes(self):
+        """Memory used by the arrays and the names"""
+        if self.new_keys:
+            self.merge()
+        arrays = (self.high, self.low, self.status, self.interests, self.starts, self.lengths)
+        return sum(values.nbytes for values in arrays) + len(self.text)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of a run: API requests per endpoint with their latency,
+throttled (429) responses, retries and bytes sent, next to the wall time
+per processing stage that the engine keeps itself.
+
+A report can be written as JSON or in the Prometheus text format (by
+file extension: .json or .prom), and PROFILE=cprofile or
+PROFILE=tracemalloc profiles the run.
+
+Throughput keeps a smoothed rate per stage of the run and estimates the
+time remaining until Mailchimp has processed all operations.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, share):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(share * len(values))) - 1))]
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {} # endpoint -> seconds per request
+        self.errors = {} # endpoint -> failed requests
+        self.bytes_sent = {} # endpoint -> request body bytes
+        self.throttled = 0
+        self.retries = 0
+
+    def observe(self, endpoint, seconds, status=None, sent=0, retry=False):
+        """Record one request; status is the HTTP status of a failed request (0 for network errors)"""
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            self.bytes_sent[endpoint] = self.bytes_sent.get(endpoint, 0) + sent
+            if status is not None:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            if status == 429:
+                self.throttled += 1
+            if retry:
+                self.retries += 1
+
+    def snapshot(self):
+        """Counts and p50/p95/p99 latency per endpoint"""
+        with self.lock:
+            endpoints = {}
+            for endpoint, latencies in self.latencies.items():
+                latencies = sorted(latencies)
+                endpoints[endpoint] = {
+                    'requests': len(latencies),
+                    'errors': self.errors.get(endpoint, 0),
+                    'seconds': round(sum(latencies), 3),
+                    'p50': round(percentile(latencies, 0.50), 4),
+                    'p95': round(percentile(latencies, 0.95), 4),
+                    'p99': round(percentile(latencies, 0.99), 4),
+                    'bytes_sent': self.bytes_sent.get(endpoint, 0),
+                }
+            return {
+                'endpoints': endpoints,
+                'requests': sum(values['requests'] for values in endpoints.values()),
+                'throttled': self.throttled,
+                'retries': self.retries,
+                'bytes_sent': sum(self.bytes_sent.values()),
+            }
+
+
+def format_duration(seconds):
+    """Format a number of seconds as hh:mm:ss, with days in front when it takes longer"""
+    if seconds is None:
+        return "Calculating..."
+    days, remainder = divmod(int(round(seconds)), 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    text = '{:02}:{:02}:{:02}'.format(hours, minutes, seconds)
+    return f"{days}d {text}" if days else text
+
+
+class Throughput:
+    """Smoothed rate per stage and the estimated time until all stages are done.
+
+    Stages are counted in their own units: 'rows' of the import file that
+    were looked up and turned into operations, operations submitted
+    ('submit') and operations processed by Mailchimp ('mailchimp'). A
+    stage without measurements yet uses its rate from defaults.
+    """
+    def __init__(self, defaults=None, smoothing=0.3, interval=0.5):
+        self.defaults = defaults or {}
+        self.smoothing = smoothing # weight of the newest measurement
+        self.interval = interval # minimum seconds between measurements
+        self.rates = {} # stage -> items per second
+        self.samples = {} # stage -> (time, items done) of the last measurement
+        self.remaining = {} # stage -> items still to do
+        self.lock = threading.Lock()
+
+    def update(self, stage, done, total):
+        """Record the progress of a stage"""
+        now = time.monotonic()
+        with self.lock:
+            self.remaining[stage] = max(total - done, 0)
+            previous = self.samples.get(stage)
+            if previous is None or done < previous[1]:
+                self.samples[stage] = (now, done)
+                return
+            if now - previous[0] < self.interval:
+                return
+            rate = (done - previous[1]) / (now - previous[0])
+            if stage in self.rates:
+                rate = self.smoothing * rate + (1 - self.smoothing) * self.rates[stage]
+            self.rates[stage] = rate
+            self.samples[stage] = (now, done)
+
+    def expect(self, stage, total):
+        """Set the work of a stage that has not started yet"""
+        with self.lock:
+            if stage not in self.samples:
+                self.remaining[stage] = max(int(total), 0)
+
+    def rate(self, stage):
+        return self.rates.get(stage)
+
+    def eta(self):
+        """Seconds until every stage is done, or None while a stage has no rate yet"""
+        seconds = 0.0
+        with self.lock:
+            for stage, remaining in self.remaining.items():
+                if not remaining:
+                    continue
+                rate = self.rates.get(stage) or self.defaults.get(stage)
+                if not rate:
+                    return None
+                seconds += remaining / rate
+        return seconds
+
+
+def prometheus_text(report):
+    """Render a run report (see UpdateEngine.metrics_report) in the Prometheus text format"""
+    labels = f'list_id="{report.get("list_id") or ""}"'
+    lines = [
+        "# HELP mailchimp_update_stage_seconds Wall time per processing stage of the last run",
+        "# TYPE mailchimp_update_stage_seconds gauge",
+    ]
+    for stage, seconds in report['stage_times'].items():
+        lines.append(f'mailchimp_update_stage_seconds{{{labels},stage="{stage}"}} {seconds}')
+    lines += [
+        "# HELP mailchimp_update_rows Rows in the import file of the last run",
+        "# TYPE mailchimp_update_rows gauge",
+        f"mailchimp_update_rows{{{labels}}} {report['rows']}",
+        "# HELP mailchimp_update_request_seconds Mailchimp API request latency per endpoint",
+        "# TYPE mailchimp_update_request_seconds summary",
+    ]
+    api = report['api']
+    for endpoint, values in api['endpoints'].items():
+        endpoint_labels = f'{labels},endpoint="{endpoint}"'
+        for quantile in ('p50', 'p95', 'p99'):
+            lines.append(f'mailchimp_update_request_seconds{{{endpoint_labels},quantile="0.{quantile[1:]}"}} {values[quantile]}')
+        lines.append(f"mailchimp_update_request_seconds_sum{{{endpoint_labels}}} {values['seconds']}")
+        lines.append(f"mailchimp_update_request_seconds_count{{{endpoint_labels}}} {values['requests']}")
+    for name, key, text in (
+        ('request_errors_total', 'errors', "Failed API requests per endpoint"),
+        ('bytes_sent_total', 'bytes_sent', "Request body bytes sent per endpoint"),
+    ):
+        lines += [f"# HELP mailchimp_update_{name} {text}", f"# TYPE mailchimp_update_{name} counter"]
+        for endpoint, values in api['endpoints'].items():
+            lines.append(f'mailchimp_update_{name}{{{labels},endpoint="{endpoint}"}} {values[key]}')
+    for name, key, text in (
+        ('throttled_total', 'throttled', "API requests answered with HTTP 429"),
+        ('retries_total', 'retries', "Retried API requests"),
+    ):
+        lines += [f"# HELP mailchimp_update_{name} {text}", f"# TYPE mailchimp_update_{name} counter",
+                  f"mailchimp_update_{name}{{{labels}}} {api[key]}"]
+    scheduler = report.get('scheduler')
+    if scheduler:
+        for name, key, text in (
+            ('scheduler_limit', 'limit', "Concurrent API requests the scheduler currently allows"),
+            ('scheduler_active', 'active', "API requests in flight"),
+            ('scheduler_max_queued', 'max_queued', "Most API requests waiting for a slot at once"),
+        ):
+            lines += [f"# HELP mailchimp_update_{name} {text}", f"# TYPE mailchimp_update_{name} gauge",
+                      f"mailchimp_update_{name}{{{labels}}} {scheduler[key]}"]
+        lines += ["# HELP mailchimp_update_scheduler_queued API requests waiting for a slot per priority",
+                  "# TYPE mailchimp_update_scheduler_queued gauge"]
+        for priority, queued in scheduler['queued_by_priority'].items():
+            lines.append(f'mailchimp_update_scheduler_queued{{{labels},priority="{priority}"}} {queued}')
+        lines += ["# HELP mailchimp_update_scheduler_wait_seconds Time API requests waited for a slot per priority",
+                  "# TYPE mailchimp_update_scheduler_wait_seconds summary"]
+        for priority, values in scheduler['waits'].items():
+            priority_labels = f'{labels},priority="{priority}"'
+            for quantile in ('p50', 'p95'):
+                lines.append(f'mailchimp_update_scheduler_wait_seconds{{{priority_labels},quantile="0.{quantile[1:]}"}} {values[quantile]}')
+            lines.append(f"mailchimp_update_scheduler_wait_seconds_sum{{{priority_labels}}} {values['seconds']}")
+            lines.append(f"mailchimp_update_scheduler_wait_seconds_count{{{priority_labels}}} {values['requests']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_report(report, path):
+    """Write a run report as Prometheus text (.prom) or JSON (any other extension)"""
+    with open(path, 'w', encoding='utf-8') as f:
+        if path.endswith('.prom'):
+            f.write(prometheus_text(report))
+        else:
+            json.dump(report, f, indent=2)
+
+
+def format_report(report):
+    """Human-readable lines of a run report, for the log and the summary panel"""
+    lines = [f"Rows: {report['rows']}"]
+    lines.append("Stages: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in report['stage_times'].items()))
+    api = report['api']
+    lines.append(f"API: {api['requests']} requests, {api['throttled']} throttled (429), {api['retries']} retries, "
+                 f"{api['bytes_sent'] / 1e6:.2f} MB sent")
+    for endpoint, values in sorted(api['endpoints'].items()):
+        lines.append(f"  {endpoint}: {values['requests']} requests, {values['errors']} errors, "
+                     f"p50 {values['p50'] * 1000:.0f} ms, p95 {values['p95'] * 1000:.0f} ms, p99 {values['p99'] * 1000:.0f} ms")
+    scheduler = report.get('scheduler')
+    if scheduler:
+        lines.append(f"Scheduler: limit {scheduler['limit']}/{scheduler['maximum']} ({scheduler['decreases']} decreases, "
+                     f"{scheduler['increases']} increases), at most {scheduler['max_queued']} requests waiting")
+        for priority, values in scheduler['waits'].items():
+            lines.append(f"  {priority}: {values['requests']} requests, wait p50 {values['p50'] * 1000:.0f} ms, "
+                         f"p95 {values['p95'] * 1000:.0f} ms")
+    return lines
+
+
+@contextmanager
+def profiled(mode, log, output_path=None):
+    """Profile the enclosed block with cProfile or tracemalloc and log the top entries.
+
+    Only the calling thread is profiled by cProfile; the cProfile stats are
+    also written to output_path when it is given.
+    """
+    if mode == 'cprofile':
+        import cProfile
+        import io
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output_path:
+                profiler.dump_stats(output_path)
+                log(f"Profile written to {output_path}")
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(20)
+            log(stream.getvalue())
+    elif mode == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            log(f"Memory: {current / 1e6:.1f} MB in use, {peak / 1e6:.1f} MB peak")
+            for statistic in snapshot.statistics('lineno')[:10]:
+                log(f"  {statistic}")
+    else:
+        yield
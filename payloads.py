@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Request bodies of the batch operations, built and serialized with as
+little work per member as possible.
+
+The create and update bodies of a run differ only in the email address
+and the names of the member: the status, the TYPE merge field and the
+interests or tags follow from the category configuration and the contact
+type. PayloadTemplate serializes such a body once, with placeholders for
+the per-member fields, and fills in only those fields for every member.
+
+The operations are serialized once, with dumps() when they are built,
+and kept as bytes. JsonStream joins them while the request is sent, so no
+copy of the whole batch is built as one string. orjson is used for this
+when it is installed (pip install orjson), the json module otherwise.
+"""
+import json
+import re
+from json.encoder import encode_basestring_ascii
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def dumps(value):
+    """Compact JSON of value as UTF-8 bytes"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def field(name):
+    """Placeholder for a per-member value in the shape of a PayloadTemplate"""
+    return f"\x00{name}\x00"
+
+placeholder_pattern = re.compile(r'"\\u0000(\w+)\\u0000"')
+
+
+def encode_value(value):
+    return encode_basestring_ascii(value) if isinstance(value, str) else json.dumps(value)
+
+
+class PayloadTemplate:
+    """JSON body with placeholders (see field()) that is serialized once.
+
+    render() gives the same text as json.dumps of the shape with the
+    placeholders replaced by the values, so bodies stay as they were.
+    """
+    def __init__(self, shape):
+        pieces = placeholder_pattern.split(json.dumps(shape))
+        self.fields = pieces[1::2]
+        self.text = "%s".join(piece.replace("%", "%%") for piece in pieces[0::2])
+
+    def render(self, **values):
+        return self.text % tuple(encode_value(values[name]) for name in self.fields)
+
+
+class JsonStream:
+    """Request body {key: [items]} of items serialized already (see dumps()), joined while it is sent.
+
+    Iterating yields pieces of about piece_size bytes and can be repeated for
+    a retry. len() is the size of the whole body, added up from the sizes of
+    the items, so the request is sent with a Content-Length rather than chunked.
+    """
+    def __init__(self, key, items, piece_size=65536):
+        self.prefix = b'{' + dumps(key) + b':['
+        self.items = items
+        self.piece_size = piece_size
+        self.size = len(self.prefix) + 2 + sum(len(item) for item in items) + max(len(items) - 1, 0)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        piece = bytearray(self.prefix)
+        for number, item in enumerate(self.items):
+            if number:
+                piece += b','
+            piece += item
+            if len(piece) >= self.piece_size:
+                yield bytes(piece)
+                piece = bytearray()
+        piece += b']}'
+        yield bytes(piece)
+
+    async def pieces(self):
+        """The pieces as an async generator, for aiohttp"""
+        for piece in self:
+            yield piece
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduler for the API requests of the whole process.
+
+Mailchimp allows 10 simultaneous connections per account, and lookups,
+prefetch pages, batch submissions and status checks all count towards
+it. ApiScheduler gives out that many slots: a request waits for a slot
+before it is sent and returns it when the answer is in. Waiting requests
+are served by priority (status checks before writes, writes before bulk
+reads) and in order of arrival within a priority.
+
+The limit adapts to what the API reports: it is halved on a throttled
+(429) response, lowered by one when most requests of a window are much
+slower than the moving average of their endpoint, and raised by one after
+a window without either, up to the maximum. The average follows slowly,
+so a burst of slow requests stands out, while requests that stay slower,
+e.g. with larger bodies, become the new normal. The threaded engine sends
+its requests through one pooled session of the scheduler (see
+pooled_client()); the asyncio engine keeps its aiohttp session but takes
+its slots from the same scheduler.
+"""
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import percentile
+
+# Priorities, lower is served first
+INTERACTIVE = 0 # batch status checks and polls
+WRITE = 1 # batch submissions, batch subscribe and segment requests
+BULK = 2 # prefetch pages, member lookups and segment member pages
+priority_names = {INTERACTIVE: 'interactive', WRITE: 'write', BULK: 'bulk'}
+
+
+class Slot:
+    """Outcome of the request in a slot: status is the HTTP status of a failed request (0 for network errors)"""
+    def __init__(self):
+        self.status = None
+
+
+class ApiScheduler:
+    def __init__(self, maximum=10, minimum=1, slow_ratio=4.0, baseline_weight=0.01, recent_waits=1000):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.slow_ratio = slow_ratio # slower than this times the average of its endpoint counts as slow
+        self.baseline_weight = baseline_weight # weight of a request in the moving average of its endpoint
+        self.recent_waits = recent_waits # waits per priority kept for the percentiles
+        self.limit = maximum
+        self.active = 0
+        self.waiting = [] # heap of (priority, arrival, enqueued at, grant)
+        self.arrivals = itertools.count()
+        self.lock = threading.Lock()
+        self.pool = None # requests session, see session()
+
+        # Adaptation, see release()
+        self.baseline = {} # endpoint -> moving average of the seconds per request
+        self.window = 0 # requests finished since the limit last changed
+        self.slow = 0
+        self.decreases = 0
+        self.increases = 0
+
+        # Monitoring, see stats(); the process may run for days, so only recent waits are kept
+        self.waits = {} # priority -> [requests, seconds, longest wait, deque of recent waits]
+        self.max_queued = 0
+
+    def session(self):
+        """requests session with a connection pool of the maximum number of slots, created on first use"""
+        with self.lock:
+            if self.pool is None:
+                import requests
+                self.pool = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.maximum)
+                self.pool.mount('https://', adapter)
+                self.pool.mount('http://', adapter)
+            return self.pool
+
+    def resize(self, maximum):
+        """Change the maximum number of slots, e.g. to the workers of a new run"""
+        with self.lock:
+            if self.limit == self.maximum or self.limit > maximum:
+                self.limit = maximum
+            self.maximum = maximum
+            grants = self.grant_waiting()
+        for grant in grants:
+            grant()
+
+    def record_wait(self, priority, seconds):
+        """Count the time a request waited for its slot (called with the lock held)"""
+        waits = self.waits.get(priority)
+        if waits is None:
+            waits = self.waits[priority] = [0, 0.0, 0.0, deque(maxlen=self.recent_waits)]
+        waits[0] += 1
+        waits[1] += seconds
+        waits[2] = max(waits[2], seconds)
+        waits[3].append(seconds)
+
+    def grant_waiting(self):
+        """Take slots for waiting requests while there is room, returns their grants (called with the lock held)"""
+        grants = []
+        while self.waiting and self.active < self.limit:
+            priority, arrival, since, grant = heapq.heappop(self.waiting)
+            self.active += 1
+            self.record_wait(priority, time.monotonic() - since)
+            grants.append(grant)
+        return grants
+
+    def enqueue(self, priority, grant):
+        """Call grant() once a slot is free for a request of this priority"""
+        with self.lock:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.record_wait(priority, 0.0)
+            else:
+                heapq.heappush(self.waiting, (priority, next(self.arrivals), time.monotonic(), grant))
+                self.max_queued = max(self.max_queued, len(self.waiting))
+                return
+        grant()
+
+    def acquire(self, priority=BULK):
+        """Wait for a slot"""
+        granted = threading.Event()
+        self.enqueue(priority, granted.set)
+        granted.wait()
+
+    async def acquire_async(self, priority=BULK):
+        """Wait for a slot without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def grant():
+            if future.cancelled():
+                self.release() # the request was cancelled while it waited, pass the slot on
+            else:
+                future.set_result(None)
+
+        def schedule():
+            try:
+                loop.call_soon_threadsafe(grant)
+            except RuntimeError:
+                self.release() # the event loop is closed
+
+        self.enqueue(priority, schedule)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # cancelled after the slot was granted, before the request could use it
+            raise
+
+    def release(self, endpoint=None, seconds=None, status=None):
+        """Return a slot, with the latency and status (see Slot) of its request when it was sent"""
+        with self.lock:
+            self.active -= 1
+            if seconds is not None:
+                self.adapt(endpoint, seconds, status)
+            grants = self.grant_waiting()
+        for grant in grants:
+            grant()
+
+    def adapt(self, endpoint, seconds, status):
+        """Adjust the limit after a request (called with the lock held)"""
+        if status == 429:
+            # Throttled: halve at once, and give the new limit a full window
+            if self.limit > self.minimum:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.decreases += 1
+            self.window = 0
+            self.slow = 0
+            return
+        if status is not None and (status == 0 or status >= 500):
+            return # network and server errors say nothing about our concurrency
+        baseline = self.baseline.get(endpoint)
+        if baseline is None:
+            self.baseline[endpoint] = seconds
+        else:
+            if seconds > self.slow_ratio * baseline:
+                self.slow += 1
+            self.baseline[endpoint] = baseline + self.baseline_weight * (seconds - baseline)
+        self.window += 1
+        if self.window < self.limit:
+            return
+        if self.slow * 2 > self.window and self.limit > self.minimum:
+            self.limit -= 1
+            self.decreases += 1
+        elif self.slow * 2 <= self.window and self.limit < self.maximum:
+            self.limit += 1
+            self.increases += 1
+        self.window = 0
+        self.slow = 0
+
+    @contextmanager
+    def slot(self, priority=BULK, endpoint=None):
+        """Hold a slot for one request; set the status of the yielded Slot when the request fails"""
+        self.acquire(priority)
+        slot = Slot()
+        start = time.perf_counter()
+        try:
+            yield slot
+        finally:
+            self.release(endpoint, time.perf_counter() - start, slot.status)
+
+    def stats(self):
+        """Limit, slots in use, queue depth and wait time per priority"""
+        with self.lock:
+            queued = {name: 0 for name in priority_names.values()}
+            for priority, arrival, since, grant in self.waiting:
+                queued[priority_names.get(priority, str(priority))] += 1
+            waits = {}
+            for priority, (requests, total, longest, recent) in self.waits.items():
+                recent = sorted(recent)
+                waits[priority_names.get(priority, str(priority))] = {
+                    'requests': requests,
+                    'seconds': round(total, 3),
+                    'max': round(longest, 4),
+                    'p50': round(percentile(recent, 0.50), 4),
+                    'p95': round(percentile(recent, 0.95), 4),
+                }
+            return {
+                'limit': self.limit,
+                'maximum': self.maximum,
+                'active': self.active,
+                'queued': sum(queued.values()),
+                'queued_by_priority': queued,
+                'max_queued': self.max_queued,
+                'waits': waits,
+                'decreases': self.decreases,
+                'increases': self.increases,
+            }
+
+
+def pooled_client(api_key, scheduler, timeout):
+    """mailchimp3 client that sends its requests through the pooled session of the scheduler"""
+    from mailchimp3 import MailChimp
+
+    class PooledMailChimp(MailChimp):
+        def _make_request(self, **kwargs):
+            return scheduler.session().request(**kwargs)
+
+    return PooledMailChimp(mc_api=api_key, timeout=timeout)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Shared setup of the tests: the configuration the modules read from the
+environment when they are imported, the repository on the import path,
+and FakeMailChimp with a list of students.
+"""
+import os
+import sys
+
+# Read at import time, so set before the tests import the modules
+os.environ.update({
+    'MAILCHIMP_LIST_ID': 'L',
+    'CONFIG_CACHE_PATH': '',
+    'CONFIG_CACHE_WEBHOOKS': 'false',
+    'DEBUG_MODE': 'false',
+    'CATEGORY_TYPE_STUDENT': 'ts',
+    'CATEGORY_TYPE_EMPLOYEE': 'te',
+    'CATEGORY_KIND_OF_EMAIL_WEEKLY': 'w',
+    'CATEGORY_TAAL_NEDERLANDS': 'nl',
+    'CATEGORY_TAAL_ENGLISH': 'en',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+import pytest
+
+import mailchimp_engine
+from fake_mailchimp import FakeMailChimp
+
+student = {'ts': True, 'nl': True, 'en': False}
+employee = {'te': True, 'nl': True, 'en': False}
+
+
+@pytest.fixture(autouse=True)
+def report_dir(tmp_path, monkeypatch):
+    """Reports and checkpoints of a test go to its own directory"""
+    monkeypatch.setattr(mailchimp_engine, 'config_report_dir', str(tmp_path))
+    monkeypatch.setattr(mailchimp_engine, 'config_checkpoint_dir', str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(mailchimp_engine, 'config_cache_path', "")
+    monkeypatch.setattr(mailchimp_engine, 'config_cache_webhooks', False)
+    return tmp_path
+
+
+@pytest.fixture
+def fake():
+    """FakeMailChimp that finishes batches at once"""
+    return FakeMailChimp(batch_rate=1e9, seed=1)
+
+
+def add_members(fake, emails, interests=student):
+    fake.add_members('L', [{'email_address': email_address, 'merge_fields': {'FNAME': 'V', 'LNAME': 'N', 'TYPE': 'Student'},
+                            'interests': dict(interests)} for email_address in emails])
+
+
+def write_contacts(path, emails):
+    """Write an import file with these email addresses, returns its path"""
+    pd.DataFrame({'Voornaam': ['V'] * len(emails), 'Naam': ['N'] * len(emails), 'E-mailadres': list(emails)}).to_csv(path, index=False)
+    return str(path)
+
+
+def statuses(fake):
+    """Status per email address of the members of the fake list"""
+    return {member['email_address']: member['status'] for member in fake.members.get('L', {}).values()}
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import inspect
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+import mailchimp_async
+import mailchimp_engine
+from conftest import add_members, statuses, write_contacts
+from mailchimp_async import AsyncUpdateEngine
+from mailchimp_engine import RunCancelled
+
+
+def async_engine(fake, **kwargs):
+    """Asyncio engine that talks to the fake over HTTP"""
+    return AsyncUpdateEngine(mailchimp=fake, api_key='fake-us1', base_url=fake.api_url(), log=lambda message: None, **kwargs)
+
+
+@pytest.mark.parametrize('subscribe_max', [0, 5000])
+def test_run_against_the_fake(fake, tmp_path, monkeypatch, subscribe_max):
+    # Through /batches and through batch subscribe
+    monkeypatch.setattr(mailchimp_engine, 'config_subscribe_max', subscribe_max)
+    add_members(fake, [f"s{i}@example.org" for i in range(20)], interests={'ts': False, 'nl': True, 'en': False})
+    path = write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(50)])
+    engine = async_engine(fake, update=True)
+    try:
+        summary = engine.run(path)
+        report = engine.new_error_report()
+        engine.poll_batches(report, interval=0.01)
+    finally:
+        engine.close()
+    assert summary['created'] == 30
+    assert summary['updated'] == 20
+    assert report.failed == 0
+    assert len(statuses(fake)) == 50
+    assert all(member['interests']['ts'] for member in fake.members['L'].values())
+    # One request for the creates and one for the updates
+    assert fake.calls['batch_operations.create' if subscribe_max == 0 else 'lists.update_members'] == 2
+
+
+def test_error_pages_are_retried(tmp_path, monkeypatch):
+    from fake_mailchimp import FakeMailChimp
+    fake = FakeMailChimp(batch_rate=1e9, seed=3, error_rate=0.2, error_page=True)
+    monkeypatch.setattr(mailchimp_async, 'config_retries', 10)
+    monkeypatch.setattr(mailchimp_engine, 'config_prefetch', False) # a lookup per member
+    path = write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(20)])
+    engine = async_engine(fake, update=True)
+    try:
+        summary = engine.run(path)
+    finally:
+        engine.close()
+    assert fake.errors > 0
+    assert summary['created'] == 20
+    assert len(statuses(fake)) == 20
+
+
+def test_cancelled_engine_closes_the_coroutine(fake):
+    async def request():
+        await asyncio.sleep(0)
+
+    engine = async_engine(fake)
+    engine.cancel()
+    coroutine = request()
+    try:
+        with pytest.raises(RunCancelled):
+            engine.wait(coroutine)
+    finally:
+        engine.close()
+    assert inspect.getcoroutinestate(coroutine) == inspect.CORO_CLOSED
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+import mailchimp_engine
+from conftest import add_members, statuses, write_contacts
+from fake_mailchimp import FakeMailChimp
+from mailchimp_engine import UpdateEngine
+
+
+@pytest.fixture(autouse=True)
+def batches_only(monkeypatch):
+    """Send everything through /batches, which is what a checkpoint follows up"""
+    monkeypatch.setattr(mailchimp_engine, 'config_subscribe_max', 0)
+
+
+def test_resume_after_interrupted_submit(fake, tmp_path):
+    path = write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(50)])
+    engine = UpdateEngine(update=True, mailchimp=fake, log=lambda message: None)
+    engine.submit = lambda: (_ for _ in ()).throw(RuntimeError("interrupted"))
+    with pytest.raises(RuntimeError):
+        engine.run(path)
+    assert fake.calls['batch_operations.create'] == 0
+
+    logs = []
+    engine = UpdateEngine(update=True, mailchimp=fake, log=logs.append)
+    summary = engine.run(path)
+    assert summary['created'] == 50
+    assert any(message.startswith("Resuming interrupted run") for message in logs)
+    engine.poll_batches(engine.new_error_report(), interval=0.01)
+    assert len(statuses(fake)) == 50
+    assert os.listdir(tmp_path / "checkpoints") == []
+
+
+def test_accepted_batches_are_not_submitted_again(fake, tmp_path):
+    path = write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(50)])
+    UpdateEngine(update=True, mailchimp=fake, log=lambda message: None).run(path)
+    assert fake.calls['batch_operations.create'] == 1
+
+    # The process crashed before the batches were polled
+    engine = UpdateEngine(update=True, mailchimp=fake, log=lambda message: None)
+    engine.run(path)
+    assert fake.calls['batch_operations.create'] == 1
+    assert [batch['operations'] for batch in engine.batches] == [50]
+    report = engine.new_error_report()
+    engine.poll_batches(report, interval=0.01)
+    assert report.failed == 0
+    assert os.listdir(tmp_path / "checkpoints") == []
+
+
+def test_unpolled_runs_submit_again(tmp_path, monkeypatch, capsys):
+    path = write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(50)])
+    for run in range(2):
+        # A list that lost its members between the runs needs all of them again
+        fake = FakeMailChimp(batch_rate=1e9, seed=run)
+        monkeypatch.setattr(mailchimp_engine, 'get_client', lambda: fake)
+        assert mailchimp_engine.main([path, '--quiet', '--list-id', 'L']) == 0
+        summary = json.loads(capsys.readouterr().out)
+        assert summary['created'] == 50
+        assert fake.calls['batch_operations.create'] == 1
+        assert len(statuses(fake)) == 50
+        assert os.listdir(tmp_path / "checkpoints") == []
+
+
+def test_unreadable_results_are_reported(fake, tmp_path, monkeypatch):
+    path = write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(10)])
+    fake.batch_rate = 0.001
+    engine = UpdateEngine(update=False, mailchimp=fake, log=lambda message: None)
+    engine.run(path)
+    # The create of s2 fails once the batch is processed
+    add_members(fake, ["s2@example.org"])
+    fake.batch_rate = 1e9
+
+    def unreadable(url):
+        raise OSError("connection reset")
+    monkeypatch.setattr(mailchimp_engine, 'iter_operation_results', unreadable)
+    monkeypatch.setattr(mailchimp_engine, 'config_retries', 1)
+    report = engine.new_error_report()
+    engine.poll_batches(report, interval=0.01)
+    assert engine.batches[0]['failed'] == 1
+    assert report.failed == 1
+    with open(report.path, encoding='utf-8') as f:
+        assert "Unreadable results" in f.read()
+    assert os.listdir(tmp_path / "checkpoints") == []
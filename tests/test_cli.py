@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+import json
+
+import mailchimp_engine
+from conftest import add_members, statuses, write_contacts
+
+
+def test_dry_run_writes_nothing(fake, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(mailchimp_engine, 'get_client', lambda: fake)
+    add_members(fake, [f"s{i}@example.org" for i in range(5)], interests={'ts': False, 'nl': True, 'en': False})
+    path = write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(10)] + ["invalid"])
+
+    assert mailchimp_engine.main([path, '--quiet', '--dry-run', '--update-policy', 'update', '--list-id', 'L']) == 0
+    summary = json.loads(capsys.readouterr().out)
+    assert summary['dry_run']
+    assert (summary['created'], summary['updated'], summary['skipped']) == (5, 5, 1)
+    assert fake.calls['batch_operations.create'] == 0
+    assert fake.calls['lists.update_members'] == 0
+    assert len(statuses(fake)) == 5
+    assert not any(member['interests']['ts'] for member in fake.members['L'].values())
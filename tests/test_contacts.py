@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+from fake_mailchimp import subscriber_hash
+from mailchimp_engine import normalise_contacts, resolve_columns
+
+
+def test_columns_by_alias():
+    columns = resolve_columns(['Voornaam', 'Roepnaam', 'Tussenvoegsel', 'Voorvoegsels', 'Achternaam', 'E-mailadres'])
+    # The alias with the highest priority wins
+    assert columns == {'voorvoegsels': 'Voorvoegsels', 'roepnaam': 'Voornaam', 'achternaam': 'Achternaam', 'email': 'E-mailadres'}
+    assert resolve_columns(['Name', 'Email'])['roepnaam'] is None
+
+
+def test_contacts_are_cleaned_and_validated():
+    data = pd.DataFrame({
+        'Roepnaam': [' Anna ', 'Bram', None, 'Daan', 'Eva'],
+        'Voorvoegsels': ['van der', None, '', None, None],
+        'Achternaam': ['Berg', 'Smit', 'Jansen', 'nan', 'Vries'],
+        'E-mailadres': ['Anna@Example.org ', 'bram.example.org', 'c@example.org', 'd@example.org', 'NULL'],
+    }, index=[10, 11, 12, 13, 14])
+    contacts, warnings, errors = normalise_contacts(data)
+
+    assert list(contacts.index) == [10, 12, 13]
+    assert list(contacts['roepnaam']) == ['Anna', '', 'Daan']
+    assert list(contacts['achternaam']) == ['van der Berg', 'Jansen', '']
+    assert list(contacts['email']) == ['Anna@Example.org', 'c@example.org', 'd@example.org']
+    # The subscriber hash is taken of the lowercase address
+    assert contacts.loc[10, 'hash'] == subscriber_hash('anna@example.org')
+    assert warnings == ['Warning: First name missing for c@example.org', 'Warning: Last name missing for d@example.org']
+    assert errors == ['Error: Invalid email address (index = 11)', 'Error: Invalid email address (index = 14)']
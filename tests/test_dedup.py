@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import pytest
+
+from conftest import statuses
+from mailchimp_engine import UpdateEngine, plan_dedup
+
+
+@pytest.fixture
+def contacts(tmp_path):
+    """s0 three times (the first without a last name), s1 once"""
+    path = tmp_path / "contacts.csv"
+    pd.DataFrame({
+        'Voornaam': ['A', 'B', 'C', ''],
+        'Naam': ['', 'One', 'Two', 'Three'],
+        'E-mailadres': ['s0@example.org', 's1@example.org', 'S0@Example.org', 's0@example.org'],
+    }).to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.mark.parametrize('policy, drop, names', [
+    ('first', {2: 0, 3: 0}, {}),
+    ('last', {0: 3, 2: 3}, {}),
+    ('non-empty', {2: 0, 3: 0}, {0: ('A', 'Two')}),
+    ('off', {}, {}),
+])
+def test_policies(contacts, policy, drop, names):
+    assert plan_dedup(contacts, policy) == (drop, names)
+
+
+def test_duplicates_are_sent_once(fake, contacts):
+    engine = UpdateEngine(update=True, mailchimp=fake, log=lambda message: None, dedup='non-empty')
+    summary = engine.run(contacts)
+    engine.poll_batches(engine.new_error_report(), interval=0.01)
+
+    assert summary['created'] == 2
+    assert summary['duplicates'] == 2
+    assert sorted(statuses(fake)) == ['s0@example.org', 's1@example.org']
+    member = next(member for member in fake.members['L'].values() if member['email_address'] == 's0@example.org')
+    assert member['merge_fields'] == {'FNAME': 'A', 'LNAME': 'Two', 'TYPE': 'Student'}
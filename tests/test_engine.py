@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import mailchimp_engine
+from conftest import add_members, statuses, write_contacts
+from fake_mailchimp import subscriber_hash
+from mailchimp_engine import UpdateEngine, plan_batches
+
+
+def run(fake, path, **kwargs):
+    engine = UpdateEngine(mailchimp=fake, log=lambda message: None, **kwargs)
+    summary = engine.run(path)
+    report = engine.new_error_report()
+    engine.poll_batches(report, interval=0.01)
+    return summary, report
+
+
+def test_prefetch_pages_through_the_list(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr(mailchimp_engine, 'config_paginate', 10)
+    add_members(fake, [f"s{i}@example.org" for i in range(25)])
+    summary, report = run(fake, write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(30)]), update=True)
+
+    # Three pages of members and one of archived members, no lookup per contact
+    assert fake.calls['lists.members.all'] == 4
+    assert fake.calls['lists.members.get'] == 0
+    assert summary['created'] == 5
+    assert summary['unchanged'] == 25
+    assert report.failed == 0
+    assert len(statuses(fake)) == 30
+
+
+def test_lookups_without_prefetch(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr(mailchimp_engine, 'config_prefetch', False)
+    add_members(fake, [f"s{i}@example.org" for i in range(10)], interests={'ts': False, 'nl': False, 'en': True})
+    summary, report = run(fake, write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(20)]),
+                          update=True, workers=4)
+
+    assert fake.calls['lists.members.get'] == 20
+    assert fake.calls['lists.members.all'] == 0
+    assert summary['created'] == 10
+    assert summary['updated'] == 10
+    # The update keeps the language of the member
+    existing = [fake.members['L'][subscriber_hash(f"s{i}@example.org")] for i in range(10)]
+    assert all(member['interests'] == {'ts': True, 'nl': False, 'en': True} for member in existing)
+
+
+def test_batches_are_limited_by_count_and_size():
+    operations = [b"x" * 9] * 7 # 10 bytes with the separator
+    assert [len(chunk) for chunk in plan_batches(operations, max_operations=3, max_bytes=1000)] == [3, 3, 1]
+    assert [len(chunk) for chunk in plan_batches(operations, max_operations=10, max_bytes=25)] == [2, 2, 2, 1]
+    # An operation larger than the limit still gets a batch of its own
+    assert [len(chunk) for chunk in plan_batches([b"x" * 50, b"x"], max_operations=10, max_bytes=25)] == [1, 1]
+
+
+def test_status_of_all_batches(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr(mailchimp_engine, 'config_subscribe_max', 0)
+    add_members(fake, [f"s{i}@example.org" for i in range(10)], interests={'ts': False, 'nl': True, 'en': False})
+    summary, report = run(fake, write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(25)]), update=True)
+
+    assert [batch['kind'] for batch in summary['batches']] == ['create', 'update']
+    engine = UpdateEngine(mailchimp=fake, log=lambda message: None)
+    engine.batches = summary['batches']
+    totals, checks = engine.check_batches()
+    assert totals == {'batches': 2, 'total': 25, 'finished': 25, 'errored': 0, 'pending': 0, 'statuses': {'finished': 2}}
+    assert [check['total_operations'] for check in checks] == [15, 10]
+
+
+@pytest.mark.parametrize('skip_unchanged, updated', [(True, 4), (False, 10)])
+def test_unchanged_members_are_skipped(fake, tmp_path, skip_unchanged, updated):
+    add_members(fake, [f"s{i}@example.org" for i in range(10)])
+    for i in range(2):
+        fake.members['L'][subscriber_hash(f"s{i}@example.org")]['merge_fields']['TYPE'] = 'Employee'
+    for i in range(2, 4):
+        fake.members['L'][subscriber_hash(f"s{i}@example.org")]['interests']['ts'] = False
+    summary, report = run(fake, write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(10)]),
+                          update=True, skip_unchanged=skip_unchanged)
+
+    assert summary['updated'] == updated
+    assert summary['unchanged'] == 10 - updated
+    assert all(member['merge_fields']['TYPE'] == 'Student' and member['interests']['ts'] for member in fake.members['L'].values())
+
+
+def test_small_runs_use_batch_subscribe(fake, tmp_path):
+    add_members(fake, ["u0@example.org"], interests={'ts': False, 'nl': True, 'en': False})
+    fake.members['L'][subscriber_hash("u0@example.org")]['status'] = 'unsubscribed'
+    emails = ["u0@example.org"] + [f"s{i}@example.org" for i in range(600)]
+    summary, report = run(fake, write_contacts(tmp_path / "contacts.csv", emails), update=True)
+
+    # 500 members per request, with the results at once
+    assert fake.calls['lists.update_members'] == 3
+    assert fake.calls['batch_operations.create'] == 0
+    assert all('check' in batch for batch in summary['batches'])
+    assert summary['created'] == 600
+    assert summary['updated'] == 1
+    assert report.failed == 0
+    # The status only applies to new members
+    assert statuses(fake)["u0@example.org"] == 'unsubscribed'
+    assert fake.members['L'][subscriber_hash("u0@example.org")]['interests']['ts']
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+import time
+
+import pytest
+
+tk = pytest.importorskip('tkinter')
+
+import mailchimp_engine
+from conftest import statuses, write_contacts
+from mailchimp_engine import UpdateEngine
+from mailchimp_update import MailchimpUpdaterGUI
+
+
+class Root:
+    """Stands in for the Tk root, which needs a display; remembers the threads that call it"""
+    def __init__(self):
+        self.threads = set()
+
+    def after(self, delay, callback, *args):
+        self.threads.add(threading.current_thread())
+
+
+def updater():
+    gui = MailchimpUpdaterGUI.__new__(MailchimpUpdaterGUI)
+    gui.root = Root()
+    gui.log_queue = queue.Queue()
+    gui.ui_queue = queue.Queue()
+    gui.latest_progress = None
+    return gui
+
+
+def test_poller_leaves_widgets_to_the_tk_thread(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr(mailchimp_engine, 'config_subscribe_max', 0)
+    monkeypatch.setattr(mailchimp_engine, 'config_poll_interval', 0.01)
+    gui = updater()
+    gui.engine = UpdateEngine(update=True, mailchimp=fake, log=gui.log_message, progress=gui.on_progress)
+    gui.engine.run(write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(20)]))
+
+    gui.start_batch_poller()
+    calls = []
+    deadline = time.monotonic() + 10
+    while len(calls) < 2 and time.monotonic() < deadline:
+        try:
+            calls.append(gui.ui_queue.get(timeout=0.1))
+        except queue.Empty:
+            pass
+    # The status check and the run summary, both called by drain_log
+    assert [callback for callback, args in calls][0] == gui.check_batch_status
+    assert len(calls) == 2
+    assert gui.root.threads == set()
+    assert len(statuses(fake)) == 20
+    assert all('failed' in batch for batch in gui.engine.batches)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import mailchimp_engine
+from conftest import statuses, write_contacts
+from fake_mailchimp import subscriber_hash
+from job_queue import JobQueue
+
+
+def run_queue(fake, jobs, **kwargs):
+    queue = JobQueue(jobs, processes=2, update=True, mailchimp=fake, log=lambda message: None, **kwargs)
+    summary = queue.run()
+    queue.poll_batches(queue.new_error_report(), interval=0.01)
+    return summary
+
+
+@pytest.mark.parametrize('policy, kept', [('first', 'ts'), ('last', 'te')])
+def test_dedup_across_files(fake, tmp_path, policy, kept):
+    students = write_contacts(tmp_path / "students.csv", [f"s{i}@example.org" for i in range(30)])
+    employees = write_contacts(tmp_path / "employees.csv", [f"S{i}@example.org" for i in range(20, 40)])
+    summary = run_queue(fake, [(students, 'Student'), (employees, 'Employee')], dedup=policy)
+
+    assert summary['created'] == 40
+    assert summary['duplicates'] == 10
+    assert [job['duplicates'] for job in summary['jobs']] == ([0, 10] if policy == 'first' else [10, 0])
+    assert len(statuses(fake)) == 40
+    interests = fake.members['L'][subscriber_hash("s25@example.org")]['interests']
+    assert interests.get(kept) is True
+    assert not interests.get({'ts': 'te', 'te': 'ts'}[kept])
+
+
+def test_failed_job_is_counted(fake, tmp_path):
+    students = write_contacts(tmp_path / "students.csv", [f"s{i}@example.org" for i in range(10)])
+    summary = run_queue(fake, [(students, 'Student'), (str(tmp_path / "missing.csv"), 'Employee')])
+
+    assert [job['status'] for job in summary['jobs']] == ['submitted', 'failed']
+    assert summary['jobs'][1]['error']
+    assert summary['failed'] == 1
+    assert summary['created'] == 10
+
+
+@pytest.mark.parametrize('missing, code', [(False, 0), (True, 1)])
+def test_exit_code(fake, tmp_path, monkeypatch, capsys, missing, code):
+    monkeypatch.setattr(mailchimp_engine, 'get_client', lambda: fake)
+    files = [write_contacts(tmp_path / "students.csv", [f"s{i}@example.org" for i in range(10)]),
+             write_contacts(tmp_path / "employees.csv", [f"e{i}@example.org" for i in range(10)]) + "=Employee"]
+    if missing:
+        files.append(str(tmp_path / "missing.csv"))
+    assert mailchimp_engine.main(files + ['--quiet', '--processes', '2', '--list-id', 'L']) == code
+
+    summary = json.loads(capsys.readouterr().out)
+    assert summary['failed'] == int(missing)
+    assert summary['created'] == 20
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta, timezone
+
+import mailchimp_engine
+from conftest import add_members
+from fake_mailchimp import subscriber_hash
+from mailchimp_engine import UpdateEngine
+
+
+def later(minutes=1):
+    return (datetime.now(timezone.utc) + timedelta(minutes=minutes)).isoformat(timespec='seconds')
+
+
+def add_unchanged(fake, emails):
+    """Members that were last changed well before the first sync"""
+    add_members(fake, emails)
+    for member in fake.members['L'].values():
+        member['last_changed'] = later(-60)
+
+
+def sync(fake, logs):
+    engine = UpdateEngine(mailchimp=fake, log=logs.append)
+    return engine.sync_member_cache()
+
+
+def test_incremental_sync(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr(mailchimp_engine, 'config_cache_path', str(tmp_path / "cache.db"))
+    add_unchanged(fake, [f"s{i}@example.org" for i in range(30)])
+    logs = []
+    index = sync(fake, logs)
+    assert len(index) == 30
+    assert "30 changed" in logs[-1]
+
+    member = fake.members['L'][subscriber_hash("s3@example.org")]
+    member['merge_fields']['LNAME'] = 'Changed'
+    member['last_changed'] = later()
+    add_members(fake, ["new@example.org"])
+    fake.members['L'][subscriber_hash("new@example.org")]['last_changed'] = later()
+    logs = []
+    index = sync(fake, logs)
+    assert len(index) == 31
+    assert index.get(subscriber_hash("s3@example.org"))['merge_fields']['LNAME'] == 'Changed'
+    assert "fetching changes only" in logs[0]
+    assert "(2 changed, 0 archived)" in logs[-1]
+
+
+def test_archived_members_keep_their_status(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr(mailchimp_engine, 'config_cache_path', str(tmp_path / "cache.db"))
+    add_unchanged(fake, [f"s{i}@example.org" for i in range(10)])
+    sync(fake, [])
+
+    for i in range(3):
+        member = fake.members['L'][subscriber_hash(f"s{i}@example.org")]
+        member['status'] = 'archived'
+        member['last_changed'] = later()
+    logs = []
+    index = sync(fake, logs)
+    assert len(index) == 10
+    assert "(0 changed, 3 archived)" in logs[-1]
+    assert index.get(subscriber_hash("s0@example.org"))['status'] == 'archived'
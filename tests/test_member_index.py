@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from fake_mailchimp import subscriber_hash
+from member_index import MemberIndex
+
+
+def member(email_address, status='subscribed', interests=None, **names):
+    return {'email_address': email_address, 'status': status, 'merge_fields': dict({'FNAME': "", 'LNAME': "", 'TYPE': "Student"}, **names),
+            'interests': interests or {}}
+
+
+def test_members_round_trip():
+    index = MemberIndex(['ts', 'te', None, 'ts'])
+    index[subscriber_hash("a@example.org")] = member("a@example.org", interests={'ts': True, 'other': True}, FNAME="Zoë", LNAME="Müller")
+    index[subscriber_hash("b@example.org")] = member("b@example.org", status='archived', interests={'te': True})
+
+    assert len(index) == 2
+    assert index.get(subscriber_hash("a@example.org")) == {
+        'email_address': "a@example.org",
+        'status': 'subscribed',
+        'merge_fields': {'FNAME': "Zoë", 'LNAME': "Müller", 'TYPE': "Student"},
+        # Only the interests of the category mapping are kept
+        'interests': {'ts': True, 'te': False},
+    }
+    assert index.get(subscriber_hash("b@example.org"))['status'] == 'archived'
+    assert subscriber_hash("c@example.org") not in index
+    assert index.get(subscriber_hash("c@example.org"), 'missing') == 'missing'
+
+
+def test_later_members_replace_earlier_ones():
+    index = MemberIndex(['ts'])
+    for i in range(100):
+        index[subscriber_hash(f"s{i}@example.org")] = member(f"s{i}@example.org", interests={'ts': True})
+    assert len(index) == 100 # merged into the sorted arrays
+    index[subscriber_hash("s5@example.org")] = member("s5@example.org", status='cleaned', LNAME="New")
+
+    assert len(index) == 100
+    assert index.get(subscriber_hash("s5@example.org"))['merge_fields']['LNAME'] == "New"
+    assert index.get(subscriber_hash("s5@example.org"))['status'] == 'cleaned'
+
+
+def test_select_by_interest_status_and_exclusion():
+    index = MemberIndex(['ts', 'te'])
+    index[subscriber_hash("s0@example.org")] = member("s0@example.org", interests={'ts': True})
+    index[subscriber_hash("s1@example.org")] = member("s1@example.org", status='unsubscribed', interests={'ts': True})
+    index[subscriber_hash("s2@example.org")] = member("s2@example.org", interests={'ts': True})
+    index[subscriber_hash("e0@example.org")] = member("e0@example.org", interests={'te': True})
+
+    assert sorted(index.select('ts')) == sorted(subscriber_hash(f"s{i}@example.org") for i in range(3))
+    assert sorted(index.select('ts', ('subscribed',))) == sorted(subscriber_hash(f"s{i}@example.org") for i in (0, 2))
+    assert index.select('ts', ('subscribed',), exclude={subscriber_hash("s0@example.org")}) == [subscriber_hash("s2@example.org")]
+    assert index.select('te', ('pending',)) == []
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import json
+
+from conftest import write_contacts
+from mailchimp_engine import UpdateEngine
+from metrics import Metrics
+
+
+def test_requests_per_endpoint():
+    metrics = Metrics()
+    for milliseconds in range(1, 101):
+        metrics.observe('lists.members.get', milliseconds / 1000, sent=10)
+    metrics.observe('lists.members.get', 0.5, status=429, retry=True)
+    metrics.observe('batches.create', 0.2, status=0)
+
+    snapshot = metrics.snapshot()
+    endpoint = snapshot['endpoints']['lists.members.get']
+    assert (endpoint['requests'], endpoint['errors'], endpoint['bytes_sent']) == (101, 1, 1000)
+    assert (endpoint['p50'], endpoint['p95'], endpoint['p99']) == (0.05, 0.096, 0.1)
+    assert snapshot['endpoints']['batches.create']['errors'] == 1
+    assert (snapshot['requests'], snapshot['throttled'], snapshot['retries']) == (102, 1, 1)
+
+
+def test_run_exports_its_metrics(fake, tmp_path):
+    engine = UpdateEngine(update=True, mailchimp=fake, log=lambda message: None)
+    engine.run(write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(10)]))
+
+    assert engine.export_metrics(str(tmp_path / "metrics.json")) == str(tmp_path / "metrics.json")
+    with open(tmp_path / "metrics.json", encoding='utf-8') as f:
+        report = json.load(f)
+    assert report['rows'] == 10
+    assert {'count', 'prefetch', 'submit'} <= set(report['stage_times'])
+    assert report['api']['endpoints']['lists.batch_subscribe']['requests'] == 1
+
+    engine.export_metrics(str(tmp_path / "metrics.prom"))
+    with open(tmp_path / "metrics.prom", encoding='utf-8') as f:
+        text = f.read()
+    assert 'mailchimp_update_rows{list_id="L"} 10' in text
+    assert 'mailchimp_update_request_seconds_count{list_id="L",endpoint="lists.batch_subscribe"} 1' in text
+    assert engine.export_metrics() is None # no CONFIG_METRICS_FILE
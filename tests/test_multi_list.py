@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from conftest import add_members, write_contacts
+from fake_mailchimp import subscriber_hash
+from mailchimp_engine import MultiListEngine, create_engine, load_targets
+
+
+def test_one_pass_updates_every_list(fake, tmp_path):
+    targets = tmp_path / "lists.json"
+    targets.write_text(json.dumps([
+        {'list_id': 'L'},
+        {'list_id': 'M', 'contact_type': 'Employee', 'category': {'Type': {'Employee': 'me'}}},
+    ]))
+    add_members(fake, [f"s{i}@example.org" for i in range(5)])
+    path = write_contacts(tmp_path / "contacts.csv", [f"s{i}@example.org" for i in range(10)] + ["invalid"])
+
+    engine = create_engine(targets=load_targets(str(targets)), update=True, mailchimp=fake, log=lambda message: None)
+    assert isinstance(engine, MultiListEngine)
+    summary = engine.run(path)
+    engine.poll_batches(engine.new_error_report(), interval=0.01)
+
+    assert [(totals['list_id'], totals['created'], totals['unchanged']) for totals in summary['lists']] == [('L', 5, 5), ('M', 10, 0)]
+    assert summary['created'] == 15
+    assert summary['skipped'] == 1 # counted once for the file
+    member = fake.members['M'][subscriber_hash("s0@example.org")]
+    assert member['merge_fields']['TYPE'] == 'Employee'
+    assert member['interests'] == {'me': True, 'w': True, 'nl': True}
+    assert len(fake.members['L']) == 10
+
+
+def test_targets_need_a_list_id(tmp_path):
+    path = tmp_path / "lists.json"
+    path.write_text(json.dumps([{'list_id': 'L'}, {'contact_type': 'Employee'}]))
+    with pytest.raises(ValueError, match="each with a list_id"):
+        load_targets(str(path))
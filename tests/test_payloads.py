@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from payloads import JsonStream, PayloadTemplate, dumps, field
+
+
+def test_template_renders_like_json_dumps():
+    shape = {'email_address': field('email_address'), 'status': 'subscribed',
+             'merge_fields': {'FNAME': field('FNAME'), 'LNAME': field('LNAME'), 'TYPE': "100%"}, 'interests': {'ts': True}}
+    template = PayloadTemplate(shape)
+    values = {'email_address': 'zoë@example.org', 'FNAME': 'Zoë "Z"', 'LNAME': 'van\\Berg'}
+
+    expected = json.loads(json.dumps(shape))
+    expected['email_address'] = values['email_address']
+    expected['merge_fields'].update(FNAME=values['FNAME'], LNAME=values['LNAME'])
+    assert template.render(**values) == json.dumps(expected)
+
+
+@pytest.mark.parametrize('piece_size', [1, 10, 65536])
+def test_stream_joins_the_operations(piece_size):
+    operations = [dumps({'method': 'POST', 'path': f"/lists/L/members/{i}", 'body': "{}"}) for i in range(20)]
+    stream = JsonStream("operations", operations, piece_size=piece_size)
+
+    body = b"".join(stream)
+    assert len(body) == len(stream)
+    assert json.loads(body) == {'operations': [json.loads(operation) for operation in operations]}
+    # A retry sends the same body again
+    assert b"".join(stream) == body
+    assert json.loads(b"".join(JsonStream("operations", []))) == {'operations': []}
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import pytest
+
+from mailchimp_engine import count_rows, read_contacts
+
+
+def test_csv_in_chunks(tmp_path):
+    # Excel in a Dutch locale writes ';' and cp1252
+    path = tmp_path / "contacts.csv"
+    rows = ["Voornaam;Naam;E-mailadres;Opleiding"] + [f"Zoë{i};Müller;z{i}@example.org;Wiskunde" for i in range(5)]
+    path.write_bytes("\r\n".join(rows).encode('cp1252'))
+
+    chunks = list(read_contacts(str(path), chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert list(pd.concat(chunks).index) == list(range(5))
+    # Only the columns the contacts are read from
+    assert list(chunks[0].columns) == ['Voornaam', 'Naam', 'E-mailadres']
+    assert chunks[0].iloc[0].tolist() == ['Zoë0', 'Müller', 'z0@example.org']
+    assert count_rows(str(path)) == 5
+
+
+def test_excel_in_chunks(tmp_path):
+    pytest.importorskip('openpyxl')
+    path = str(tmp_path / "contacts.xlsx")
+    data = pd.DataFrame({
+        'Voornaam': [f"V{i}" for i in range(5)] + [None, " "],
+        'Naam': ["N"] * 5 + [None, None],
+        'E-mailadres': [f"s{i}@example.org" for i in range(5)] + [None, None],
+    })
+    data.to_excel(path, index=False)
+
+    chunks = list(read_contacts(path, chunk_size=4))
+    # Empty rows at the end of the sheet are left out
+    assert [len(chunk) for chunk in chunks] == [4, 1]
+    assert list(pd.concat(chunks).index) == list(range(5))
+    assert chunks[1].iloc[-1].tolist() == ['V4', 'N', 's4@example.org']
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import mailchimp_engine
+from mailchimp_engine import MultiListEngine, UpdateEngine
+from scheduler import ApiScheduler
+
+
+def test_cancel_while_waiting_passes_the_slot_on():
+    scheduler = ApiScheduler(maximum=1)
+
+    async def main():
+        await scheduler.acquire_async()
+        waiting = asyncio.ensure_future(scheduler.acquire_async())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        scheduler.release()
+        await asyncio.sleep(0.01)
+        assert waiting.cancelled()
+
+    asyncio.run(main())
+    assert scheduler.active == 0
+    assert scheduler.stats()['queued'] == 0
+
+
+def test_cancel_after_the_grant_releases_the_slot():
+    scheduler = ApiScheduler(maximum=1)
+
+    async def main():
+        await scheduler.acquire_async()
+        waiting = asyncio.ensure_future(scheduler.acquire_async())
+        await asyncio.sleep(0)
+        scheduler.release() # grants the slot to the waiting request
+        waiting.cancel() # before it could resume
+        await asyncio.sleep(0.01)
+        assert waiting.cancelled()
+
+    asyncio.run(main())
+    assert scheduler.active == 0
+
+
+def test_top_level_workers_size_the_scheduler(monkeypatch):
+    monkeypatch.setattr(mailchimp_engine, 'api_scheduler', None)
+    scheduler = mailchimp_engine.get_scheduler(3)
+    assert (scheduler.maximum, scheduler.limit) == (3, 3)
+    # An engine takes the shared scheduler as it is
+    assert UpdateEngine(workers=6, log=lambda message: None).scheduler is scheduler
+    assert scheduler.maximum == 3
+
+
+def test_lists_share_all_workers(monkeypatch):
+    monkeypatch.setattr(mailchimp_engine, 'api_scheduler', None)
+    targets = [{'list_id': list_id} for list_id in ('A', 'B', 'C')]
+    engine = MultiListEngine(targets, workers=10, log=lambda message: None)
+    assert (engine.scheduler.maximum, engine.scheduler.limit) == (10, 10)
+    assert all(list_engine.scheduler is engine.scheduler for list_engine in engine.engines)
+    assert [list_engine.workers for list_engine in engine.engines] == [3, 3, 3]
+
+
+def test_waits_are_bounded():
+    scheduler = ApiScheduler(maximum=2, recent_waits=10)
+    for _ in range(100):
+        scheduler.acquire()
+        scheduler.release()
+    waits = scheduler.stats()['waits']['bulk']
+    assert waits['requests'] == 100
+    assert len(scheduler.waits[2][3]) == 10
+
+
+def test_slower_requests_become_the_baseline():
+    scheduler = ApiScheduler(maximum=10)
+    for _ in range(50):
+        scheduler.acquire()
+        scheduler.release('batches.create', 0.1, None)
+    # Larger batches stay slower: the limit drops at first, then recovers
+    for _ in range(200):
+        scheduler.acquire()
+        scheduler.release('batches.create', 1.0, None)
+    assert scheduler.decreases > 0
+    assert scheduler.limit == scheduler.maximum
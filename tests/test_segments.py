@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import mailchimp_engine
+from conftest import add_members, employee, write_contacts
+from fake_mailchimp import subscriber_hash
+from mailchimp_engine import UpdateEngine
+
+segments = {
+    'Kind of email': {'Weekly': 'Weekly', 'instant': None},
+    'Type': {'Student': 'Students', 'Employee': 'Employees'},
+    'Taal': {'Nederlands': 'NL', 'English': 'EN'},
+}
+
+
+def segment_members(fake, name):
+    """Email addresses in the segment (or tag) with this name"""
+    segment = next(segment for segment in fake.segments['L'].values() if segment['name'] == name)
+    return sorted(member['email_address'] for md5hash, member in fake.members['L'].items() if md5hash in segment['members'])
+
+
+def emails(numbers):
+    return sorted(f"s{i}@example.org" for i in numbers)
+
+
+@pytest.mark.parametrize('subscribe_max', [0, 5000])
+def test_groups_are_set_with_segment_requests(fake, tmp_path, monkeypatch, subscribe_max):
+    # New members get their tags in the create operation, or with segment requests after batch subscribe
+    monkeypatch.setattr(mailchimp_engine, 'config_subscribe_max', subscribe_max)
+    add_members(fake, emails(range(10)))
+    add_members(fake, ["e0@example.org", "e1@example.org"], employee)
+    fake.add_segment('L', 'Employees', emails(range(5)) + ["e0@example.org", "e1@example.org"])
+    fake.add_segment('L', 'EN', ["s0@example.org"])
+    fake.add_segment('L', 'NL', [])
+    fake.add_segment('L', 'Weekly', [])
+
+    path = write_contacts(tmp_path / "students.csv", emails(range(15)))
+    engine = UpdateEngine(update=True, mailchimp=fake, log=lambda message: None, group_mode='segments', segments=segments)
+    summary = engine.run(path)
+    report = engine.new_error_report()
+    engine.poll_batches(report, interval=0.01)
+
+    assert summary['created'] == 5
+    assert summary['unchanged'] == 10 # only their segments change
+    assert summary['segments']['Students'] == {'added': 15, 'removed': 0}
+    assert summary['segments']['Employees'] == {'added': 0, 'removed': 5}
+    assert report.failed == 0
+    # The missing tag of the type was created
+    assert segment_members(fake, 'Students') == emails(range(15))
+    assert segment_members(fake, 'Employees') == ["e0@example.org", "e1@example.org"]
+    # Members keep their language, Nederlands when they have none
+    assert segment_members(fake, 'EN') == ["s0@example.org"]
+    assert segment_members(fake, 'NL') == emails(range(1, 15))
+    assert segment_members(fake, 'Weekly') == emails(range(10, 15))
+    assert fake.members['L'][subscriber_hash("s10@example.org")]['interests'] == {} # no interests are sent
+    # A few bulk requests instead of an update per member
+    assert fake.calls['lists.segments.update_members'] <= 6
+
+
+def test_unknown_segment_id_is_an_error(fake, tmp_path):
+    path = write_contacts(tmp_path / "students.csv", emails(range(3)))
+    mapping = dict(segments, Type={'Student': '4242', 'Employee': 'Employees'})
+    engine = UpdateEngine(update=True, mailchimp=fake, log=lambda message: None, group_mode='segments', segments=mapping)
+    with pytest.raises(ValueError, match="Static segment 4242"):
+        engine.run(path)
+    assert fake.calls['batch_operations.create'] + fake.calls['lists.update_members'] == 0
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import mailchimp_engine
+from conftest import add_members, employee, statuses, write_contacts
+from job_queue import JobQueue
+from mailchimp_engine import UpdateEngine
+
+
+def run(fake, path, **kwargs):
+    engine = UpdateEngine(update=True, mailchimp=fake, log=lambda message: None, sync_max_share=0.5, **kwargs)
+    summary = engine.run(path)
+    engine.poll_batches(engine.new_error_report(), interval=0.01)
+    return summary
+
+
+@pytest.fixture
+def students(fake):
+    """20 subscribed and 5 unsubscribed students, and 5 employees"""
+    add_members(fake, [f"s{i}@example.org" for i in range(20)])
+    add_members(fake, [f"u{i}@example.org" for i in range(5)])
+    for member in fake.members['L'].values():
+        if member['email_address'].startswith('u'):
+            member['status'] = 'unsubscribed'
+    add_members(fake, [f"e{i}@example.org" for i in range(5)], employee)
+
+
+@pytest.mark.parametrize('mode, removed', [('archive', 8), ('unsubscribe', 4)])
+def test_removes_members_missing_from_the_file(fake, tmp_path, students, mode, removed):
+    path = write_contacts(tmp_path / "students.csv", [f"s{i}@example.org" for i in range(16)] + ["u0@example.org"])
+    summary = run(fake, path, sync=mode)
+
+    assert summary['removed'] == removed
+    status = statuses(fake)
+    assert status['s16@example.org'] == ('archived' if mode == 'archive' else 'unsubscribed')
+    assert status['u1@example.org'] == ('archived' if mode == 'archive' else 'unsubscribed')
+    assert status['e0@example.org'] == 'subscribed' # another contact type
+    with open(summary['sync_report'], encoding='utf-8') as f:
+        assert len(f.readlines()) == removed + 1
+
+
+def test_stops_when_too_many_would_be_removed(fake, tmp_path, students):
+    path = write_contacts(tmp_path / "students.csv", [f"s{i}@example.org" for i in range(5)])
+    engine = UpdateEngine(update=True, mailchimp=fake, log=lambda message: None, sync='archive', sync_max_share=0.1)
+    with pytest.raises(ValueError, match="CONFIG_SYNC_MAX_SHARE"):
+        engine.run(path)
+    assert fake.calls['lists.update_members'] + fake.calls['batch_operations.create'] == 0
+
+
+def test_removes_once_with_the_member_cache(fake, tmp_path, monkeypatch, students):
+    monkeypatch.setattr(mailchimp_engine, 'config_cache_path', str(tmp_path / "cache.db"))
+    path = write_contacts(tmp_path / "students.csv", [f"s{i}@example.org" for i in range(16)])
+    assert run(fake, path, sync='archive')['removed'] == 9
+    # The cache knows the archived members, so they are not archived again
+    assert run(fake, path, sync='archive')['removed'] == 0
+
+
+@pytest.mark.parametrize('cache', [False, True])
+def test_archived_contacts_are_updated(fake, tmp_path, monkeypatch, students, cache):
+    if cache:
+        monkeypatch.setattr(mailchimp_engine, 'config_cache_path', str(tmp_path / "cache.db"))
+    run(fake, write_contacts(tmp_path / "students.csv", [f"s{i}@example.org" for i in range(16)]), sync='archive')
+
+    # Back in the file, the archived students are found instead of created again
+    engine = UpdateEngine(update=True, skip_unchanged=False, mailchimp=fake, log=lambda message: None)
+    summary = engine.run(write_contacts(tmp_path / "all.csv", [f"s{i}@example.org" for i in range(20)]))
+    report = engine.new_error_report()
+    engine.poll_batches(report, interval=0.01)
+    assert summary['created'] == 0
+    assert summary['updated'] == 20
+    assert report.failed == 0
+
+
+def run_queue(fake, jobs):
+    queue = JobQueue(jobs, processes=2, update=True, mailchimp=fake, log=lambda message: None, sync='archive', sync_max_share=0.5)
+    summary = queue.run()
+    queue.poll_batches(queue.new_error_report(), interval=0.01)
+    return summary
+
+
+def test_queue_compares_with_all_files(fake, tmp_path, students):
+    first = write_contacts(tmp_path / "first.csv", [f"s{i}@example.org" for i in range(8)])
+    second = write_contacts(tmp_path / "second.csv", [f"s{i}@example.org" for i in range(8, 16)])
+    summary = run_queue(fake, [(first, 'Student'), (second, 'Student')])
+
+    # Only the members in neither file, and only by one of the jobs
+    assert summary['removed'] == 9
+    assert sorted(job['removed'] for job in summary['jobs']) == [0, 9]
+    assert sorted(email for email, status in statuses(fake).items() if status == 'archived') == sorted(
+        [f"s{i}@example.org" for i in range(16, 20)] + [f"u{i}@example.org" for i in range(5)])
+    assert run_queue(fake, [(first, 'Student'), (second, 'Student')])['removed'] == 0
+
+
+def test_queue_skips_the_sync_when_a_file_fails(fake, tmp_path, students):
+    first = write_contacts(tmp_path / "first.csv", [f"s{i}@example.org" for i in range(8)])
+    summary = run_queue(fake, [(first, 'Student'), (str(tmp_path / "missing.csv"), 'Student')])
+
+    assert summary['failed'] == 1
+    assert summary['removed'] == 0
+    assert 'archived' not in statuses(fake).values()
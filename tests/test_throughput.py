@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import metrics
+from metrics import Throughput, format_duration
+
+
+def test_format_duration():
+    assert format_duration(None) == "Calculating..."
+    assert format_duration(59.6) == "00:01:00"
+    assert format_duration(3 * 86400 + 3723) == "3d 01:02:03"
+
+
+def test_smoothed_rates_and_eta(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(metrics.time, 'monotonic', lambda: clock[0])
+    throughput = Throughput(defaults={'mailchimp': 10}, smoothing=0.5, interval=1)
+    throughput.update('rows', 0, 1000)
+    throughput.expect('mailchimp', 1000)
+    assert throughput.eta() is None # no rate for the rows yet
+
+    clock[0] = 0.5
+    throughput.update('rows', 100, 1000)
+    assert throughput.rate('rows') is None # measured too soon
+    clock[0] = 1
+    throughput.update('rows', 100, 1000)
+    assert throughput.rate('rows') == 100
+    clock[0] = 2
+    throughput.update('rows', 400, 1000)
+    assert throughput.rate('rows') == 200 # halfway between 100 and 300
+    # 600 rows at 200 per second and 1000 operations at the default of 10 per second
+    assert throughput.eta() == 103
+
+    throughput.update('mailchimp', 1000, 1000)
+    throughput.update('rows', 1000, 1000)
+    assert throughput.eta() == 0
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import time
+import urllib.request
+from urllib.parse import urlencode
+
+import pytest
+
+import mailchimp_engine
+from conftest import add_members, write_contacts
+from fake_mailchimp import subscriber_hash
+from mailchimp_engine import UpdateEngine
+from member_cache import MemberCache
+from webhook_receiver import WebhookReceiver, replay
+
+categories = {'L': {'Taal': {'name': 'Taal', 'Nederlands': 'nl', 'English': 'en'}}}
+
+webhooks = [
+    {'type': 'subscribe', 'data[list_id]': 'L', 'data[email]': 'a@example.org', 'data[merges][FNAME]': 'Anna',
+     'data[merges][LNAME]': 'Smit', 'data[merges][GROUPINGS][0][name]': 'Taal', 'data[merges][GROUPINGS][0][groups]': 'English'},
+    {'type': 'subscribe', 'data[list_id]': 'L', 'data[email]': 'b@example.org'},
+    {'type': 'subscribe', 'data[list_id]': 'L', 'data[email]': 'c@example.org'},
+    {'type': 'profile', 'data[list_id]': 'L', 'data[email]': 'a@example.org', 'data[merges][LNAME]': 'de Smit'},
+    {'type': 'upemail', 'data[list_id]': 'L', 'data[old_email]': 'b@example.org', 'data[new_email]': 'b2@example.org'},
+    {'type': 'unsubscribe', 'data[list_id]': 'L', 'data[email]': 'c@example.org', 'data[action]': 'delete'},
+    {'type': 'cleaned', 'data[list_id]': 'L', 'data[email]': 'd@example.org'},
+    {'type': 'campaign', 'data[list_id]': 'L'},
+]
+
+
+def post(url, fields):
+    request = urllib.request.Request(url, data=urlencode(fields).encode('utf-8'), method='POST')
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+
+def check_cache(path):
+    cache = MemberCache(path)
+    try:
+        members = cache.load('L')
+    finally:
+        cache.close()
+    assert set(members) == {subscriber_hash(email) for email in ('a@example.org', 'b2@example.org', 'd@example.org')}
+    anna = members[subscriber_hash('a@example.org')]
+    assert anna['status'] == 'subscribed'
+    assert anna['merge_fields'] == {'FNAME': 'Anna', 'LNAME': 'de Smit'}
+    assert anna['interests'] == {'nl': False, 'en': True}
+    assert members[subscriber_hash('b2@example.org')]['email_address'] == 'b2@example.org'
+    assert members[subscriber_hash('d@example.org')]['status'] == 'cleaned'
+
+
+def test_recorded_webhooks_replay_into_the_cache(tmp_path):
+    record = str(tmp_path / "webhooks.jsonl")
+    receiver = WebhookReceiver(str(tmp_path / "live.db"), categories=categories, secret="s3cret", record=record, log=lambda message: None)
+    url = receiver.start('127.0.0.1', 0)
+    try:
+        for fields in webhooks:
+            assert post(url + "?secret=s3cret", fields) == 200
+    finally:
+        receiver.close()
+    assert receiver.stats()['received'] == len(webhooks)
+    check_cache(str(tmp_path / "live.db"))
+
+    receiver = WebhookReceiver(str(tmp_path / "replayed.db"), categories=categories, log=lambda message: None)
+    try:
+        assert replay(record, receiver) == len(webhooks)
+    finally:
+        receiver.close()
+    check_cache(str(tmp_path / "replayed.db"))
+
+
+def test_missed_webhooks_mark_the_cache_stale(tmp_path):
+    receiver = WebhookReceiver(str(tmp_path / "cache.db"), categories=categories, log=lambda message: None)
+    try:
+        receiver.start('127.0.0.1', 0)
+        assert receiver.cache.stale_reasons('L') == ['receiver started']
+        receiver.cache.store('L', [], synced_at='2999-01-01T00:00:00+00:00')
+        assert receiver.cache.stale_reasons('L') == []
+
+        def broken(changes):
+            raise sqlite3.OperationalError("disk I/O error")
+        receiver.cache.apply = broken
+        assert receiver.receive(urlencode(webhooks[0]))
+        deadline = time.monotonic() + 5
+        while receiver.stats()['failed'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert receiver.stats()['failed'] == 1
+        assert receiver.cache.stale_reasons('L') == ['webhooks failed']
+    finally:
+        receiver.close()
+
+
+@pytest.fixture
+def webhook_cache(fake, tmp_path, monkeypatch):
+    """A member cache that was filled by a run, with webhooks keeping it current from then on"""
+    monkeypatch.setattr(mailchimp_engine, 'config_cache_path', str(tmp_path / "cache.db"))
+    add_members(fake, [f"s{i}@example.org" for i in range(10)])
+    UpdateEngine(mailchimp=fake, log=lambda message: None).sync_member_cache()
+    monkeypatch.setattr(mailchimp_engine, 'config_cache_webhooks', True)
+    return str(tmp_path / "cache.db")
+
+
+def test_stale_cache_fetches_the_changes(fake, webhook_cache, monkeypatch):
+    calls = fake.calls['lists.members.all']
+    UpdateEngine(mailchimp=fake, log=lambda message: None).sync_member_cache()
+    assert fake.calls['lists.members.all'] == calls
+
+    cache = MemberCache(webhook_cache)
+    cache.mark_stale('L', 'webhooks failed')
+    # Marks from the second a sync starts are kept, as they may be newer than the changes it fetches
+    with cache.conn:
+        cache.conn.execute("UPDATE stale SET marked_at = '2000-01-01T00:00:00+00:00'")
+    cache.close()
+    logs = []
+    UpdateEngine(mailchimp=fake, log=logs.append).sync_member_cache()
+    assert fake.calls['lists.members.all'] > calls
+    assert "webhooks failed" in logs[0]
+
+    # The sync cleared the mark, but a cache older than CONFIG_CACHE_MAX_AGE is synced as well
+    calls = fake.calls['lists.members.all']
+    UpdateEngine(mailchimp=fake, log=lambda message: None).sync_member_cache()
+    assert fake.calls['lists.members.all'] == calls
+    monkeypatch.setattr(mailchimp_engine, 'config_cache_max_age', 0)
+    UpdateEngine(mailchimp=fake, log=lambda message: None).sync_member_cache()
+    assert fake.calls['lists.members.all'] > calls
+
+
+def test_run_applies_its_writes_to_the_cache(fake, webhook_cache, tmp_path):
+    path = write_contacts(tmp_path / "students.csv", [f"s{i}@example.org" for i in range(5, 15)])
+    engine = UpdateEngine(update=True, mailchimp=fake, log=lambda message: None)
+    engine.run(path)
+    cache = MemberCache(webhook_cache)
+    try:
+        assert cache.stale_reasons('L') == [engine.cache_mark]
+        engine.poll_batches(engine.new_error_report(), interval=0.01)
+        assert cache.stale_reasons('L') == []
+        members = cache.load('L')
+    finally:
+        cache.close()
+    assert len(members) == 15
+    assert members[subscriber_hash("s14@example.org")]['status'] == 'subscribed'
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Receiver for Mailchimp list webhooks that keeps the member cache current,
+so the updater does not have to fetch the changes at the start of a run.
+
+Mailchimp posts every subscribe, unsubscribe, profile, upemail (email
+change) and cleaned event of a list as a form to the webhook URL. The
+receiver turns each event into a change of the member in the cache
+(CONFIG_CACHE_PATH), keyed by the same subscriber hash process_contacts
+computes. Events wait in a bounded queue and one writer thread applies
+what has accumulated in a single transaction, so a burst becomes a few
+large writes. When the queue is full the webhook is answered with 503,
+and Mailchimp sends it again later. When the receiver starts, or webhooks
+it answered could not be written, the lists are marked stale in the cache
+and the next run of the updater fetches their changes.
+
+    python webhook_receiver.py serve --port 8080 --record webhooks.jsonl
+    python webhook_receiver.py replay webhooks.jsonl        # straight into the cache
+    python webhook_receiver.py replay webhooks.jsonl --url http://127.0.0.1:8080/?secret=...
+
+Register https://<host>/?secret=<CONFIG_WEBHOOK_SECRET> as webhook of the
+list, with all sources (including the API, so the updater's own changes
+reach the cache), and set CONFIG_CACHE_WEBHOOKS=true for the updater.
+"""
+import argparse
+import hmac
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import urllib.request
+from datetime import datetime
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, urlsplit
+
+from mailchimp_engine import category, config_cache_path, config_lists, listid, load_targets, print_log, target_category
+from member_cache import MemberCache
+
+config_webhook_host = os.environ.get("CONFIG_WEBHOOK_HOST", "127.0.0.1")
+config_webhook_port = int(os.environ.get("CONFIG_WEBHOOK_PORT", "8080"))
+config_webhook_secret = os.environ.get("CONFIG_WEBHOOK_SECRET", "") # the secret query parameter of the webhook URL
+config_webhook_queue = int(os.environ.get("CONFIG_WEBHOOK_QUEUE", "10000")) # webhooks waiting to be written, 503 when full
+config_webhook_batch = int(os.environ.get("CONFIG_WEBHOOK_BATCH", "500")) # webhooks written per transaction
+
+merge_names = ('FNAME', 'LNAME', 'TYPE')
+
+
+def subscriber_hash(email_address):
+    return md5(email_address.lower().encode('utf-8')).hexdigest()
+
+
+def webhook_interests(fields, mapping):
+    """Interests of the category mapping set by the groupings of a webhook, as interest id -> bool"""
+    interests = {}
+    number = 0
+    while f"data[merges][GROUPINGS][{number}][name]" in fields:
+        prefix = f"data[merges][GROUPINGS][{number}]"
+        number += 1
+        group = next((values for values in mapping.values() if fields[prefix + "[name]"] == values.get('name')
+                      or (values.get('id') and fields.get(prefix + "[unique_id]") == values.get('id'))), None)
+        if group is None:
+            continue
+        chosen = set(name.strip() for name in fields.get(prefix + "[groups]", "").split(","))
+        for name, interest in group.items():
+            if name not in ('name', 'id') and interest:
+                interests[interest] = name in chosen
+    return interests
+
+
+def webhook_changes(fields, categories):
+    """Cache changes of one webhook (see MemberCache.apply), given its form fields and the category mapping per list"""
+    event = fields.get('type')
+    list_id = fields.get('data[list_id]')
+    if not list_id or event not in ('subscribe', 'unsubscribe', 'profile', 'upemail', 'cleaned'):
+        return [] # e.g. campaign events
+
+    if event == 'upemail':
+        new_email = fields['data[new_email]']
+        return [(list_id, subscriber_hash(new_email),
+                 {'email_address': new_email, 'replaces': subscriber_hash(fields['data[old_email]'])})]
+
+    email_address = fields['data[email]']
+    md5hash = subscriber_hash(email_address)
+    if event == 'cleaned':
+        return [(list_id, md5hash, {'email_address': email_address, 'status': 'cleaned'})]
+    if event == 'unsubscribe' and fields.get('data[action]') == 'delete':
+        # Deleted or archived members are no longer in the list
+        return [(list_id, md5hash, None)]
+
+    values = {
+        'email_address': email_address,
+        'merge_fields': {name: fields[f"data[merges][{name}]"] for name in merge_names if f"data[merges][{name}]" in fields},
+        'interests': webhook_interests(fields, categories.get(list_id, category)),
+    }
+    if event != 'profile':
+        values['status'] = 'subscribed' if event == 'subscribe' else 'unsubscribed'
+    return [(list_id, md5hash, values)]
+
+
+class WebhookReceiver:
+    """Bounded queue of webhook changes and the thread that writes them to the member cache"""
+    def __init__(self, cache_path=config_cache_path, categories=None, secret=config_webhook_secret,
+                 queue_size=config_webhook_queue, batch_size=config_webhook_batch, record=None, log=print_log):
+        if not cache_path:
+            raise ValueError("CONFIG_CACHE_PATH not set in .env file")
+        self.cache = MemberCache(cache_path)
+        self.categories = categories if categories is not None else list_categories()
+        self.secret = secret
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.record_path = record # received webhooks are appended here, for a replay
+        self.record_lock = threading.Lock()
+        self.log_message = log
+        self.server = None
+        self.lock = threading.Lock()
+        self.counts = {'received': 0, 'written': 0, 'busy': 0, 'invalid': 0, 'failed': 0, 'transactions': 0}
+        self.events = {} # webhook type -> received
+        self.stale = set() # (list id, reason) not yet marked in the cache, tried again after the next write
+        self.writer = threading.Thread(target=self.write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def count(self, name, number=1):
+        with self.lock:
+            self.counts[name] += number
+
+    def receive(self, body, timeout=1.0):
+        """Queue the changes of a form-encoded webhook body; False when the queue stayed full for timeout seconds"""
+        fields = dict(parse_qsl(body, keep_blank_values=True))
+        try:
+            changes = webhook_changes(fields, self.categories)
+        except KeyError as e:
+            self.count('invalid')
+            raise ValueError(f"Webhook without {e.args[0]}")
+        try:
+            self.queue.put(changes, timeout=timeout)
+        except queue.Full:
+            self.count('busy') # Mailchimp sends it again
+            return False
+        with self.lock:
+            self.counts['received'] += 1
+            self.events[fields.get('type', '')] = self.events.get(fields.get('type', ''), 0) + 1
+        if self.record_path:
+            line = json.dumps({'received_at': datetime.now().isoformat(timespec='seconds'), 'body': body}) + "\n"
+            with self.record_lock, open(self.record_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+        return True
+
+    def write(self):
+        """Apply the queued changes, everything that accumulated during the previous write in one transaction"""
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            webhooks = 1
+            stop = False
+            while webhooks < self.batch_size:
+                try:
+                    changes = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if changes is None:
+                    stop = True
+                    break
+                batch += changes
+                webhooks += 1
+            try:
+                self.cache.apply(batch)
+                self.count('written', webhooks)
+                self.count('transactions')
+            except sqlite3.Error as e:
+                self.count('failed', webhooks)
+                self.log_message(f"Error writing {webhooks} webhooks to the member cache: {str(e)}")
+                # They were answered with 200 already, so the next run fetches the changes instead
+                self.mark_stale(set(list_id for list_id, md5hash, values in batch), 'webhooks failed')
+            else:
+                self.mark_stale((), None)
+            if stop:
+                return
+
+    def mark_stale(self, list_ids, reason):
+        """Mark lists stale in the cache, keeping the marks that fail for the next attempt"""
+        with self.lock:
+            self.stale.update((list_id, reason) for list_id in list_ids)
+            marks = sorted(self.stale)
+        if not marks:
+            return
+        try:
+            for list_id, reason in marks:
+                self.cache.mark_stale(list_id, reason)
+        except sqlite3.Error as e:
+            self.log_message(f"Error marking {len(marks)} lists stale in the member cache: {str(e)}")
+            return
+        with self.lock:
+            self.stale.difference_update(marks)
+
+    def start(self, host=config_webhook_host, port=config_webhook_port):
+        """Serve the webhook URL in a background thread, returns the URL"""
+        # Changes made while the receiver was down never reach it
+        self.mark_stale(self.categories, 'receiver started')
+        receiver = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def authorised(self):
+                secret = parse_qs(urlsplit(self.path).query).get('secret', [""])[0]
+                if receiver.secret and not hmac.compare_digest(secret, receiver.secret):
+                    self.send_error(403)
+                    return False
+                return True
+
+            def do_GET(self):
+                # Mailchimp checks that the URL answers before it saves a webhook
+                if self.authorised():
+                    self.reply(200, b"OK")
+
+            def do_POST(self):
+                if not self.authorised():
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+                try:
+                    queued = receiver.receive(body)
+                except ValueError as e:
+                    self.reply(400, str(e).encode('utf-8'))
+                    return
+                if queued:
+                    self.reply(200, b"OK")
+                else:
+                    self.reply(503, b"Busy", {'Retry-After': '5'})
+
+            def reply(self, status, text, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(text)))
+                self.end_headers()
+                self.wfile.write(text)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), WebhookHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.log_message(f"Receiving webhooks on http://{host}:{self.server.server_port}/ into {self.cache.path}")
+        return f"http://{host}:{self.server.server_port}/"
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, events=dict(self.events), queued=self.queue.qsize(), stale=len(self.stale))
+
+    def close(self):
+        """Stop receiving, write what is still queued and close the cache"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.queue.put(None)
+        self.writer.join()
+        self.cache.close()
+
+
+def list_categories():
+    """Category mapping per list id: the lists of CONFIG_LISTS, or the list of MAILCHIMP_LIST_ID"""
+    if config_lists:
+        return {target['list_id']: target_category(target) for target in load_targets(config_lists)}
+    return {listid: category} if listid else {}
+
+
+def recorded_webhooks(path):
+    """Bodies of the webhooks in a file written with --record"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)['body']
+
+
+def replay(path, receiver=None, url=None):
+    """Send recorded webhooks again, to a receiver URL or straight to a receiver; returns the number sent"""
+    sent = 0
+    for body in recorded_webhooks(path):
+        if url:
+            request = urllib.request.Request(url, data=body.encode('utf-8'), method='POST',
+                                             headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            with urllib.request.urlopen(request) as response:
+                response.read()
+        else:
+            while not receiver.receive(body):
+                pass # the writer catches up
+        sent += 1
+    return sent
+
+
+def main(argv=None):
+    """Command-line entry point: serve the webhook URL, or replay recorded webhooks"""
+    parser = argparse.ArgumentParser(description="Keep the member cache current with Mailchimp list webhooks.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="receive webhooks until interrupted")
+    serve.add_argument('--host', default=config_webhook_host, help="address to listen on (default: %(default)s)")
+    serve.add_argument('--port', type=int, default=config_webhook_port, help="port to listen on (default: %(default)s)")
+    serve.add_argument('--record', help="append every received webhook to this file, for a replay")
+    replayed = commands.add_parser('replay', help="send the webhooks of a --record file again")
+    replayed.add_argument('file')
+    replayed.add_argument('--url', help="receiver to post them to (default: apply them to the member cache directly)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'replay' and args.url:
+        start = time.perf_counter()
+        sent = replay(args.file, url=args.url)
+        print(json.dumps({'sent': sent, 'seconds': round(time.perf_counter() - start, 3)}))
+        return 0
+
+    try:
+        receiver = WebhookReceiver(record=args.record if args.command == 'serve' else None)
+    except ValueError as e:
+        parser.error(str(e))
+    start = time.perf_counter()
+    try:
+        if args.command == 'serve':
+            receiver.start(args.host, args.port)
+            while True:
+                time.sleep(1)
+        else:
+            replay(args.file, receiver)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.close()
+    print(json.dumps(dict(receiver.stats(), seconds=round(time.perf_counter() - start, 3))))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())